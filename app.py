@@ -1,11 +1,16 @@
+import json
+
 from aws_cdk import (
+    BundlingOptions,
     Duration,
     aws_iam as iam,
     aws_lambda as lambda_,
     aws_lambda_event_sources as eventsources,
     aws_apigateway as apigateway,
+    aws_dynamodb as dynamodb,
     aws_rekognition as rekognition,
     aws_s3 as s3,
+    aws_s3_notifications as s3n,
     Stack,
     App,    
     CfnOutput,
@@ -45,6 +50,20 @@ class CdklambdaStack(Stack):
                                       block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
                                       enforce_ssl=True)
         
+        # Result cache keyed by the SHA-256 of uploaded documents
+        self.result_cache_table = dynamodb.Table(self, 'result-cache-table',
+                                                 partition_key=dynamodb.Attribute(name='digest', type=dynamodb.AttributeType.STRING),
+                                                 billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                                                 time_to_live_attribute='expires_at',
+                                                 removal_policy=RemovalPolicy.DESTROY)
+
+        # Leases and completed records of processed events, absorbs duplicate notifications
+        self.idempotency_table = dynamodb.Table(self, 'idempotency-table',
+                                                partition_key=dynamodb.Attribute(name='id', type=dynamodb.AttributeType.STRING),
+                                                billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                                                time_to_live_attribute='expires_at',
+                                                removal_policy=RemovalPolicy.DESTROY)
+
         # Create Rekognition Collection
         rekognition_collection = rekognition.CfnCollection(self, "RekognitionCollection",collection_id="MyRekognitionCollection")
 
@@ -73,10 +92,63 @@ class CdklambdaStack(Stack):
             endpoint_types=[apigateway.EndpointType.REGIONAL]
         )
 
+        # Topic that Textract publishes async job completions to
+        textract_completion_topic = sns.Topic(self, "TextractCompletionTopic")
+
+        # Role Textract assumes to publish to the completion topic
+        textract_sns_role = iam.Role(self, "TextractSnsRole",
+                                     assumed_by=iam.ServicePrincipal('textract.amazonaws.com'))
+        textract_completion_topic.grant_publish(textract_sns_role)
+
+        # Pillow for the image preprocessing stage, installed with pip in the
+        # Lambda build image so the binary wheels match the runtime (needs Docker)
+        pillow_layer = lambda_.LayerVersion(self, 'pillow-layer',
+                                            code=lambda_.Code.from_asset('layers/pillow', bundling=BundlingOptions(
+                                                image=lambda_.Runtime.PYTHON_3_9.bundling_image,
+                                                command=['bash', '-c', 'pip install -r requirements.txt -t /asset-output/python']
+                                            )),
+                                            compatible_runtimes=[lambda_.Runtime.PYTHON_3_9],
+                                            description="Pillow for image preprocessing")
+
         # Trigger Textract Lambda
         trigger_textract = lambda_.Function(self, 'file-upload-trigger', **python_lambda_kwargs,
                                             code=lambda_.Code.from_asset('lambda'),
-                                            function_name="start-textract")
+                                            layers=[pillow_layer],
+                                            function_name="start-textract",
+                                            environment={
+                                                "MAX_CONCURRENCY": "8",
+                                                "RESULT_CACHE_TABLE": self.result_cache_table.table_name,
+                                                "IDEMPOTENCY_TABLE": self.idempotency_table.table_name,
+                                                "TEXTRACT_SNS_TOPIC_ARN": textract_completion_topic.topic_arn,
+                                                "TEXTRACT_ROLE_ARN": textract_sns_role.role_arn
+                                            })
+
+        # Completion notifications that still failed after Lambda's async retries,
+        # kept for replay since their documents wait in the landing bucket
+        textract_completion_dead_letter_queue = sqs.Queue(self, "TextractCompletionDeadLetterQueue",
+                                                          retention_period=Duration.days(14))
+
+        # Textract Completion Lambda, runs Comprehend and routing once a job has finished
+        completion_lambda_kwargs = dict(python_lambda_kwargs, handler='s3event.textract_completion_handler')
+        textract_complete = lambda_.Function(self, 'textract-complete', **completion_lambda_kwargs,
+                                             code=lambda_.Code.from_asset('lambda'),
+                                             function_name="complete-textract",
+                                             retry_attempts=2,
+                                             dead_letter_queue=textract_completion_dead_letter_queue,
+                                             environment={
+                                                 "MAX_CONCURRENCY": "8",
+                                                 "RESULT_CACHE_TABLE": self.result_cache_table.table_name,
+                                                 "IDEMPOTENCY_TABLE": self.idempotency_table.table_name
+                                             })
+        textract_complete.add_event_source(eventsources.SnsEventSource(textract_completion_topic))
+
+        self.result_cache_table.grant_read_write_data(trigger_textract)
+        self.result_cache_table.grant_read_write_data(textract_complete)
+        self.idempotency_table.grant_read_write_data(trigger_textract)
+        self.idempotency_table.grant_read_write_data(textract_complete)
+
+        # Allow the trigger Lambda to hand the SNS role to Textract
+        textract_sns_role.grant_pass_role(trigger_textract.role)
 
         # Lambda Integration
         integration = apigateway.LambdaIntegration(trigger_textract)
@@ -99,8 +171,38 @@ class CdklambdaStack(Stack):
             resources=['*']  # This allows access to all S3 buckets and Textract resources
         ))
 
+        textract_complete.add_to_role_policy(iam.PolicyStatement(
+            actions=[
+                's3:GetObject',
+                's3:PutObject',
+                's3:ListBucket',
+                's3:DeleteObject',
+                'textract:GetDocumentTextDetection',
+                'comprehend:*'
+            ],
+            resources=['*']
+        ))
+
+        # Buffer uploads in SQS so bursts are absorbed instead of hitting the Textract and Comprehend quotas
+        ingest_dead_letter_queue = sqs.Queue(self, "IngestDeadLetterQueue",
+                                             retention_period=Duration.days(14))
+
+        # Visibility timeout must be at least six times the function timeout
+        ingest_queue = sqs.Queue(self, "IngestQueue",
+                                 visibility_timeout=Duration.minutes(60),
+                                 dead_letter_queue=sqs.DeadLetterQueue(
+                                     max_receive_count=self.node.try_get_context('ingest:maxReceiveCount') or 3,
+                                     queue=ingest_dead_letter_queue))
+
+        self.input_bucket.add_event_notification(s3.EventType.OBJECT_CREATED, s3n.SqsDestination(ingest_queue))
+
         # Add Trigger and Environment Variables
-        trigger_textract.add_event_source(eventsources.S3EventSource(self.input_bucket, events=[s3.EventType.OBJECT_CREATED]))
+        trigger_textract.add_event_source(eventsources.SqsEventSource(
+            ingest_queue,
+            batch_size=self.node.try_get_context('ingest:batchSize') or 10,
+            max_batching_window=Duration.seconds(self.node.try_get_context('ingest:maxBatchingWindowSeconds') or 5),
+            max_concurrency=self.node.try_get_context('ingest:maxConcurrency') or 5,
+            report_batch_item_failures=True))
         
         # Create the queue
         MySqsQueue = sqs.Queue(self, "MySqsQueue")
@@ -108,12 +210,27 @@ class CdklambdaStack(Stack):
         # Create the Topic
         MySnsTopic = sns.Topic(self, "MySnsTopic")
 
+        # Classification rules from the JSON file given with -c rules:config=<path>,
+        # both functions must classify with the same rules
+        rules_config = self.node.try_get_context('rules:config')
+        if rules_config:
+            with open(rules_config) as f:
+                rules_json = json.dumps(json.load(f), separators=(',', ':'))
+            for function in (trigger_textract, textract_complete):
+                function.add_environment("RULES_CONFIG", rules_json)
+
         # Create an SQS topic subscription object
         sqsSubscription = snssubs.SqsSubscription(MySqsQueue)
 
         # Add the SQS subscription to the sns topic
         MySnsTopic.add_subscription(sqsSubscription)
 
+        # Both Lambda functions publish one result message per routed document,
+        # the subscription forwards them to MySqsQueue
+        for function in (trigger_textract, textract_complete):
+            function.add_environment("RESULT_TOPIC_ARN", MySnsTopic.topic_arn)
+            MySnsTopic.grant_publish(function)
+
         # Define the condition
         condition = {
             'ArnEquals': {
@@ -134,6 +251,8 @@ class CdklambdaStack(Stack):
         CfnOutput(self, "SQS queue name", description="SQS queue name", value=MySqsQueue.queue_name)
         CfnOutput(self, "SQS queue ARN", description="SQS queue arn", value=MySqsQueue.queue_arn)
         CfnOutput(self, "SQS queue URL", description="SQS queue URL", value=MySqsQueue.queue_url)
+        CfnOutput(self, "Ingest dead letter queue URL", description="Ingest dead letter queue URL", value=ingest_dead_letter_queue.queue_url)
+        CfnOutput(self, "Textract completion dead letter queue URL", description="Textract completion dead letter queue URL", value=textract_completion_dead_letter_queue.queue_url)
         CfnOutput(self, "SNS topic name", description="SNS topic name", value=MySnsTopic.topic_name)
         CfnOutput(self, "SNS topic ARN", description="SNS topic ARN", value=MySnsTopic.topic_arn)
 
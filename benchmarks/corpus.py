@@ -0,0 +1,119 @@
+import json
+import os
+import random
+
+# Share of each document kind in a generated corpus
+KIND_WEIGHTS = {
+    'aadhaar': 0.25,
+    'aadhaar_unnumbered': 0.10,
+    'pan': 0.15,
+    'driving_licence': 0.15,
+    'passport': 0.10,
+    'other_document': 0.10,
+    'photo': 0.10,
+    'not_an_image': 0.05
+}
+
+DOCUMENT_LABELS = [{'Name': 'Document', 'Confidence': 97.0}, {'Name': 'Text', 'Confidence': 99.0}, {'Name': 'Face', 'Confidence': 95.0}]
+JPEG_MAGIC = b'\xff\xd8\xff\xe0'
+PDF_MAGIC = b'%PDF-1.7\n'
+# Kinds whose text identifies the document, these can be scanned into a multi-page PDF
+TEXT_ID_KINDS = ('aadhaar', 'pan', 'driving_licence')
+
+VERHOEFF_D = (
+    (0, 1, 2, 3, 4, 5, 6, 7, 8, 9), (1, 2, 3, 4, 0, 6, 7, 8, 9, 5), (2, 3, 4, 0, 1, 7, 8, 9, 5, 6),
+    (3, 4, 0, 1, 2, 8, 9, 5, 6, 7), (4, 0, 1, 2, 3, 9, 5, 6, 7, 8), (5, 9, 8, 7, 6, 0, 4, 3, 2, 1),
+    (6, 5, 9, 8, 7, 1, 0, 4, 3, 2), (7, 6, 5, 9, 8, 2, 1, 0, 4, 3), (8, 7, 6, 5, 9, 3, 2, 1, 0, 4),
+    (9, 8, 7, 6, 5, 4, 3, 2, 1, 0)
+)
+VERHOEFF_P = (
+    (0, 1, 2, 3, 4, 5, 6, 7, 8, 9), (1, 5, 7, 6, 2, 8, 3, 0, 9, 4), (5, 8, 0, 3, 7, 9, 6, 1, 4, 2),
+    (8, 9, 1, 6, 0, 4, 3, 5, 2, 7), (9, 4, 5, 3, 1, 2, 6, 8, 7, 0), (4, 2, 8, 6, 5, 7, 3, 9, 0, 1),
+    (2, 7, 9, 3, 8, 0, 6, 4, 1, 5), (7, 0, 4, 6, 9, 1, 3, 2, 5, 8)
+)
+VERHOEFF_INV = (0, 4, 3, 2, 1, 5, 6, 7, 8, 9)
+
+def _aadhaar_number(rng):
+    digits = str(rng.randint(2, 9)) + ''.join(str(rng.randint(0, 9)) for _ in range(10))
+    checksum = 0
+    for index, digit in enumerate(reversed(digits)):
+        checksum = VERHOEFF_D[checksum][VERHOEFF_P[(index + 1) % 8][int(digit)]]
+    number = digits + str(VERHOEFF_INV[checksum])
+    return f"{number[:4]} {number[4:8]} {number[8:]}"
+
+def _letters(rng, count):
+    return ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(count))
+
+def _digits(rng, count):
+    return ''.join(rng.choice('0123456789') for _ in range(count))
+
+def _pages(kind, rng, filler_lines):
+    filler = [f"Line {index} {_letters(rng, 8)}" for index in range(filler_lines)]
+    if kind == 'aadhaar':
+        return [["Government of India", f"Name {_letters(rng, 6)}", _aadhaar_number(rng)] + filler]
+    if kind == 'aadhaar_unnumbered':
+        return [["Aadhaar", f"Name {_letters(rng, 6)}", "Address on reverse"] + filler]
+    if kind == 'pan':
+        return [["INCOME TAX DEPARTMENT", "Permanent Account Number Card", _letters(rng, 5) + _digits(rng, 4) + _letters(rng, 1)] + filler]
+    if kind == 'driving_licence':
+        return [["Indian Union Driving Licence", f"MH{_digits(rng, 2)} 20{_digits(rng, 2)}{_digits(rng, 7)}"] + filler]
+    if kind == 'other_document':
+        return [["Monthly statement", f"Account {_digits(rng, 10)}"] + filler]
+    return []
+
+def _labels(kind):
+    if kind == 'passport':
+        return DOCUMENT_LABELS + [{'Name': 'Passport', 'Confidence': 96.0}]
+    if kind == 'photo':
+        return [{'Name': 'Landscape', 'Confidence': 92.0}, {'Name': 'Tree', 'Confidence': 88.0}]
+    return DOCUMENT_LABELS
+
+def _scanned_pdf(pages, rng, filler_lines, page_count):
+    # The ID page at a random position among pages of filler text
+    filler_pages = [[f"Page {index} line {line} {_letters(rng, 8)}" for line in range(filler_lines)] for index in range(page_count - 1)]
+    filler_pages.insert(rng.randrange(page_count), pages[0])
+    return filler_pages
+
+def generate_corpus(documents, seed=0, filler_lines=10, duplicate_rate=0.0, pdf_rate=0.0, pdf_pages=8):
+    # Deterministic list of documents for a seed, duplicates reuse the
+    # content of an earlier document under a new key. With pdf_rate, that
+    # share of the text IDs becomes a multi-page PDF with the ID on one page.
+    rng = random.Random(seed)
+    kinds = list(KIND_WEIGHTS)
+    weights = [KIND_WEIGHTS[kind] for kind in kinds]
+    corpus = []
+    for index in range(documents):
+        if corpus and rng.random() < duplicate_rate:
+            original = rng.choice(corpus)
+            extension = os.path.splitext(original["key"])[1]
+            corpus.append(dict(original, key=f"uploads/{index:06d}-duplicate{extension}", duplicate_of=original["key"]))
+            continue
+        kind = rng.choices(kinds, weights)[0]
+        extension = '.txt' if kind == 'not_an_image' else rng.choice(['.jpg', '.jpeg', '.png'])
+        pages = _pages(kind, rng, filler_lines)
+        if pdf_rate and kind in TEXT_ID_KINDS and rng.random() < pdf_rate:
+            extension = '.pdf'
+            pages = _scanned_pdf(pages, rng, filler_lines, pdf_pages)
+        corpus.append({
+            "key": f"uploads/{index:06d}-{kind}{extension}",
+            "kind": kind,
+            "labels": _labels(kind),
+            "pages": pages,
+            "nonce": f"{seed}-{index}"
+        })
+    return corpus
+
+def document_body(document):
+    # Unique bytes per document, starting with a JPEG or PDF signature
+    nonce = document["nonce"].encode('utf-8')
+    if document["kind"] == 'not_an_image':
+        return nonce
+    return (PDF_MAGIC if document["key"].endswith('.pdf') else JPEG_MAGIC) + nonce
+
+def save_corpus(corpus, path):
+    with open(path, 'w') as f:
+        json.dump({"version": 1, "documents": corpus}, f, indent=1)
+
+def load_corpus(path):
+    with open(path) as f:
+        return json.load(f)["documents"]
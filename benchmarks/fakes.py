@@ -0,0 +1,323 @@
+import io
+import json
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+
+from botocore.exceptions import ClientError
+
+# Mean simulated latency in seconds for each API call
+DEFAULT_LATENCY = {
+    's3.get_object': 0.020,
+    's3.head_object': 0.010,
+    's3.copy_object': 0.040,
+    's3.put_object': 0.025,
+    's3.delete_object': 0.015,
+    's3.delete_objects': 0.030,
+    'rekognition.detect_labels': 0.300,
+    'textract.detect_document_text': 0.800,
+    'textract.start_document_text_detection': 0.100,
+    'textract.get_document_text_detection': 0.080,
+    'comprehend.contains_pii_entities': 0.150,
+    'comprehend.detect_pii_entities': 0.200,
+    'sns.publish_batch': 0.030,
+    'sqs.send_message_batch': 0.030
+}
+
+class Recorder:
+    # Wall time of every simulated API call, grouped by service.operation
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.durations[name].append(seconds)
+
+    def reset(self):
+        with self._lock:
+            self.durations.clear()
+
+class SimulationConfig:
+
+    def __init__(self, latency_scale=1.0, error_rate=0.0, in_progress_cycles=1, seed=None, latency=None):
+        self.latency = dict(DEFAULT_LATENCY)
+        self.latency.update(latency or {})
+        self.latency_scale = latency_scale
+        self.error_rate = error_rate
+        self.in_progress_cycles = in_progress_cycles
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self, name):
+        with self._lock:
+            # +/- 50% uniform jitter around the mean
+            jitter = self.random.uniform(0.5, 1.5)
+            fail = self.random.random() < self.error_rate
+        return self.latency.get(name, 0.0) * self.latency_scale * jitter, fail
+
+class FakeClient:
+    service_name = None
+
+    def __init__(self, world):
+        self.world = world
+
+    def _call(self, operation):
+        name = f"{self.service_name}.{operation}"
+        if self.world.on_call:
+            self.world.on_call(name)
+        seconds, fail = self.world.config.delay(name)
+        start = time.perf_counter()
+        if seconds:
+            time.sleep(seconds)
+        self.world.recorder.add(name, time.perf_counter() - start)
+        if fail:
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, operation)
+
+class _Body:
+
+    def __init__(self, data):
+        self._stream = io.BytesIO(data)
+
+    def read(self, *args):
+        return self._stream.read(*args)
+
+class FakeS3(FakeClient):
+    service_name = 's3'
+
+    def _get(self, bucket_name, object_key, operation):
+        data = self.world.objects.get((bucket_name, object_key))
+        if data is None:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'The specified key does not exist.'}}, operation)
+        return data
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self._call('get_object')
+        data = self._get(Bucket, Key, 'GetObject')
+        return {'Body': _Body(data), 'ContentLength': len(data)}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._call('head_object')
+        return {'ContentLength': len(self._get(Bucket, Key, 'HeadObject'))}
+
+    def copy_object(self, Bucket, CopySource, Key, **kwargs):
+        self._call('copy_object')
+        self.world.objects[(Bucket, Key)] = self._get(CopySource['Bucket'], CopySource['Key'], 'CopyObject')
+        return {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._call('put_object')
+        self.world.objects[(Bucket, Key)] = Body
+        return {}
+
+    def copy(self, CopySource, Bucket, Key, **kwargs):
+        self.copy_object(Bucket=Bucket, CopySource=CopySource, Key=Key)
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._call('delete_object')
+        self.world.objects.pop((Bucket, Key), None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self._call('delete_objects')
+        for item in Delete['Objects']:
+            self.world.objects.pop((Bucket, item['Key']), None)
+        return {} if Delete.get('Quiet') else {'Deleted': [{'Key': item['Key']} for item in Delete['Objects']]}
+
+    def get_paginator(self, operation_name):
+        # Only ListObjectsV2, which backfill.py lists buckets with
+        return _ListObjectsPaginator(self)
+
+class _ListObjectsPaginator:
+    page_size = 1000
+
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix='', StartAfter=None):
+        contents = [{'Key': key, 'Size': len(data)} for (bucket_name, key), data in sorted(self.s3.world.objects.items())
+                    if bucket_name == Bucket and key.startswith(Prefix) and (StartAfter is None or key > StartAfter)]
+        for start in range(0, len(contents), self.page_size):
+            self.s3._call('list_objects_v2')
+            yield {'Contents': contents[start:start + self.page_size]}
+
+class FakeRekognition(FakeClient):
+    service_name = 'rekognition'
+
+    def detect_labels(self, Image, **kwargs):
+        self._call('detect_labels')
+        document = self.world.document_for_bytes(Image['Bytes'])
+        return {'Labels': list(document["labels"]) if document else []}
+
+class _TextractExceptions:
+
+    class UnsupportedDocumentException(ClientError):
+        pass
+
+    class InvalidS3ObjectException(ClientError):
+        pass
+
+class FakeTextract(FakeClient):
+    service_name = 'textract'
+    exceptions = _TextractExceptions
+    page_size = 1000
+
+    def __init__(self, world):
+        super().__init__(world)
+        self.jobs = {}
+        self.tokens = {}
+        self._lock = threading.Lock()
+
+    def detect_document_text(self, Document):
+        self._call('detect_document_text')
+        document = self.world.document_for_bytes(Document['Bytes'])
+        return {'Blocks': _blocks(document)}
+
+    def start_document_text_detection(self, DocumentLocation, ClientRequestToken=None, JobTag=None, NotificationChannel=None, **kwargs):
+        self._call('start_document_text_detection')
+        location = DocumentLocation['S3Object']
+        with self._lock:
+            # Like Textract, a repeated token returns the job it started
+            if ClientRequestToken in self.tokens:
+                return {'JobId': self.tokens[ClientRequestToken]}
+            job_id = f"job-{len(self.jobs) + 1}"
+            self.jobs[job_id] = {
+                "key": location['Name'],
+                # A job with a notification channel has finished by the time it is delivered
+                "remaining": 0 if NotificationChannel else self.world.config.in_progress_cycles
+            }
+            if ClientRequestToken:
+                self.tokens[ClientRequestToken] = job_id
+        if NotificationChannel:
+            self.world.completions.append({'Sns': {'Message': json.dumps({
+                'JobId': job_id,
+                'Status': 'SUCCEEDED',
+                'API': 'StartDocumentTextDetection',
+                'JobTag': JobTag,
+                'DocumentLocation': {'S3ObjectName': location['Name'], 'S3Bucket': location['Bucket']}
+            })}})
+        return {'JobId': job_id}
+
+    def get_document_text_detection(self, JobId, NextToken=None, **kwargs):
+        self._call('get_document_text_detection')
+        job = self.jobs[JobId]
+        with self._lock:
+            if job["remaining"] > 0:
+                job["remaining"] -= 1
+                return {'JobStatus': 'IN_PROGRESS'}
+
+        blocks = _blocks(self.world.documents.get(job["key"]))
+        start = int(NextToken or 0)
+        response = {
+            'JobStatus': 'SUCCEEDED',
+            'DocumentMetadata': {'Pages': max([block['Page'] for block in blocks] or [1])},
+            'Blocks': blocks[start:start + self.page_size]
+        }
+        if start + self.page_size < len(blocks):
+            response['NextToken'] = str(start + self.page_size)
+        return response
+
+def _blocks(document):
+    if not document:
+        return []
+    blocks = []
+    for page, lines in enumerate(document["pages"], start=1):
+        for index, line in enumerate(lines):
+            blocks.append({
+                'BlockType': 'LINE',
+                'Id': f"{page}-{index}",
+                'Page': page,
+                'Text': line,
+                'Confidence': 99.0,
+                'Geometry': {'BoundingBox': {'Left': 0.1, 'Top': 0.05 * index, 'Width': 0.8, 'Height': 0.04}}
+            })
+    return blocks
+
+# Words the fake Comprehend treats as evidence of each entity type
+COMPREHEND_MARKERS = (
+    ('Aadhaar', 'IN_AADHAAR'),
+    ('Licence', 'DRIVER_ID'),
+    ('Permanent', 'IN_PERMANENT_ACCOUNT_NUMBER'),
+    ('Passport', 'PASSPORT_NUMBER'),
+    ('Name', 'NAME')
+)
+
+# Like the real service, an Aadhaar number is recognised without any keyword
+AADHAAR_NUMBER = re.compile(r'\b[2-9]\d{3} \d{4} \d{4}\b')
+
+def _comprehend_matches(text):
+    matches = []
+    for marker, entity_type in COMPREHEND_MARKERS:
+        offset = text.find(marker)
+        if offset >= 0:
+            matches.append((entity_type, offset, offset + len(marker)))
+    number = AADHAAR_NUMBER.search(text)
+    if number and not any(entity_type == 'IN_AADHAAR' for entity_type, _, _ in matches):
+        matches.append(('IN_AADHAAR', number.start(), number.end()))
+    return matches
+
+class FakeComprehend(FakeClient):
+    service_name = 'comprehend'
+
+    def contains_pii_entities(self, Text, LanguageCode):
+        self._call('contains_pii_entities')
+        return {'Labels': [{'Name': entity_type, 'Score': 0.95} for entity_type, _, _ in _comprehend_matches(Text)]}
+
+    def detect_pii_entities(self, Text, LanguageCode):
+        self._call('detect_pii_entities')
+        return {'Entities': [{'Type': entity_type, 'Score': 0.95, 'BeginOffset': begin, 'EndOffset': end}
+                             for entity_type, begin, end in _comprehend_matches(Text)]}
+
+class FakeSns(FakeClient):
+    service_name = 'sns'
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        self._call('publish_batch')
+        self.world.messages.extend(entry['Message'] for entry in PublishBatchRequestEntries)
+        return {'Successful': [{'Id': entry['Id']} for entry in PublishBatchRequestEntries], 'Failed': []}
+
+class FakeSqs(FakeClient):
+    service_name = 'sqs'
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self._call('send_message_batch')
+        self.world.messages.extend(entry['MessageBody'] for entry in Entries)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+class World:
+    # Shared state behind the fake clients: objects in S3 and the documents
+    # they contain, looked up by key (async Textract) or by bytes (everything else)
+
+    def __init__(self, config, on_call=None):
+        self.config = config
+        self.recorder = Recorder()
+        # Called with service.operation for every call, e.g. the handler's metrics.count_call
+        self.on_call = on_call
+        self.objects = {}
+        self.documents = {}
+        # Result notifications published to SNS or SQS
+        self.messages = []
+        # Textract completions, as the SNS records textract_completion_handler receives
+        self.completions = []
+        self._by_bytes = {}
+
+    def upload(self, bucket_name, object_key, body, document):
+        self.objects[(bucket_name, object_key)] = body
+        self.documents[object_key] = document
+        self._by_bytes[body] = document
+
+    def document_for_bytes(self, data):
+        return self._by_bytes.get(data)
+
+    def clients(self):
+        return {
+            's3': FakeS3(self),
+            'rekognition': FakeRekognition(self),
+            'textract': FakeTextract(self),
+            'comprehend': FakeComprehend(self),
+            'sns': FakeSns(self),
+            'sqs': FakeSqs(self)
+        }
@@ -0,0 +1,238 @@
+"""Offline benchmark for lambda/s3event.py.
+
+Drives lambda_handler with batches of SQS-wrapped S3 events against
+in-process stand-ins for S3, Rekognition, Textract and Comprehend, and
+reports per-stage and end-to-end latency percentiles, documents per
+second and peak memory. No AWS credentials or network access are used.
+
+    python benchmarks/run.py --documents 200 --batch-size 10
+    python benchmarks/run.py --save-baseline baseline.json
+    python benchmarks/run.py --baseline baseline.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), 'lambda')
+LANDING_BUCKET = 'docs-landing-bucket'
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark lambda_handler against simulated AWS services")
+    parser.add_argument('--documents', type=int, default=100, help="documents in a generated corpus")
+    parser.add_argument('--seed', type=int, default=0, help="seed for the corpus and simulated latencies")
+    parser.add_argument('--corpus', help="replay a corpus saved with --save-corpus")
+    parser.add_argument('--save-corpus', help="write the generated corpus to this file")
+    parser.add_argument('--duplicate-rate', type=float, default=0.0, help="share of documents re-uploading earlier content")
+    parser.add_argument('--pdf-rate', type=float, default=0.0, help="share of Aadhaar, PAN and licence documents uploaded as multi-page PDFs")
+    parser.add_argument('--pdf-pages', type=int, default=8, help="pages in each generated PDF")
+    parser.add_argument('--filler-lines', type=int, default=10, help="extra LINE blocks per document")
+    parser.add_argument('--redelivery-rate', type=float, default=0.0, help="share of S3 notifications delivered twice")
+    parser.add_argument('--batch-size', type=int, default=10, help="SQS messages per invocation")
+    parser.add_argument('--concurrency', type=int, default=8, help="MAX_CONCURRENCY for the handler")
+    parser.add_argument('--repeat', type=int, default=1, help="times the corpus is replayed")
+    parser.add_argument('--keep-cache', action='store_true', help="keep the result cache between repeats")
+    parser.add_argument('--latency-scale', type=float, default=1.0, help="multiplier for all simulated latencies, 0 disables them")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="probability that a simulated call is throttled")
+    parser.add_argument('--in-progress-cycles', type=int, default=1, help="IN_PROGRESS responses before an async Textract job succeeds")
+    parser.add_argument('--rate-limits', default='off', help="API_RATE_LIMITS for the handler, e.g. 'textract.detect_document_text=10', '' for its defaults")
+    parser.add_argument('--async-textract', action='store_true', help="force the start-and-poll Textract path")
+    parser.add_argument('--baseline', help="compare against a report saved with --save-baseline")
+    parser.add_argument('--save-baseline', help="write the report to this file")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    return parser.parse_args(argv)
+
+def percentiles(values):
+    if not values:
+        return {"count": 0, "p50": None, "p95": None, "p99": None}
+    ordered = sorted(values)
+
+    def rank(percent):
+        # Nearest-rank percentile, in milliseconds
+        index = max(0, min(len(ordered) - 1, int(round(percent / 100.0 * len(ordered) + 0.5)) - 1))
+        return round(ordered[index] * 1000, 3)
+
+    return {"count": len(ordered), "p50": rank(50), "p95": rank(95), "p99": rank(99)}
+
+def sqs_event(documents, first_sequence=0, redelivered=()):
+    # One S3 notification per SQS message, as delivered by the ingest queue.
+    # Messages for the documents at the indexes in redelivered are sent twice.
+    records = []
+    for index, document in enumerate(documents):
+        sequence = first_sequence + index
+        s3_event = {'Records': [{
+            'eventSource': 'aws:s3',
+            'eventName': 'ObjectCreated:Put',
+            's3': {
+                'bucket': {'name': LANDING_BUCKET},
+                'object': {'key': document["key"], 'size': len(document["body"]), 'sequencer': f"{sequence:016X}"}
+            }
+        }]}
+        records.append({'eventSource': 'aws:sqs', 'messageId': f"msg-{sequence}", 'body': json.dumps(s3_event)})
+        if index in redelivered:
+            records.append({'eventSource': 'aws:sqs', 'messageId': f"msg-{sequence}-again", 'body': json.dumps(s3_event)})
+    return {'Records': records}
+
+def run(args):
+    # The handler reads its configuration from the environment at import time
+    os.environ['MAX_CONCURRENCY'] = str(args.concurrency)
+    os.environ['IMAGE_PREPROCESSING'] = 'false'
+    os.environ['TEXTRACT_POLL_INITIAL_DELAY'] = str(0.05 * args.latency_scale)
+    os.environ['TEXTRACT_POLL_MAX_DELAY'] = str(0.5 * args.latency_scale)
+    os.environ['API_RATE_LIMITS'] = args.rate_limits
+    os.environ['THROTTLE_BACKOFF_BASE'] = str(0.2 * args.latency_scale)
+    os.environ['THROTTLE_BACKOFF_MAX'] = str(5 * args.latency_scale)
+    for name in ('TEXTRACT_SNS_TOPIC_ARN', 'TEXTRACT_ROLE_ARN', 'RESULT_CACHE_TABLE', 'RESULT_CACHE_DIR', 'IDEMPOTENCY_TABLE', 'RESULT_QUEUE_URL'):
+        os.environ.pop(name, None)
+    # Result notifications are published to SNS, as deployed
+    os.environ['RESULT_TOPIC_ARN'] = 'arn:aws:sns:us-east-1:000000000000:benchmark-results'
+    sys.path.insert(0, LAMBDA_DIR)
+    sys.path.insert(0, BENCHMARK_DIR)
+
+    import cache
+    import clients
+    import metrics
+    import ocr
+    import ratelimit
+    import s3event
+    from corpus import document_body, generate_corpus, load_corpus, save_corpus
+    from fakes import SimulationConfig, World
+
+    if args.async_textract:
+        ocr.SYNC_MAX_BYTES = -1
+
+    corpus = load_corpus(args.corpus) if args.corpus else generate_corpus(
+        args.documents, seed=args.seed, filler_lines=args.filler_lines, duplicate_rate=args.duplicate_rate,
+        pdf_rate=args.pdf_rate, pdf_pages=args.pdf_pages)
+    if args.save_corpus:
+        save_corpus(corpus, args.save_corpus)
+    for document in corpus:
+        document["body"] = document_body(document)
+
+    world = World(SimulationConfig(latency_scale=args.latency_scale, error_rate=args.error_rate,
+                                   in_progress_cycles=args.in_progress_cycles, seed=args.seed),
+                  on_call=metrics.count_call)
+    for name, client in world.clients().items():
+        clients.set_client(name, client)
+
+    # Keep the handler's log lines and prints out of the report
+    logging.getLogger().addHandler(logging.NullHandler())
+    logging.getLogger().setLevel(logging.WARNING)
+
+    invocations = []
+    outcomes = {}
+    # The handler's own per-document stage timings, in seconds
+    stage_timings = {}
+    # Every upload gets a new sequencer, so repeats are new events and not duplicates
+    sequence = 0
+    rng = random.Random(args.seed)
+    tracemalloc.start()
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        if not args.keep_cache:
+            s3event.RESULT_CACHE = cache.ResultCache([cache.LRUCacheBackend()])
+        for start in range(0, len(corpus), args.batch_size):
+            batch = corpus[start:start + args.batch_size]
+            for document in batch:
+                world.upload(LANDING_BUCKET, document["key"], document["body"], document)
+            redelivered = {index for index in range(len(batch)) if rng.random() < args.redelivery_rate}
+            event = sqs_event(batch, sequence, redelivered)
+            sequence += len(batch)
+
+            invocation_start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                response = s3event.lambda_handler(event, None)
+            invocations.append(time.perf_counter() - invocation_start)
+
+            for name, milliseconds in response.get("timings_ms", {}).items():
+                stage_timings.setdefault(f"{name} (per invocation)", []).append(milliseconds / 1000)
+            for result in response.get("results", []):
+                outcomes[result["outcome"]] = outcomes.get(result["outcome"], 0) + 1
+                for name, milliseconds in result.get("timings_ms", {}).items():
+                    stage_timings.setdefault(name, []).append(milliseconds / 1000)
+    elapsed = time.perf_counter() - started
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    documents = len(corpus) * args.repeat
+    return {
+        "config": {
+            "documents": documents,
+            "batch_size": args.batch_size,
+            "concurrency": args.concurrency,
+            "latency_scale": args.latency_scale,
+            "error_rate": args.error_rate,
+            "in_progress_cycles": args.in_progress_cycles,
+            "async_textract": args.async_textract,
+            "rate_limits": args.rate_limits,
+            "pdf_rate": args.pdf_rate,
+            "redelivery_rate": args.redelivery_rate,
+            "seed": args.seed
+        },
+        "elapsed_s": round(elapsed, 3),
+        "documents_per_second": round(documents / elapsed, 3) if elapsed else None,
+        "end_to_end": percentiles(invocations),
+        "stages": {name: percentiles(values) for name, values in sorted(stage_timings.items())},
+        "api_calls": {name: percentiles(values) for name, values in sorted(world.recorder.durations.items())},
+        "outcomes": outcomes,
+        "notifications": len(world.messages),
+        "rate_limiter": ratelimit.LIMITER.stats(),
+        "peak_memory_mb": round(peak_memory / (1024 * 1024), 3)
+    }
+
+def _change(current, baseline):
+    if current is None or not baseline:
+        return ''
+    return f"{(current - baseline) / baseline * 100:+.1f}%"
+
+def print_report(report, baseline=None):
+    print(f"documents: {report['config']['documents']}  elapsed: {report['elapsed_s']} s  "
+          f"documents/s: {report['documents_per_second']} {_change(report['documents_per_second'], baseline and baseline['documents_per_second'])}")
+    print(f"peak memory: {report['peak_memory_mb']} MB {_change(report['peak_memory_mb'], baseline and baseline['peak_memory_mb'])}")
+    print(f"outcomes: {report['outcomes']}  notifications: {report.get('notifications')}")
+    waited = {api: stats for api, stats in report.get('rate_limiter', {}).items() if stats['throttled'] or stats['wait_ms']}
+    if waited:
+        print(f"rate limiter: {waited}")
+    print()
+    rows = [('end_to_end (per invocation)', report['end_to_end'], baseline and baseline['end_to_end'])]
+    for name, stats in report['stages'].items():
+        rows.append((name, stats, baseline and baseline.get('stages', {}).get(name)))
+    _print_table('stage', rows)
+    print()
+    _print_table('API call', [(name, stats, baseline and baseline.get('api_calls', {}).get(name))
+                              for name, stats in report['api_calls'].items()])
+
+def _print_table(title, rows):
+    print(f"{title:45} {'count':>7} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}")
+    for name, stats, base in rows:
+        line = f"{name:45} {stats['count']:>7} {stats['p50']:>10} {stats['p95']:>10} {stats['p99']:>10}"
+        if base:
+            line += f"   p95 {_change(stats['p95'], base['p95'])}"
+        print(line)
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    if args.json:
+        print(json.dumps(report, indent=1))
+    else:
+        print_report(report, baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+"""Reclassify objects that are already stored in a bucket.
+
+Lists the bucket one page at a time and runs every object through the
+same per-document pipeline as s3event.lambda_handler, a batch at a time
+on a bounded worker pool, then moves it to the folder for its new
+classification. A checkpoint is written after every batch, so an
+interrupted run resumes after the last finished batch.
+
+    python lambda/backfill.py --bucket docs-landing-bucket --checkpoint landing.json
+    python lambda/backfill.py --bucket invalid-docs-bucket --prefix invalid-docs-folder/ --dry-run
+    python lambda/backfill.py --bucket invalid-docs-bucket --keys-from failed.jsonl
+    python lambda/backfill.py --bucket invalid-docs-bucket --rules new-rules.json --dry-run
+
+Run it with the same environment variables as the Lambda function
+(VALID_DOCS_BUCKET, INVALID_DOCS_BUCKET, RESULT_CACHE_TABLE, RULES_CONFIG, ...).
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import ocr
+import s3event
+from cache import LRUCacheBackend, ResultCache, create_result_cache
+from clients import get_client
+from routing import DESTINATIONS, destination_for, original_key
+from rules import load_rules
+from sidecar import is_sidecar_key
+
+LOG = logging.getLogger()
+
+# Outcomes that leave the object where it is and need another run
+FAILED_OUTCOMES = ('error', 'deferred')
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Reclassify and move objects already stored in a bucket")
+    parser.add_argument('--bucket', required=True, help="bucket to reprocess")
+    parser.add_argument('--prefix', default='', help="only reprocess keys starting with this prefix")
+    parser.add_argument('--keys-from', help="reprocess the keys in this file, e.g. a --failed-keys file, instead of listing the bucket")
+    parser.add_argument('--workers', type=int, default=s3event.MAX_CONCURRENCY, help="documents processed in parallel")
+    parser.add_argument('--batch-size', type=int, default=100, help="documents classified and moved between checkpoints")
+    parser.add_argument('--checkpoint', help="resume from and save progress to this file")
+    parser.add_argument('--failed-keys', help="append the keys that could not be processed or moved to this file")
+    parser.add_argument('--limit', type=int, help="stop after this many objects")
+    parser.add_argument('--dry-run', action='store_true', help="classify, print the moves as JSON lines and leave every object in place")
+    parser.add_argument('--rules', help="classify with the rules in this JSON file instead of RULES_CONFIG, "
+                        "except documents finished by the Textract completion function")
+    parser.add_argument('--use-cache', action='store_true', help="reuse cached classifications made with the same rules")
+    parser.add_argument('--verbose', action='store_true', help="log every document")
+    return parser.parse_args(argv)
+
+def list_keys(s3, bucket_name, prefix='', start_after=None):
+    # Yields (key, size) pairs, holding one listing page at a time
+    kwargs = {'Bucket': bucket_name, 'Prefix': prefix}
+    if start_after:
+        kwargs['StartAfter'] = start_after
+    for page in s3.get_paginator('list_objects_v2').paginate(**kwargs):
+        for item in page.get('Contents', []):
+            # Skip the placeholders the console creates for folders, and the
+            # sidecars stored next to routed documents
+            if not item['Key'].endswith('/') and not is_sidecar_key(item['Key']):
+                yield item['Key'], item['Size']
+
+def read_keys(path, start_after=None):
+    # Keys from a file of JSON lines with a "key" field, or one key per line.
+    # Lines are processed in file order, so resuming skips by line number.
+    skip = int(start_after or 0)
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if line_number <= skip or not line:
+                continue
+            key = json.loads(line)["key"] if line.startswith('{') else line
+            yield key, None, line_number
+
+def batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def s3_record(bucket_name, object_key, size):
+    # Same shape as a record of an S3 event notification
+    return {
+        's3': {
+            'bucket': {'name': bucket_name},
+            'object': {'key': object_key, 'size': size}
+        }
+    }
+
+def new_checkpoint(args):
+    return {
+        "bucket": args.bucket,
+        "prefix": args.prefix,
+        "keys_from": args.keys_from,
+        "start_after": None,
+        "processed": 0,
+        "failed": 0,
+        "outcomes": {},
+        "complete": False
+    }
+
+def load_checkpoint(args):
+    if not args.checkpoint or not os.path.exists(args.checkpoint):
+        return new_checkpoint(args)
+    with open(args.checkpoint) as f:
+        checkpoint = json.load(f)
+    for name in ('bucket', 'prefix', 'keys_from'):
+        if checkpoint.get(name) != getattr(args, name):
+            raise SystemExit(f"{args.checkpoint} is for {name} {checkpoint.get(name)!r}, not {getattr(args, name)!r}")
+    return checkpoint
+
+def save_checkpoint(path, checkpoint):
+    # Write and rename, so an interrupted run never leaves a partial file
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, 'w') as f:
+        json.dump(checkpoint, f, indent=1)
+    os.replace(temporary_path, path)
+
+def planned_move(result):
+    # (destination bucket, destination key), or None if the object stays in place
+    if result.get("outcome") not in DESTINATIONS:
+        return None
+    destination = destination_for(result["outcome"], original_key(result["bucket"], result["key"]))
+    if destination == (result["bucket"], result["key"]):
+        return None
+    return destination
+
+def failed(result):
+    return result.get("outcome") in FAILED_OUTCOMES or bool(result.get("routing_error"))
+
+def process_batch(batch, bucket_name, s3, executor, dry_run):
+    records = [s3_record(bucket_name, object_key, size) for object_key, size, _ in batch]
+    results = list(executor.map(lambda record: s3event.measured(s3event.process_record_safely, record, s3), records))
+    if not dry_run:
+        s3event.route_results(results, s3)
+        s3event.notify_results(results)
+    return results
+
+def report_moves(results):
+    for result in results:
+        destination = planned_move(result)
+        if destination:
+            print(json.dumps({
+                "source": f"s3://{result['bucket']}/{result['key']}",
+                "destination": f"s3://{destination[0]}/{destination[1]}",
+                "outcome": result["outcome"]
+            }), flush=True)
+
+def record_failures(path, results):
+    with open(path, 'a') as f:
+        for result in results:
+            if failed(result):
+                f.write(json.dumps({
+                    "key": result["key"],
+                    "outcome": result["outcome"],
+                    "error_message": result.get("routing_error") or result.get("error_message")
+                }) + '\n')
+
+def run(args):
+    s3 = get_client('s3')
+    checkpoint = load_checkpoint(args)
+    if checkpoint["complete"]:
+        print(f"{args.checkpoint} is already complete", file=sys.stderr)
+        return checkpoint
+
+    if args.rules:
+        s3event.RULES = load_rules(args.rules)
+    if args.dry_run:
+        # Nothing outside this process may change: no async jobs that the
+        # completion Lambda would route, and no shared cache writes
+        ocr.TEXTRACT_SNS_TOPIC_ARN = None
+        s3event.RESULT_CACHE = ResultCache([LRUCacheBackend()], read=args.use_cache, rules=s3event.RULES.fingerprint)
+    else:
+        s3event.RESULT_CACHE = create_result_cache(read=args.use_cache, rules=s3event.RULES.fingerprint)
+
+    # (key, size, resume position) triples: keys are listed in order, and a
+    # keys file is resumed by line number
+    if args.keys_from:
+        items = read_keys(args.keys_from, checkpoint["start_after"])
+    else:
+        items = ((object_key, size, object_key) for object_key, size in list_keys(s3, args.bucket, args.prefix, checkpoint["start_after"]))
+
+    started = time.perf_counter()
+    processed = 0
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        for batch in batches(items, args.batch_size):
+            if args.limit is not None:
+                batch = batch[:args.limit - processed]
+                if not batch:
+                    break
+            batch_started = time.perf_counter()
+            results = process_batch(batch, args.bucket, s3, executor, args.dry_run)
+
+            if args.dry_run:
+                report_moves(results)
+            if args.failed_keys:
+                record_failures(args.failed_keys, results)
+
+            processed += len(results)
+            for result in results:
+                checkpoint["outcomes"][result["outcome"]] = checkpoint["outcomes"].get(result["outcome"], 0) + 1
+            checkpoint["processed"] += len(results)
+            checkpoint["failed"] += sum(1 for result in results if failed(result))
+            checkpoint["start_after"] = batch[-1][2]
+            if args.checkpoint and not args.dry_run:
+                save_checkpoint(args.checkpoint, checkpoint)
+
+            elapsed = time.perf_counter() - started
+            batch_elapsed = time.perf_counter() - batch_started
+            print(f"{checkpoint['processed']} objects ({processed} this run) "
+                  f"{processed / elapsed:.1f}/s overall, {len(results) / batch_elapsed:.1f}/s last batch, "
+                  f"failed {checkpoint['failed']}, outcomes {checkpoint['outcomes']}, last key {batch[-1][0]}",
+                  file=sys.stderr, flush=True)
+            if args.limit is not None and processed >= args.limit:
+                break
+        else:
+            checkpoint["complete"] = True
+            if args.checkpoint and not args.dry_run:
+                save_checkpoint(args.checkpoint, checkpoint)
+
+    LOG.info(f"Result cache stats: {s3event.RESULT_CACHE.stats()}")
+    LOG.info(f"Rate limiter stats: {s3event.LIMITER.stats()}")
+    return checkpoint
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(stream=sys.stderr, format='%(asctime)s %(levelname)s %(message)s')
+    LOG.setLevel(logging.INFO if args.verbose else logging.WARNING)
+    run(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from clients import get_client
+
+LOG = logging.getLogger()
+
+# Cached classifications expire after this many seconds
+CACHE_TTL_SECONDS = int(os.environ.get('RESULT_CACHE_TTL_SECONDS', str(7 * 24 * 3600)))
+# Maximum number of entries kept in memory by each warm container
+CACHE_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', '1024'))
+# Persistent backends, DynamoDB when deployed or a local directory for development
+CACHE_TABLE_NAME = os.environ.get('RESULT_CACHE_TABLE')
+CACHE_DIRECTORY = os.environ.get('RESULT_CACHE_DIR')
+
+# Only final classifications are cached
+CACHEABLE_OUTCOMES = ('valid', 'valid-passport', 'invalid')
+
+def content_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+class LRUCacheBackend:
+    # In-process cache, survives between warm invocations of the same container
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, digest):
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            if entry["expires_at"] <= time.time():
+                del self._entries[digest]
+                self.evictions += 1
+                return None
+            self._entries.move_to_end(digest)
+            return entry["value"]
+
+    def put(self, digest, value):
+        with self._lock:
+            self._entries[digest] = {
+                "value": value,
+                "expires_at": time.time() + self.ttl_seconds
+            }
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+class DynamoDBCacheBackend:
+    # Persistent cache shared by all containers. Expired items are removed by
+    # the table's TTL on expires_at and ignored here until then.
+
+    def __init__(self, table_name, ttl_seconds=CACHE_TTL_SECONDS):
+        self.table_name = table_name
+        self.ttl_seconds = ttl_seconds
+
+    def get(self, digest):
+        response = get_client('dynamodb').get_item(
+            TableName=self.table_name,
+            Key={'digest': {'S': digest}}
+        )
+        item = response.get('Item')
+        if not item or int(item['expires_at']['N']) <= time.time():
+            return None
+        return json.loads(item['value']['S'])
+
+    def put(self, digest, value):
+        get_client('dynamodb').put_item(
+            TableName=self.table_name,
+            Item={
+                'digest': {'S': digest},
+                'value': {'S': json.dumps(value)},
+                'expires_at': {'N': str(int(time.time() + self.ttl_seconds))}
+            }
+        )
+
+class DirectoryCacheBackend:
+    # Local stand-in for the persistent cache, one JSON file per digest
+
+    def __init__(self, directory, max_entries=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, digest):
+        return os.path.join(self.directory, f"{digest}.json")
+
+    def get(self, digest):
+        try:
+            with open(self._path(digest)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry["expires_at"] <= time.time():
+            self._remove(self._path(digest))
+            return None
+        return entry["value"]
+
+    def put(self, digest, value):
+        with self._lock:
+            with open(self._path(digest), 'w') as f:
+                json.dump({"value": value, "expires_at": time.time() + self.ttl_seconds}, f)
+            self._evict()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            self.evictions += 1
+        except OSError:
+            pass
+
+    def _evict(self):
+        # Drop the least recently written entries once over max_entries
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.json')]
+        if len(paths) <= self.max_entries:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - self.max_entries]:
+            self._remove(path)
+
+class ResultCache:
+    # Classification results keyed by the SHA-256 of the object bytes.
+    # Backends are checked in order and earlier ones are filled from later hits.
+    # Entries record the fingerprint of the rules that classified them, and
+    # entries from other rules are misses. With read=False every lookup misses
+    # but results are still written, e.g. to refresh cached results.
+
+    def __init__(self, backends, read=True, rules=None):
+        self.backends = backends
+        self.read = read
+        self.rules = rules
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def get(self, digest):
+        for index, backend in enumerate(self.backends if self.read else []):
+            try:
+                value = backend.get(digest)
+            except Exception as e:
+                LOG.error(f"Error reading result cache: {str(e)}")
+                self._count('errors')
+                continue
+            if value is not None and value.get("rules") == self.rules:
+                for earlier in self.backends[:index]:
+                    earlier.put(digest, value)
+                self._count('hits')
+                return value
+        self._count('misses')
+        return None
+
+    def put(self, digest, outcome, entity_types=None, sidecar=None):
+        # sidecar is the [bucket, key] of the OCR sidecar written for the
+        # document, copied for later uploads of the same bytes
+        if outcome not in CACHEABLE_OUTCOMES:
+            return
+        value = {
+            "outcome": outcome,
+            "entity_types": list(entity_types or []),
+            "rules": self.rules
+        }
+        if sidecar:
+            value["sidecar"] = list(sidecar)
+        for backend in self.backends:
+            try:
+                backend.put(digest, value)
+            except Exception as e:
+                LOG.error(f"Error writing result cache: {str(e)}")
+                self._count('errors')
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors
+        }
+
+def create_result_cache(read=True, rules=None):
+    backends = [LRUCacheBackend()]
+    if CACHE_TABLE_NAME:
+        backends.append(DynamoDBCacheBackend(CACHE_TABLE_NAME))
+    elif CACHE_DIRECTORY:
+        backends.append(DirectoryCacheBackend(CACHE_DIRECTORY))
+    return ResultCache(backends, read=read, rules=rules)
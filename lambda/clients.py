@@ -0,0 +1,95 @@
+import boto3
+import logging
+import os
+import threading
+import time
+from botocore.config import Config
+
+from metrics import count_botocore_call
+from ratelimit import RATE_LIMITED_SERVICES, RateLimitedClient
+
+LOG = logging.getLogger()
+
+# Record when the container started loading this module
+_MODULE_LOADED_AT = time.perf_counter()
+
+# Connection pool sized to the number of records processed in parallel,
+# plus a little headroom for the parallel Comprehend calls
+MAX_POOL_CONNECTIONS = int(os.environ.get('MAX_POOL_CONNECTIONS', str(int(os.environ.get('MAX_CONCURRENCY', '8')) * 2)))
+MAX_ATTEMPTS = int(os.environ.get('AWS_MAX_ATTEMPTS', '5'))
+
+CLIENT_CONFIG = Config(
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+    tcp_keepalive=True,
+    retries={
+        'max_attempts': MAX_ATTEMPTS,
+        'mode': 'adaptive'
+    }
+)
+
+# Retries of the rate limited services are handled by ratelimit, which backs
+# off with jitter on throttling and transient server or connection errors,
+# and gives up on throttling with ThrottledError. botocore's standard mode
+# would retry throttling errors as well, so it makes a single attempt and
+# every error reaches the limiter.
+LIMITED_CLIENT_CONFIG = CLIENT_CONFIG.merge(Config(
+    retries={
+        'max_attempts': int(os.environ.get('LIMITED_AWS_MAX_ATTEMPTS', '1')),
+        'mode': 'standard'
+    }
+))
+
+def _wrap(service_name, client):
+    if service_name in RATE_LIMITED_SERVICES:
+        return RateLimitedClient(client, service_name)
+    return client
+
+_clients = {}
+_init_times = {}
+_lock = threading.Lock()
+_session = None
+
+def get_client(service_name):
+    # Fast path for warm invocations, no locking needed once the client exists
+    client = _clients.get(service_name)
+    if client is not None:
+        return client
+
+    # boto3 sessions are not thread safe, so creation is serialised
+    global _session
+    with _lock:
+        client = _clients.get(service_name)
+        if client is None:
+            start = time.perf_counter()
+            if _session is None:
+                _session = boto3.session.Session()
+            config = LIMITED_CLIENT_CONFIG if service_name in RATE_LIMITED_SERVICES else CLIENT_CONFIG
+            client = _session.client(service_name, config=config)
+            client.meta.events.register('before-call', count_botocore_call)
+            client = _wrap(service_name, client)
+            _init_times[service_name] = time.perf_counter() - start
+            _clients[service_name] = client
+            LOG.info(f"Created {service_name} client in {_init_times[service_name] * 1000:.1f} ms")
+    return client
+
+def set_client(service_name, client):
+    # Register a client for a service, e.g. a stubbed client for local testing.
+    # It is rate limited like a real client of the same service.
+    with _lock:
+        _clients[service_name] = _wrap(service_name, client)
+        _init_times.setdefault(service_name, 0.0)
+
+def reset_clients():
+    global _session
+    with _lock:
+        _clients.clear()
+        _init_times.clear()
+        _session = None
+
+def get_init_stats():
+    # Time spent creating each client, and since this module was loaded
+    return {
+        "client_init_ms": {name: round(seconds * 1000, 3) for name, seconds in _init_times.items()},
+        "total_client_init_ms": round(sum(_init_times.values()) * 1000, 3),
+        "since_module_load_ms": round((time.perf_counter() - _MODULE_LOADED_AT) * 1000, 3)
+    }
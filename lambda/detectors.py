@@ -0,0 +1,83 @@
+import re
+
+# Verhoeff checksum tables used by Aadhaar numbers
+VERHOEFF_D = (
+    (0, 1, 2, 3, 4, 5, 6, 7, 8, 9),
+    (1, 2, 3, 4, 0, 6, 7, 8, 9, 5),
+    (2, 3, 4, 0, 1, 7, 8, 9, 5, 6),
+    (3, 4, 0, 1, 2, 8, 9, 5, 6, 7),
+    (4, 0, 1, 2, 3, 9, 5, 6, 7, 8),
+    (5, 9, 8, 7, 6, 0, 4, 3, 2, 1),
+    (6, 5, 9, 8, 7, 1, 0, 4, 3, 2),
+    (7, 6, 5, 9, 8, 2, 1, 0, 4, 3),
+    (8, 7, 6, 5, 9, 3, 2, 1, 0, 4),
+    (9, 8, 7, 6, 5, 4, 3, 2, 1, 0)
+)
+VERHOEFF_P = (
+    (0, 1, 2, 3, 4, 5, 6, 7, 8, 9),
+    (1, 5, 7, 6, 2, 8, 3, 0, 9, 4),
+    (5, 8, 0, 3, 7, 9, 6, 1, 4, 2),
+    (8, 9, 1, 6, 0, 4, 3, 5, 2, 7),
+    (9, 4, 5, 3, 1, 2, 6, 8, 7, 0),
+    (4, 2, 8, 6, 5, 7, 3, 9, 0, 1),
+    (2, 7, 9, 3, 8, 0, 6, 4, 1, 5),
+    (7, 0, 4, 6, 9, 1, 3, 2, 5, 8)
+)
+
+# Aadhaar: 12 digits, never starting with 0 or 1, usually printed as 4-4-4.
+# Digit groups before or after the match, e.g. a 16 digit card number, rule it out.
+AADHAAR_PATTERN = re.compile(r'(?<!\d[ -])\b[2-9]\d{3}([ -]?)\d{4}\1\d{4}\b(?![ -]?\d)')
+# PAN: five letters, four digits, one letter (AAAAA9999A)
+PAN_PATTERN = re.compile(r'\b[A-Z]{5}\d{4}[A-Z]\b')
+# Driving licence: state code, RTO code, year of issue and a 7 digit number,
+# e.g. MH14 20110062821 or MH-14-2011-0062821
+DL_PATTERN = re.compile(r'\b[A-Z]{2}[ -]?\d{2}[ -]?(?:19|20)\d{2}[ -]?\d{7}\b')
+# Indian passport: one letter followed by seven digits
+PASSPORT_PATTERN = re.compile(r'\b[A-PR-WY][1-9]\d{6}\b')
+
+def verhoeff_valid(number):
+    checksum = 0
+    for index, digit in enumerate(reversed(number)):
+        checksum = VERHOEFF_D[checksum][VERHOEFF_P[index % 8][int(digit)]]
+    return checksum == 0
+
+def _entity(entity_type, match):
+    return {
+        "Type": entity_type,
+        "Score": 1.0,
+        "BeginOffset": match.start(),
+        "EndOffset": match.end(),
+        "Source": "local"
+    }
+
+def detect_local_entities(text, hints):
+    # Returns the entities that local evidence alone is enough to confirm,
+    # given the document hints from the keywords in the text (see rules.py).
+    # Candidates that only match a pattern without supporting keywords are
+    # left for Comprehend.
+    entities = []
+
+    # One in ten random numbers passes the checksum, so it only confirms an
+    # Aadhaar number on a document with Aadhaar keywords
+    if 'AADHAAR' in hints:
+        for match in AADHAAR_PATTERN.finditer(text):
+            if verhoeff_valid(re.sub(r'\D', '', match.group(0))):
+                entities.append(_entity('IN_AADHAAR', match))
+                break
+
+    if 'PAN' in hints:
+        match = PAN_PATTERN.search(text)
+        if match:
+            entities.append(_entity('IN_PERMANENT_ACCOUNT_NUMBER', match))
+
+    if 'DRIVING_LICENCE' in hints:
+        match = DL_PATTERN.search(text)
+        if match:
+            entities.append(_entity('DRIVER_ID', match))
+
+    if 'PASSPORT' in hints:
+        match = PASSPORT_PATTERN.search(text)
+        if match:
+            entities.append(_entity('PASSPORT_NUMBER', match))
+
+    return entities
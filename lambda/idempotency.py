@@ -0,0 +1,169 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+
+from clients import get_client
+
+LOG = logging.getLogger()
+
+# An event being processed is leased for longer than the Lambda timeout, so
+# a lease only expires when the invocation holding it died
+LEASE_SECONDS = int(os.environ.get('IDEMPOTENCY_LEASE_SECONDS', '900'))
+# Completed events are remembered this long, duplicates arrive within minutes
+RECORD_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', str(24 * 3600)))
+# DynamoDB table shared by all containers, otherwise each container remembers its own events
+IDEMPOTENCY_TABLE_NAME = os.environ.get('IDEMPOTENCY_TABLE')
+
+IN_PROGRESS = 'in_progress'
+COMPLETED = 'completed'
+
+def s3_event_key(record):
+    # Identity of one S3 notification: the same object version and sequencer
+    # means a repeated delivery of the same event. None without either, e.g.
+    # for records built by backfill.py, which are always processed.
+    s3_info = record.get('s3', {})
+    object_info = s3_info.get('object', {})
+    version_id = object_info.get('versionId')
+    sequencer = object_info.get('sequencer')
+    if not version_id and not sequencer:
+        return None
+    parts = [s3_info.get('bucket', {}).get('name') or '', object_info.get('key') or '', version_id or '', sequencer or '']
+    return 's3:' + hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+def textract_job_key(job_id):
+    return f"textract-job:{job_id}"
+
+class MemoryIdempotencyStore:
+    # Local stand-in for the DynamoDB store, shared by the threads of one process
+
+    def __init__(self, lease_seconds=LEASE_SECONDS, ttl_seconds=RECORD_TTL_SECONDS):
+        self.lease_seconds = lease_seconds
+        self.ttl_seconds = ttl_seconds
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def claim(self, key):
+        # Returns (token, None) when the caller should process the event, or
+        # (None, item) with the record of the delivery that has or is doing it
+        now = time.time()
+        with self._lock:
+            item = self._items.get(key)
+            if item and item["expires_at"] > now and (item["status"] == COMPLETED or item["lease_expires_at"] > now):
+                return None, dict(item)
+            token = uuid.uuid4().hex
+            self._items[key] = {
+                "status": IN_PROGRESS,
+                "token": token,
+                "lease_expires_at": now + self.lease_seconds,
+                "expires_at": now + self.lease_seconds
+            }
+            return token, None
+
+    def complete(self, key, token, result):
+        with self._lock:
+            item = self._items.get(key)
+            if not item or item["token"] != token:
+                LOG.warning(f"Lease on {key} was lost before the event completed")
+                return
+            self._items[key] = {
+                "status": COMPLETED,
+                "token": token,
+                "result": result,
+                "expires_at": time.time() + self.ttl_seconds
+            }
+
+    def release(self, key, token):
+        # Let a later delivery process the event again
+        with self._lock:
+            item = self._items.get(key)
+            if item and item["token"] == token:
+                del self._items[key]
+
+    def __len__(self):
+        return len(self._items)
+
+class DynamoDBIdempotencyStore:
+    # Leases and completed records shared by all containers. Conditional
+    # writes make claim atomic, and the table's TTL on expires_at removes
+    # old records.
+
+    def __init__(self, table_name, lease_seconds=LEASE_SECONDS, ttl_seconds=RECORD_TTL_SECONDS):
+        self.table_name = table_name
+        self.lease_seconds = lease_seconds
+        self.ttl_seconds = ttl_seconds
+
+    def claim(self, key):
+        now = int(time.time())
+        token = uuid.uuid4().hex
+        try:
+            get_client('dynamodb').put_item(
+                TableName=self.table_name,
+                Item={
+                    'id': {'S': key},
+                    'status': {'S': IN_PROGRESS},
+                    'token': {'S': token},
+                    'lease_expires_at': {'N': str(now + self.lease_seconds)},
+                    'expires_at': {'N': str(now + self.lease_seconds)}
+                },
+                ConditionExpression='attribute_not_exists(id) OR expires_at < :now OR (#status = :in_progress AND lease_expires_at < :now)',
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={':now': {'N': str(now)}, ':in_progress': {'S': IN_PROGRESS}}
+            )
+            return token, None
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+        response = get_client('dynamodb').get_item(TableName=self.table_name, Key={'id': {'S': key}}, ConsistentRead=True)
+        item = response.get('Item')
+        if not item:
+            # Released between the two calls, the next delivery will process it
+            return None, {"status": IN_PROGRESS}
+        return None, {
+            "status": item['status']['S'],
+            "result": json.loads(item['result']['S']) if 'result' in item else None
+        }
+
+    def complete(self, key, token, result):
+        try:
+            get_client('dynamodb').put_item(
+                TableName=self.table_name,
+                Item={
+                    'id': {'S': key},
+                    'status': {'S': COMPLETED},
+                    'token': {'S': token},
+                    'result': {'S': json.dumps(result)},
+                    'expires_at': {'N': str(int(time.time() + self.ttl_seconds))}
+                },
+                ConditionExpression='#token = :token',
+                ExpressionAttributeNames={'#token': 'token'},
+                ExpressionAttributeValues={':token': {'S': token}}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            LOG.warning(f"Lease on {key} was lost before the event completed")
+
+    def release(self, key, token):
+        try:
+            get_client('dynamodb').delete_item(
+                TableName=self.table_name,
+                Key={'id': {'S': key}},
+                ConditionExpression='#token = :token',
+                ExpressionAttributeNames={'#token': 'token'},
+                ExpressionAttributeValues={':token': {'S': token}}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+def create_idempotency_store():
+    if IDEMPOTENCY_TABLE_NAME:
+        return DynamoDBIdempotencyStore(IDEMPOTENCY_TABLE_NAME)
+    return MemoryIdempotencyStore()
@@ -0,0 +1,95 @@
+import io
+import logging
+import os
+import time
+
+# Pillow is optional, without it images are only checked and passed through as-is
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
+
+LOG = logging.getLogger()
+
+# Rekognition accepts at most 5 MB of inline image bytes
+MAX_IMAGE_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', str(5 * 1024 * 1024)))
+# Long edge images are scaled down to, and the smallest long edge kept for OCR
+MAX_LONG_EDGE = int(os.environ.get('IMAGE_MAX_LONG_EDGE', '2400'))
+MIN_LONG_EDGE = int(os.environ.get('IMAGE_MIN_LONG_EDGE', '1200'))
+JPEG_QUALITIES = (90, 80, 70, 60)
+
+# EXIF orientation tag
+ORIENTATION_TAG = 0x0112
+
+MAGIC_NUMBERS = (
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'%PDF-', 'pdf'),
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff')
+)
+
+class InvalidImageError(Exception):
+    pass
+
+def sniff_format(data):
+    for magic, name in MAGIC_NUMBERS:
+        if data.startswith(magic):
+            return name
+    return None
+
+def _encode(image, quality):
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=quality, optimize=True)
+    return output.getvalue()
+
+def _fit(image, max_bytes):
+    # Lower the JPEG quality first, then the resolution down to MIN_LONG_EDGE
+    while True:
+        for quality in JPEG_QUALITIES:
+            data = _encode(image, quality)
+            if len(data) <= max_bytes:
+                return data
+        long_edge = max(image.size)
+        if long_edge <= MIN_LONG_EDGE:
+            return data
+        scale = max(0.75, MIN_LONG_EDGE / long_edge)
+        image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.LANCZOS)
+
+def preprocess_image(data, max_bytes=MAX_IMAGE_BYTES, max_long_edge=MAX_LONG_EDGE):
+    # Validate, orient, downscale and recompress an uploaded image in memory.
+    # Images that are already upright, small enough and under max_bytes are
+    # returned untouched so OCR sees the original pixels.
+    start = time.perf_counter()
+    image_format = sniff_format(data)
+    if image_format not in ('jpeg', 'png'):
+        raise InvalidImageError(f"Content is not a JPEG or PNG image (detected {image_format or 'unknown'})")
+
+    result = {
+        "bytes": data,
+        "format": image_format,
+        "original_bytes": len(data),
+        "processed": False
+    }
+
+    if Image is not None:
+        try:
+            image = Image.open(io.BytesIO(data))
+            orientation = image.getexif().get(ORIENTATION_TAG, 1)
+            needs_resize = max(image.size) > max_long_edge
+            if orientation != 1 or needs_resize or len(data) > max_bytes:
+                image = ImageOps.exif_transpose(image)
+                if needs_resize:
+                    image.thumbnail((max_long_edge, max_long_edge), Image.LANCZOS)
+                if image.mode not in ('RGB', 'L'):
+                    image = image.convert('RGB')
+                result["bytes"] = _fit(image, max_bytes)
+                result["format"] = 'jpeg'
+                result["processed"] = True
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            raise InvalidImageError(f"Image could not be decoded: {str(e)}")
+
+    result["bytes_saved"] = result["original_bytes"] - len(result["bytes"])
+    result["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    return result
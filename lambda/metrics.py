@@ -0,0 +1,145 @@
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# CloudWatch namespace for the embedded metric format records
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'DocumentProcessing')
+# Share of documents that get a per-document metric record, invocation totals are always emitted
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '1.0'))
+# Extracted text is PII, it is only logged when explicitly enabled
+LOG_DOCUMENT_TEXT = os.environ.get('LOG_DOCUMENT_TEXT', 'false').lower() == 'true'
+
+_local = threading.local()
+
+class DocumentMetrics:
+    # Stage durations, API call counts and byte counts for one document
+
+    def __init__(self):
+        self.timings = {}
+        self.api_calls = {}
+        self.bytes = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            with self._lock:
+                self.timings[name] = round(self.timings.get(name, 0.0) + elapsed, 3)
+
+    def add_timing(self, name, milliseconds):
+        with self._lock:
+            self.timings[name] = round(self.timings.get(name, 0.0) + milliseconds, 3)
+
+    def count_call(self, name):
+        with self._lock:
+            self.api_calls[name] = self.api_calls.get(name, 0) + 1
+
+    def add_bytes(self, name, count):
+        with self._lock:
+            self.bytes[name] = self.bytes.get(name, 0) + count
+
+def current():
+    return getattr(_local, 'metrics', None)
+
+@contextmanager
+def bind(metrics):
+    # Make metrics the target of stage() and count_call() in this thread
+    previous = current()
+    _local.metrics = metrics
+    try:
+        yield metrics
+    finally:
+        _local.metrics = previous
+
+@contextmanager
+def stage(name):
+    metrics = current()
+    if metrics is None:
+        yield
+    else:
+        with metrics.stage(name):
+            yield
+
+def add_timing(name, milliseconds):
+    metrics = current()
+    if metrics is not None:
+        metrics.add_timing(name, milliseconds)
+
+def count_call(name):
+    metrics = current()
+    if metrics is not None:
+        metrics.count_call(name)
+
+def add_bytes(name, count):
+    metrics = current()
+    if metrics is not None:
+        metrics.add_bytes(name, count)
+
+def count_botocore_call(model, **kwargs):
+    # botocore before-call hook, counts API calls. Each attempt the rate
+    # limiter makes is a call of its own, botocore's internal retries are not counted.
+    count_call(f"{model.service_model.service_name}.{model.name}")
+
+def should_sample():
+    return METRICS_SAMPLE_RATE >= 1.0 or random.random() < METRICS_SAMPLE_RATE
+
+def _metric_name(name):
+    return ''.join(part.capitalize() for part in name.split('_'))
+
+def emf_record(values, units, dimensions=None, properties=None):
+    # CloudWatch embedded metric format, one log line becomes metrics
+    record = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [list(dimensions)] if dimensions else [[]],
+                "Metrics": [{"Name": name, "Unit": units[name]} for name in values]
+            }]
+        }
+    }
+    record.update(dimensions or {})
+    record.update(properties or {})
+    record.update(values)
+    return record
+
+def document_record(result):
+    values = {}
+    units = {}
+    for name, milliseconds in result.get("timings_ms", {}).items():
+        metric = f"{_metric_name(name)}Time"
+        values[metric] = milliseconds
+        units[metric] = "Milliseconds"
+    values["ApiCalls"] = sum(result.get("api_calls", {}).values())
+    units["ApiCalls"] = "Count"
+    for name, count in result.get("bytes", {}).items():
+        metric = f"{_metric_name(name)}Bytes"
+        values[metric] = count
+        units[metric] = "Bytes"
+    return emf_record(values, units,
+                      dimensions={"Outcome": result.get("outcome", "unknown")},
+                      properties={"ApiCallCounts": result.get("api_calls", {}), "Cached": bool(result.get("cached")),
+                                  "DecisionTrace": result.get("decision_trace", [])})
+
+def invocation_record(results, timings_ms, bytes_moved):
+    outcomes = {}
+    for result in results:
+        outcomes[result.get("outcome", "unknown")] = outcomes.get(result.get("outcome", "unknown"), 0) + 1
+    values = {"Documents": len(results), "BytesMoved": bytes_moved}
+    units = {"Documents": "Count", "BytesMoved": "Bytes"}
+    for name, milliseconds in timings_ms.items():
+        metric = f"{_metric_name(name)}Time"
+        values[metric] = milliseconds
+        units[metric] = "Milliseconds"
+    return emf_record(values, units, properties={"Outcomes": outcomes})
+
+def emit(record):
+    # Lambda forwards stdout to CloudWatch Logs, which extracts the metrics
+    print(json.dumps(record))
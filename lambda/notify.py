@@ -0,0 +1,151 @@
+import json
+import logging
+import os
+import time
+
+from clients import get_client
+from ratelimit import backoff_delay
+
+LOG = logging.getLogger()
+
+# Result messages go to the SNS topic, the SQS queue, or both
+RESULT_TOPIC_ARN = os.environ.get('RESULT_TOPIC_ARN')
+RESULT_QUEUE_URL = os.environ.get('RESULT_QUEUE_URL')
+# Entries that failed in a batch call are sent again this many times
+NOTIFY_MAX_ATTEMPTS = int(os.environ.get('NOTIFY_MAX_ATTEMPTS', '3'))
+
+# PublishBatch and SendMessageBatch take at most 10 entries and 256 KB
+MAX_BATCH_ENTRIES = 10
+MAX_BATCH_BYTES = 256 * 1024
+
+DOCUMENT_TYPES = {
+    'IN_AADHAAR': 'aadhaar',
+    'IN_PERMANENT_ACCOUNT_NUMBER': 'pan',
+    'DRIVER_ID': 'driving_licence',
+    'PASSPORT_NUMBER': 'passport'
+}
+
+def document_type(result):
+    for entity_type in result.get("entity_types", []):
+        if entity_type in DOCUMENT_TYPES:
+            return DOCUMENT_TYPES[entity_type]
+    # Passports recognised by Rekognition have no entity types
+    if result.get("outcome") == "valid-passport":
+        return 'passport'
+    return None
+
+def result_message(result, destination):
+    return {
+        "bucket": result["bucket"],
+        "key": result["key"],
+        "outcome": result["outcome"],
+        "destination": f"s3://{destination[0]}/{destination[1]}",
+        "document_type": document_type(result),
+        "entity_types": result.get("entity_types", []),
+        "timings_ms": result.get("timings_ms", {})
+    }
+
+def batches(bodies):
+    # Groups of up to MAX_BATCH_ENTRIES message bodies within MAX_BATCH_BYTES
+    batch = []
+    size = 0
+    for body in bodies:
+        body_size = len(body.encode('utf-8'))
+        if batch and (len(batch) == MAX_BATCH_ENTRIES or size + body_size > MAX_BATCH_BYTES):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(body)
+        size += body_size
+    if batch:
+        yield batch
+
+class SnsSink:
+    name = 'sns'
+
+    def __init__(self, topic_arn):
+        self.topic_arn = topic_arn
+
+    def send(self, entries):
+        response = get_client('sns').publish_batch(
+            TopicArn=self.topic_arn,
+            PublishBatchRequestEntries=[{
+                'Id': entry_id,
+                'Message': body,
+                'MessageAttributes': {'outcome': {'DataType': 'String', 'StringValue': json.loads(body)["outcome"]}}
+            } for entry_id, body in entries]
+        )
+        return response.get('Failed', [])
+
+class SqsSink:
+    name = 'sqs'
+
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+
+    def send(self, entries):
+        response = get_client('sqs').send_message_batch(
+            QueueUrl=self.queue_url,
+            Entries=[{
+                'Id': entry_id,
+                'MessageBody': body,
+                'MessageAttributes': {'outcome': {'DataType': 'String', 'StringValue': json.loads(body)["outcome"]}}
+            } for entry_id, body in entries]
+        )
+        return response.get('Failed', [])
+
+class ResultNotifier:
+    # Buffers the result messages of one invocation and sends them in batches
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+        self._bodies = []
+
+    def add(self, message):
+        self._bodies.append(json.dumps(message, separators=(',', ':')))
+
+    def __len__(self):
+        return len(self._bodies)
+
+    def _send_batch(self, sink, bodies):
+        # Sends one batch, retrying the entries that failed for reasons other
+        # than the request itself. Returns the number of messages not sent.
+        pending = {str(index): body for index, body in enumerate(bodies)}
+        for attempt in range(NOTIFY_MAX_ATTEMPTS):
+            try:
+                failed = sink.send(list(pending.items()))
+            except Exception as e:
+                LOG.error(f"Error sending {len(pending)} result messages to {sink.name}: {str(e)}")
+                failed = [{'Id': entry_id, 'SenderFault': False} for entry_id in pending]
+
+            retry = {}
+            for failure in failed:
+                if failure.get('SenderFault'):
+                    LOG.error(f"{sink.name} rejected a result message: {failure.get('Code')} {failure.get('Message')}")
+                else:
+                    retry[failure['Id']] = pending[failure['Id']]
+            if not retry:
+                return len(failed)
+            pending = retry
+            if attempt + 1 < NOTIFY_MAX_ATTEMPTS:
+                time.sleep(backoff_delay(attempt))
+        LOG.error(f"Gave up sending {len(pending)} result messages to {sink.name}")
+        return len(pending)
+
+    def flush(self):
+        # Returns the number of messages that could not be sent
+        bodies = self._bodies
+        self._bodies = []
+        unsent = 0
+        for sink in self.sinks:
+            for batch in batches(bodies):
+                unsent += self._send_batch(sink, batch)
+        return unsent
+
+def create_notifier():
+    sinks = []
+    if RESULT_TOPIC_ARN:
+        sinks.append(SnsSink(RESULT_TOPIC_ARN))
+    if RESULT_QUEUE_URL:
+        sinks.append(SqsSink(RESULT_QUEUE_URL))
+    return ResultNotifier(sinks)
@@ -0,0 +1,206 @@
+import base64
+import binascii
+import hashlib
+import json
+import logging
+import os
+import time
+
+from botocore.exceptions import ClientError
+
+from clients import get_client
+from metrics import stage
+
+LOG = logging.getLogger()
+
+# Synchronous DetectDocumentText accepts JPEG and PNG bytes up to 10 MB
+SYNC_MAX_BYTES = 10 * 1024 * 1024
+SYNC_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# Backoff for polling asynchronous Textract jobs
+POLL_INITIAL_DELAY = float(os.environ.get('TEXTRACT_POLL_INITIAL_DELAY', '1'))
+POLL_MAX_DELAY = float(os.environ.get('TEXTRACT_POLL_MAX_DELAY', '10'))
+
+# Asynchronous jobs publish their completion to SNS when these are set
+TEXTRACT_SNS_TOPIC_ARN = os.environ.get('TEXTRACT_SNS_TOPIC_ARN')
+TEXTRACT_ROLE_ARN = os.environ.get('TEXTRACT_ROLE_ARN')
+
+# JobTag marking jobs started by this pipeline, and the version of the stage one state
+JOB_TAG = os.environ.get('TEXTRACT_JOB_TAG', 'docs-classifier:v1')
+
+# Textract errors caused by the document itself, e.g. an encrypted or corrupt PDF
+TEXTRACT_DOCUMENT_ERRORS = (
+    'UnsupportedDocumentException',
+    'InvalidS3ObjectException',
+    'BadDocumentException',
+    'DocumentTooLargeException'
+)
+
+class TextractJobFailed(Exception):
+    # An asynchronous job finished with status FAILED, Textract could not read the document
+    pass
+
+def is_document_error(error):
+    # Retrying will not help, the document goes to the invalid bucket
+    if isinstance(error, TextractJobFailed):
+        return True
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in TEXTRACT_DOCUMENT_ERRORS
+
+def can_detect_sync(object_key, image_bytes):
+    return (image_bytes is not None
+            and len(image_bytes) <= SYNC_MAX_BYTES
+            and object_key.lower().endswith(SYNC_EXTENSIONS))
+
+def detect_text_sync(image_bytes):
+    textract_client = get_client('textract')
+    with stage('textract_detect'):
+        response = textract_client.detect_document_text(Document={'Bytes': image_bytes})
+    return response.get('Blocks', [])
+
+def start_text_detection(bucket_name, object_key, **kwargs):
+    textract_client = get_client('textract')
+    with stage('textract_start'):
+        response = textract_client.start_document_text_detection(
+            DocumentLocation={"S3Object": {"Bucket": bucket_name, "Name": object_key}},
+            **kwargs
+        )
+    job_id = response['JobId']
+    LOG.info(f"Textract job started with JobId: {job_id}")
+    return job_id
+
+def wait_for_textract_job(job_id):
+    textract_client = get_client('textract')
+    delay = POLL_INITIAL_DELAY
+
+    while True:
+        response = textract_client.get_document_text_detection(JobId=job_id)
+        status = response['JobStatus']
+
+        if status in ('SUCCEEDED', 'PARTIAL_SUCCESS'):
+            return response
+        elif status == 'FAILED':
+            raise TextractJobFailed(f"Textract job {job_id} failed: {response.get('StatusMessage', '')}")
+
+        # Exponential backoff between status checks
+        time.sleep(delay)
+        delay = min(delay * 2, POLL_MAX_DELAY)
+
+def get_textract_results(job_id):
+    textract_client = get_client('textract')
+
+    # Wait for the job, then follow NextToken to collect every page of blocks
+    with stage('textract_poll'):
+        response = wait_for_textract_job(job_id)
+    blocks = list(response.get('Blocks', []))
+    next_token = response.get('NextToken')
+    with stage('textract_fetch'):
+        while next_token:
+            page = textract_client.get_document_text_detection(JobId=job_id, NextToken=next_token)
+            blocks.extend(page.get('Blocks', []))
+            next_token = page.get('NextToken')
+
+    response = dict(response)
+    response['Blocks'] = blocks
+    response.pop('NextToken', None)
+    return response
+
+def iter_text_pages(job_id):
+    # Yields (page number, blocks) for each page of a job's results. The
+    # next batch of results is only fetched when the caller asks for the
+    # next page, so a caller that stops early never reads the rest.
+    textract_client = get_client('textract')
+    with stage('textract_poll'):
+        response = wait_for_textract_job(job_id)
+
+    page_number = None
+    page_blocks = []
+    while True:
+        for block in response.get('Blocks', []):
+            # Blocks arrive in page order, a page is complete once the next one starts
+            number = block.get('Page', 1)
+            if page_blocks and number != page_number:
+                yield page_number, page_blocks
+                page_blocks = []
+            page_number = number
+            page_blocks.append(block)
+
+        next_token = response.get('NextToken')
+        if not next_token:
+            break
+        with stage('textract_fetch'):
+            response = textract_client.get_document_text_detection(JobId=job_id, NextToken=next_token)
+
+    if page_blocks:
+        yield page_number, page_blocks
+
+def detect_text(bucket_name, object_key, image_bytes=None):
+    # Single-page images already in memory use the synchronous API,
+    # anything else goes through an asynchronous Textract job
+    if can_detect_sync(object_key, image_bytes):
+        LOG.info(f"Running synchronous Textract on {object_key}")
+        return detect_text_sync(image_bytes)
+
+    job_id = start_text_detection(bucket_name, object_key)
+    return get_textract_results(job_id)["Blocks"]
+
+def get_line_text(blocks):
+    # Extract text from LINE blocks, with whitespace normalized to single spaces
+    return ' '.join([' '.join(block["Text"].split()) for block in blocks if block["BlockType"] == "LINE"])
+
+def notifications_enabled():
+    return bool(TEXTRACT_SNS_TOPIC_ARN and TEXTRACT_ROLE_ARN)
+
+def client_request_token(bucket_name, object_key, digest=None):
+    # The same content under the same key always maps to the same token, so
+    # Textract returns the existing job instead of starting a duplicate one.
+    # A different file uploaded under the key gets a job of its own.
+    source = f"{bucket_name}/{object_key}/{digest or ''}"
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()[:64]
+
+def encode_job_tag(digest=None):
+    # JobTag is limited to 64 characters of [a-zA-Z0-9_.-:], so the SHA-256
+    # content digest is carried as unpadded base64url (43 characters)
+    if not digest:
+        return JOB_TAG
+    encoded = base64.urlsafe_b64encode(bytes.fromhex(digest)).decode('ascii').rstrip('=')
+    return f"{JOB_TAG}:{encoded}"
+
+def decode_job_tag(job_tag):
+    # Returns (started by this pipeline, content digest or None)
+    if not job_tag or not (job_tag == JOB_TAG or job_tag.startswith(f"{JOB_TAG}:")):
+        return False, None
+    encoded = job_tag[len(JOB_TAG) + 1:]
+    if not encoded:
+        return True, None
+    try:
+        return True, base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4)).hex()
+    except (binascii.Error, ValueError):
+        return True, None
+
+def start_text_detection_with_notification(bucket_name, object_key, digest=None):
+    # Stage one: start the job and return straight away. The bucket and key
+    # come back in the completion message's DocumentLocation, the JobTag
+    # records that the document already passed Rekognition validation and
+    # carries the content digest for the result cache.
+    return start_text_detection(
+        bucket_name, object_key,
+        ClientRequestToken=client_request_token(bucket_name, object_key, digest),
+        JobTag=encode_job_tag(digest),
+        NotificationChannel={
+            'SNSTopicArn': TEXTRACT_SNS_TOPIC_ARN,
+            'RoleArn': TEXTRACT_ROLE_ARN
+        }
+    )
+
+def parse_completion_message(sns_record):
+    # Textract completion notification delivered through SNS
+    message = json.loads(sns_record['Sns']['Message'])
+    location = message.get('DocumentLocation', {})
+    return {
+        "job_id": message['JobId'],
+        "status": message.get('Status'),
+        "job_tag": message.get('JobTag'),
+        "digest": decode_job_tag(message.get('JobTag'))[1],
+        "bucket": location.get('S3Bucket'),
+        "key": location.get('S3ObjectName')
+    }
@@ -0,0 +1,141 @@
+import logging
+import os
+import re
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import metrics
+from clients import get_client
+
+LOG = logging.getLogger()
+
+# Comprehend accepts at most 100 KB of UTF-8 text per request, keep some margin
+MAX_CHUNK_BYTES = int(os.environ.get('PII_MAX_CHUNK_BYTES', '90000'))
+# Chunks of one document sent to Comprehend in parallel
+PII_MAX_WORKERS = int(os.environ.get('PII_MAX_WORKERS', '4'))
+
+TOKEN_PATTERN = re.compile(r'\S+\s*')
+
+# Shared by all records in the container, chunks are short lived Comprehend calls
+_executor = ThreadPoolExecutor(max_workers=PII_MAX_WORKERS)
+
+def _split_token(token, max_bytes):
+    # Hard split a single token longer than max_bytes, on character boundaries
+    pieces = []
+    current = ''
+    current_bytes = 0
+    for char in token:
+        size = len(char.encode('utf-8'))
+        if current and current_bytes + size > max_bytes:
+            pieces.append(current)
+            current = ''
+            current_bytes = 0
+        current += char
+        current_bytes += size
+    if current:
+        pieces.append(current)
+    return pieces
+
+def split_text(text, max_bytes=MAX_CHUNK_BYTES):
+    # Returns (character offset, chunk) pairs, split on whitespace so that
+    # each chunk is at most max_bytes of UTF-8
+    if len(text.encode('utf-8')) <= max_bytes:
+        return [(0, text)] if text else []
+
+    chunks = []
+    start = 0
+    current = []
+    current_bytes = 0
+    for match in TOKEN_PATTERN.finditer(text):
+        token = match.group(0)
+        size = len(token.encode('utf-8'))
+        if current and current_bytes + size > max_bytes:
+            chunks.append((start, ''.join(current)))
+            current = []
+            current_bytes = 0
+        if not current:
+            start = match.start()
+        if size > max_bytes:
+            offset = match.start()
+            for piece in _split_token(token, max_bytes):
+                chunks.append((offset, piece))
+                offset += len(piece)
+            continue
+        current.append(token)
+        current_bytes += size
+    if current:
+        chunks.append((start, ''.join(current)))
+    return chunks
+
+def _run_chunks(fn, chunks, is_done):
+    # Call fn on every chunk in parallel. Stops waiting, and cancels chunks
+    # that have not started yet, as soon as is_done(result) is true.
+    if len(chunks) == 1:
+        return [fn(*chunks[0])]
+
+    # Chunk calls are counted against the document being processed
+    document_metrics = metrics.current()
+
+    def run_chunk(offset, chunk):
+        with metrics.bind(document_metrics):
+            return fn(offset, chunk)
+
+    results = []
+    pending = {_executor.submit(run_chunk, *chunk) for chunk in chunks}
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                results.append(result)
+                if is_done(result):
+                    return results
+    finally:
+        for future in pending:
+            future.cancel()
+    return results
+
+def detect_pii_entities(text, stop_types=(), min_score=0.0):
+    # Entities scoring below min_score are dropped per chunk, so they never
+    # stop the other chunks early
+    comprehend_client = get_client('comprehend')
+
+    def detect_chunk(offset, chunk):
+        response = comprehend_client.detect_pii_entities(Text=chunk, LanguageCode='en')
+        entities = []
+        for entity in response.get('Entities', []):
+            if entity['Score'] < min_score:
+                continue
+            # Rebase offsets to positions in the full text
+            entities.append({
+                "Type": entity['Type'],
+                "Score": entity['Score'],
+                "BeginOffset": entity['BeginOffset'] + offset,
+                "EndOffset": entity['EndOffset'] + offset
+            })
+        return entities
+
+    chunks = split_text(text)
+    results = _run_chunks(detect_chunk, chunks,
+                          lambda entities: any(entity['Type'] in stop_types for entity in entities))
+
+    entities = [entity for chunk_entities in results for entity in chunk_entities]
+    entities.sort(key=lambda entity: entity['BeginOffset'])
+    return entities
+
+def contains_pii_entities(text, stop_types=(), min_score=0.0):
+    comprehend_client = get_client('comprehend')
+
+    def label_chunk(offset, chunk):
+        response = comprehend_client.contains_pii_entities(Text=chunk, LanguageCode='en')
+        return [label for label in response.get('Labels', []) if label['Score'] > min_score]
+
+    chunks = split_text(text)
+    results = _run_chunks(label_chunk, chunks,
+                          lambda labels: any(label['Name'] in stop_types for label in labels))
+
+    # Merge labels from all chunks, keeping the highest score for each name
+    scores = {}
+    for labels in results:
+        for label in labels:
+            scores[label['Name']] = max(label['Score'], scores.get(label['Name'], 0.0))
+    return [{"Name": name, "Score": score} for name, score in scores.items()]
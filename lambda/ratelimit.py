@@ -0,0 +1,210 @@
+import logging
+import os
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError, ConnectionError as BotocoreConnectionError, HTTPClientError
+
+import metrics
+
+LOG = logging.getLogger()
+
+# Calls per second for each API, per container. Account quotas are shared by
+# all concurrent containers, so these should be the quota divided by the
+# expected number of containers. Override with API_RATE_LIMITS, e.g.
+# "textract.detect_document_text=5,comprehend.contains_pii_entities=10",
+# or set it to "off" to only keep the throttling backoff.
+DEFAULT_RATE_LIMITS = {
+    'rekognition.detect_labels': 50.0,
+    'textract.detect_document_text': 10.0,
+    'textract.start_document_text_detection': 10.0,
+    'textract.get_document_text_detection': 10.0,
+    'comprehend.contains_pii_entities': 20.0,
+    'comprehend.detect_pii_entities': 20.0
+}
+# Services whose clients go through the limiter
+RATE_LIMITED_SERVICES = ('rekognition', 'textract', 'comprehend')
+
+# Attempts per call when the API throttles or fails transiently, and the
+# backoff between them
+THROTTLE_MAX_ATTEMPTS = int(os.environ.get('THROTTLE_MAX_ATTEMPTS', '4'))
+THROTTLE_BACKOFF_BASE = float(os.environ.get('THROTTLE_BACKOFF_BASE', '0.2'))
+THROTTLE_BACKOFF_MAX = float(os.environ.get('THROTTLE_BACKOFF_MAX', '5'))
+
+THROTTLING_ERROR_CODES = (
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'LimitExceededException',
+    'SlowDown'
+)
+
+# Server side errors worth another attempt, like any 5xx response
+TRANSIENT_ERROR_CODES = (
+    'InternalFailure',
+    'InternalServerError',
+    'InternalServerException',
+    'InternalError',
+    'ServiceUnavailable',
+    'ServiceUnavailableException',
+    'RequestTimeout',
+    'RequestTimeoutException'
+)
+
+# Client attributes that are not API calls
+_PASSTHROUGH = ('exceptions', 'meta', 'get_paginator', 'get_waiter', 'can_paginate', 'close', 'generate_presigned_url')
+
+class ThrottledError(Exception):
+    # An API kept throttling after every backoff attempt, the document should be retried later
+
+    def __init__(self, api, error):
+        super().__init__(f"{api} throttled after {THROTTLE_MAX_ATTEMPTS} attempts: {str(error)}")
+        self.api = api
+
+def parse_rate_limits(value):
+    if value.strip().lower() == 'off':
+        return {}
+    limits = dict(DEFAULT_RATE_LIMITS)
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        api, rate = item.split('=')
+        limits[api.strip()] = float(rate)
+    return limits
+
+RATE_LIMITS = parse_rate_limits(os.environ.get('API_RATE_LIMITS', ''))
+
+def is_throttling_error(error):
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+def is_transient_error(error):
+    # Connection resets, timeouts and server errors, which another attempt may not hit
+    if isinstance(error, (BotocoreConnectionError, HTTPClientError)):
+        return True
+    if not isinstance(error, ClientError):
+        return False
+    return (error.response.get('Error', {}).get('Code') in TRANSIENT_ERROR_CODES
+            or error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500)
+
+def is_throttled(error):
+    # A throttling error from any client, limited or not
+    return isinstance(error, ThrottledError) or is_throttling_error(error)
+
+def backoff_delay(attempt):
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(THROTTLE_BACKOFF_MAX, THROTTLE_BACKOFF_BASE * 2 ** attempt))
+
+class TokenBucket:
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # Takes one token, sleeping until one is available. Returns the seconds waited.
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+class RateLimiter:
+    # One token bucket per API, plus counters for the invocation logs
+
+    def __init__(self, limits=None):
+        self.limits = RATE_LIMITS if limits is None else limits
+        self._buckets = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, api):
+        rate = self.limits.get(api)
+        if not rate:
+            return None
+        with self._lock:
+            bucket = self._buckets.get(api)
+            if bucket is None:
+                bucket = self._buckets[api] = TokenBucket(rate)
+            return bucket
+
+    def _count(self, api, name, amount=1):
+        with self._lock:
+            stats = self._stats.setdefault(api, {"calls": 0, "throttled": 0, "gave_up": 0, "transient": 0, "wait_ms": 0.0})
+            stats[name] += amount
+
+    def _wait(self, api, seconds, timing):
+        if seconds:
+            self._count(api, "wait_ms", seconds * 1000)
+            metrics.add_timing(timing, seconds * 1000)
+
+    def call(self, api, fn, *args, **kwargs):
+        bucket = self._bucket(api)
+        for attempt in range(THROTTLE_MAX_ATTEMPTS):
+            if bucket is not None:
+                self._wait(api, bucket.acquire(), 'rate_limit_wait')
+            self._count(api, "calls")
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if is_throttling_error(e):
+                    self._count(api, "throttled")
+                    if attempt + 1 == THROTTLE_MAX_ATTEMPTS:
+                        self._count(api, "gave_up")
+                        raise ThrottledError(api, e)
+                    reason = 'throttled'
+                elif is_transient_error(e):
+                    # Raised as is after the last attempt, the document fails
+                    # and its message is retried through SQS
+                    self._count(api, "transient")
+                    if attempt + 1 == THROTTLE_MAX_ATTEMPTS:
+                        raise
+                    reason = f"failed ({str(e)})"
+                else:
+                    raise
+                delay = backoff_delay(attempt)
+                LOG.warning(f"{api} {reason}, retrying in {delay * 1000:.0f} ms")
+                time.sleep(delay)
+                self._wait(api, delay, 'throttle_backoff')
+
+    def stats(self):
+        with self._lock:
+            return {api: dict(stats, wait_ms=round(stats["wait_ms"], 3)) for api, stats in self._stats.items()}
+
+# Shared by every client in the container
+LIMITER = RateLimiter()
+
+class RateLimitedClient:
+    # Wraps a boto3 client so that every API call goes through LIMITER.
+    # Everything else, e.g. exceptions and meta, is the wrapped client's.
+
+    def __init__(self, client, service_name, limiter=None):
+        self._client = client
+        self._service_name = service_name
+        self._limiter = limiter or LIMITER
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name.startswith('_') or name in _PASSTHROUGH or not callable(attribute):
+            return attribute
+
+        api = f"{self._service_name}.{name}"
+
+        def limited(*args, **kwargs):
+            return self._limiter.call(api, attribute, *args, **kwargs)
+        return limited
@@ -0,0 +1,177 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+from sidecar import decode_sidecar, encode_sidecar, reuse_ocr, sidecar_key
+
+LOG = logging.getLogger()
+
+VALID_DOCS_BUCKET = os.environ.get('VALID_DOCS_BUCKET', 'valid-docs-bucket')
+INVALID_DOCS_BUCKET = os.environ.get('INVALID_DOCS_BUCKET', 'invalid-docs-bucket')
+
+# Destination bucket and key prefix for each classification outcome
+DESTINATIONS = {
+    'valid': (VALID_DOCS_BUCKET, 'valid-docs-folder/'),
+    'valid-passport': (VALID_DOCS_BUCKET, 'valid-docs-folder/passport/'),
+    'invalid': (INVALID_DOCS_BUCKET, 'invalid-docs-folder/')
+}
+
+# Objects larger than this are copied with a managed multipart copy
+MULTIPART_COPY_THRESHOLD = int(os.environ.get('MULTIPART_COPY_THRESHOLD', str(100 * 1024 * 1024)))
+# DeleteObjects accepts at most 1000 keys per request
+DELETE_BATCH_SIZE = 1000
+
+def original_key(bucket_name, object_key):
+    # Key as uploaded, for objects that are already in a destination folder
+    for destination_bucket, prefix in sorted(DESTINATIONS.values(), key=lambda destination: -len(destination[1])):
+        if bucket_name == destination_bucket and object_key.startswith(prefix):
+            return object_key[len(prefix):]
+    return object_key
+
+def destination_for(outcome, object_key):
+    destination_bucket, prefix = DESTINATIONS[outcome]
+    return destination_bucket, f"{prefix}{object_key}"
+
+class Router:
+    # Collects the destination of every document in an invocation, then
+    # copies each object once and deletes the sources in bulk
+
+    def __init__(self, s3, max_workers=8):
+        self.s3 = s3
+        self.max_workers = max_workers
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def route(self, bucket_name, object_key, outcome, size=None, sidecar=None, sidecar_source=None):
+        # A later decision for the same object replaces an earlier one.
+        # sidecar is written next to the destination object, as encoded bytes.
+        # With sidecar_source, the (bucket, key) of an existing sidecar, it
+        # takes the OCR output of that one, unless it is gone.
+        with self._lock:
+            self._routes[(bucket_name, object_key)] = {
+                "outcome": outcome,
+                "size": size,
+                "sidecar": sidecar,
+                "sidecar_source": sidecar_source
+            }
+
+    def __len__(self):
+        return len(self._routes)
+
+    def _copy(self, source, route):
+        # Returns False when the object is already at its destination, e.g.
+        # when a reprocessed document keeps its classification
+        bucket_name, object_key = source
+        destination_bucket, destination_key = destination_for(route["outcome"], original_key(bucket_name, object_key))
+        moved = (destination_bucket, destination_key) != source
+        if moved:
+            copy_source = {'Bucket': bucket_name, 'Key': object_key}
+            if route["size"] is not None and route["size"] > MULTIPART_COPY_THRESHOLD:
+                self.s3.copy(copy_source, destination_bucket, destination_key,
+                             Config=TransferConfig(multipart_threshold=MULTIPART_COPY_THRESHOLD))
+            else:
+                self.s3.copy_object(
+                    Bucket=destination_bucket,
+                    CopySource=copy_source,
+                    Key=destination_key
+                )
+            LOG.info(f"File copied to S3 bucket: {destination_bucket}/{destination_key}")
+
+        # Only once the document is in place, so a failed copy never leaves
+        # a sidecar without its document
+        if route["sidecar_source"] is not None:
+            self._copy_sidecar(route["sidecar_source"], destination_bucket, destination_key, route["sidecar"])
+        elif route["sidecar"] is not None:
+            self._put_sidecar(destination_bucket, destination_key, route["sidecar"])
+        return moved
+
+    def _put_sidecar(self, bucket_name, object_key, data):
+        self.s3.put_object(
+            Bucket=bucket_name,
+            Key=sidecar_key(object_key),
+            Body=data,
+            ContentType='application/json',
+            ContentEncoding='gzip'
+        )
+
+    def _copy_sidecar(self, source, bucket_name, object_key, data):
+        # data, the document's own sidecar, takes the pages and entities of
+        # the sidecar at source, and keeps its own source and decision trace
+        if tuple(source) == (bucket_name, sidecar_key(object_key)):
+            return
+        try:
+            response = self.s3.get_object(Bucket=source[0], Key=source[1])
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+                raise
+            LOG.warning(f"Sidecar {source[0]}/{source[1]} no longer exists, writing a new one")
+        else:
+            data = encode_sidecar(reuse_ocr(decode_sidecar(data), decode_sidecar(response['Body'].read())))
+        self._put_sidecar(bucket_name, object_key, data)
+
+    def _copy_safely(self, item):
+        source, route = item
+        try:
+            return source, self._copy(source, route), None
+        except Exception as e:
+            LOG.error(f"Error copying {source[0]}/{source[1]}: {str(e)}")
+            return source, False, str(e)
+
+    def _delete(self, bucket_name, object_keys):
+        failures = {}
+        for start in range(0, len(object_keys), DELETE_BATCH_SIZE):
+            batch = object_keys[start:start + DELETE_BATCH_SIZE]
+            try:
+                response = self.s3.delete_objects(
+                    Bucket=bucket_name,
+                    Delete={
+                        'Objects': [{'Key': object_key} for object_key in batch],
+                        'Quiet': True
+                    }
+                )
+            except Exception as e:
+                LOG.error(f"Error deleting objects from S3 bucket {bucket_name}: {str(e)}")
+                for object_key in batch:
+                    failures[(bucket_name, object_key)] = str(e)
+                continue
+
+            # In quiet mode only the keys that could not be deleted are returned
+            for error in response.get('Errors', []):
+                failures[(bucket_name, error['Key'])] = f"{error.get('Code')}: {error.get('Message')}"
+            LOG.info(f"Original objects deleted from S3 bucket: {bucket_name} ({len(batch)} keys)")
+        return failures
+
+    def flush(self):
+        # Returns {(bucket, key): error message} for every object that could
+        # not be copied or deleted. Sources are only deleted after a successful copy.
+        with self._lock:
+            routes = self._routes
+            self._routes = {}
+        if not routes:
+            return {}
+
+        items = list(routes.items())
+        if self.max_workers > 1 and len(items) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(items))) as executor:
+                copies = list(executor.map(self._copy_safely, items))
+        else:
+            copies = [self._copy_safely(item) for item in items]
+
+        failures = {}
+        to_delete = {}
+        for source, copied, error in copies:
+            if error:
+                failures[source] = error
+            elif copied:
+                to_delete.setdefault(source[0], []).append(source[1])
+                # A reprocessed document takes its old sidecar along
+                if original_key(*source) != source[1]:
+                    to_delete[source[0]].append(sidecar_key(source[1]))
+
+        for bucket_name, object_keys in to_delete.items():
+            failures.update(self._delete(bucket_name, object_keys))
+        return failures
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import logging
+import os
+import re
+
+LOG = logging.getLogger()
+
+# Classification rules, a path to a JSON file or the JSON itself. They are
+# loaded once per container, so changing a threshold only needs a new
+# configuration. Sections missing from it keep their DEFAULT_RULES.
+RULES_CONFIG = os.environ.get('RULES_CONFIG')
+
+# Outcomes a rule can decide
+OUTCOMES = ('valid', 'valid-passport', 'invalid')
+# Decision of the label rules when the text has to be read to decide
+READ_TEXT = 'read_text'
+# Comprehend analyses: PII entities with offsets, or PII labels for the whole text
+ANALYSES = ('offsets', 'labels')
+
+DEFAULT_RULES = {
+    # Rekognition labels, checked first. A rule with an outcome decides the
+    # document on its own, the others send it on to Textract.
+    "labels": [
+        {"names": ["Passport"], "min_confidence": 90.0, "outcome": "valid-passport"},
+        {"names": ["Text", "Person", "Face", "Head", "QR Code", "Document", "Id Cards", "Passport"], "min_confidence": 50.0}
+    ],
+    # Keywords in the extracted text. A hint is set when every word of any of
+    # its groups appears.
+    "keywords": {
+        "DRIVING_LICENCE": [["driving", "licence"], ["driving", "license"]],
+        "AADHAAR": [["aadhaar"], ["uidai"]],
+        "PAN": [["permanent", "account", "number"], ["income", "tax"]],
+        "PASSPORT": [["passport", "republic"]]
+    },
+    # The Comprehend analysis of the first rule whose hint was found, a rule
+    # without a hint always applies
+    "comprehend": [
+        {"hint": "DRIVING_LICENCE", "analysis": "offsets"},
+        {"hint": "AADHAAR", "analysis": "labels", "min_score": 0.0},
+        {"hint": "PAN", "analysis": "offsets"},
+        {"analysis": "labels", "min_score": 0.7}
+    ],
+    # Entity types that make a document a valid Govt ID, and its outcome
+    "entities": {
+        "IN_AADHAAR": "valid",
+        "IN_PERMANENT_ACCOUNT_NUMBER": "valid",
+        "DRIVER_ID": "valid",
+        "PASSPORT_NUMBER": "valid-passport"
+    }
+}
+
+def trace_step(stage, decision=None, **details):
+    # One entry of a document's decision trace
+    step = {"stage": stage}
+    if decision is not None:
+        step["decision"] = decision
+    step.update(details)
+    return step
+
+def _words(keyword):
+    return ' '.join(keyword.lower().split())
+
+class RuleSet:
+    # Rules compiled once: label names to a dict of rules, every keyword into
+    # one pattern matched in a single pass over the text
+
+    def __init__(self, config):
+        self.config = config
+        # Cached classifications are only reused under the same rules
+        self.fingerprint = hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+        self._labels = {}
+        for rule in config["labels"]:
+            outcome = rule.get("outcome")
+            if outcome is not None and outcome not in OUTCOMES:
+                raise ValueError(f"Label rule outcome must be one of {OUTCOMES}, not {outcome!r}")
+            for name in rule["names"]:
+                self._labels.setdefault(name, []).append((float(rule.get("min_confidence", 0.0)), outcome))
+
+        self._hints = []
+        keywords = set()
+        for hint, groups in config["keywords"].items():
+            groups = [frozenset(_words(keyword) for keyword in group) for group in groups]
+            self._hints.append((hint, groups))
+            keywords.update(*groups)
+        # Longest first, so a phrase wins over a keyword it starts with
+        alternatives = [r'\s+'.join(map(re.escape, keyword.split())) for keyword in sorted(keywords, key=len, reverse=True)]
+        self._keyword_pattern = re.compile(r'\b(' + '|'.join(alternatives) + r')\b', re.IGNORECASE) if alternatives else None
+
+        self._comprehend = []
+        for rule in config["comprehend"]:
+            if rule["analysis"] not in ANALYSES:
+                raise ValueError(f"Comprehend analysis must be one of {ANALYSES}, not {rule['analysis']!r}")
+            self._comprehend.append({
+                "hint": rule.get("hint"),
+                "analysis": rule["analysis"],
+                "min_score": float(rule.get("min_score", 0.0))
+            })
+
+        self.entity_outcomes = dict(config["entities"])
+        for outcome in self.entity_outcomes.values():
+            if outcome not in OUTCOMES:
+                raise ValueError(f"Entity outcome must be one of {OUTCOMES}, not {outcome!r}")
+        # Comprehend stops reading chunks once one of these is found
+        self.entity_types = tuple(self.entity_outcomes)
+
+    def check_labels(self, labels, trace):
+        # One pass over the Rekognition labels. Returns the outcome of the
+        # first deciding rule that matches, READ_TEXT if only rules that send
+        # the document to Textract matched, or 'invalid'.
+        matched = []
+        for label in labels:
+            for min_confidence, outcome in self._labels.get(label['Name'], ()):
+                if label['Confidence'] < min_confidence:
+                    continue
+                if outcome:
+                    trace.append(trace_step('labels', outcome, label=label['Name'], confidence=round(label['Confidence'], 2)))
+                    return outcome
+                matched.append(label['Name'])
+
+        decision = READ_TEXT if matched else 'invalid'
+        trace.append(trace_step('labels', decision, labels=sorted(set(matched))))
+        return decision
+
+    def match_hints(self, text):
+        if self._keyword_pattern is None:
+            return set()
+        found = {_words(match.group(1)) for match in self._keyword_pattern.finditer(text)}
+        return {hint for hint, groups in self._hints if any(group <= found for group in groups)}
+
+    def comprehend_rule(self, hints):
+        for rule in self._comprehend:
+            if rule["hint"] is None or rule["hint"] in hints:
+                return rule
+        return None
+
+    def decide_entities(self, entities, trace, source):
+        # Returns (outcome, entity type) of the first Govt ID entity, or ('invalid', None)
+        for entity in entities:
+            entity_type = entity.get('Name') or entity.get('Type')
+            outcome = self.entity_outcomes.get(entity_type)
+            if outcome:
+                trace.append(trace_step(source, outcome, entity_type=entity_type))
+                return outcome, entity_type
+        trace.append(trace_step(source, 'invalid'))
+        return 'invalid', None
+
+def load_rules(value=RULES_CONFIG):
+    if not value:
+        return RuleSet(DEFAULT_RULES)
+    if value.lstrip().startswith('{'):
+        config = json.loads(value)
+    else:
+        with open(value) as f:
+            config = json.load(f)
+    unknown = set(config) - set(DEFAULT_RULES)
+    if unknown:
+        raise ValueError(f"Unknown rules sections: {sorted(unknown)}")
+    rules = RuleSet(dict(DEFAULT_RULES, **config))
+    LOG.info(f"Loaded classification rules {rules.fingerprint}")
+    return rules
@@ -1,73 +1,87 @@
-import boto3
+import json
 import logging
+import os
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from botocore.exceptions import ClientError
+
+from cache import content_digest, create_result_cache
+from clients import get_client, get_init_stats
+from detectors import detect_local_entities
+from idempotency import COMPLETED, create_idempotency_store, s3_event_key, textract_job_key
+from imaging import InvalidImageError, preprocess_image, sniff_format
+from metrics import (
+    LOG_DOCUMENT_TEXT,
+    DocumentMetrics,
+    add_bytes,
+    bind,
+    current,
+    document_record,
+    emit,
+    invocation_record,
+    should_sample,
+    stage
+)
+from ocr import (
+    can_detect_sync,
+    decode_job_tag,
+    detect_text,
+    detect_text_sync,
+    get_line_text,
+    is_document_error,
+    iter_text_pages,
+    notifications_enabled,
+    parse_completion_message,
+    start_text_detection,
+    start_text_detection_with_notification
+)
+from notify import create_notifier, result_message
+from pii import contains_pii_entities, detect_pii_entities
+from ratelimit import LIMITER, is_throttled
+from routing import DESTINATIONS, Router, destination_for, original_key
+from rules import READ_TEXT, load_rules, trace_step
+from sidecar import SIDECARS_ENABLED, build_sidecar, encode_sidecar, page_record, reuse_ocr, sidecar_key
 
 # Configure logging
 LOG = logging.getLogger()
 LOG.setLevel(logging.INFO)  # Set to DEBUG level for detailed logging
 
-def move_to_bucket(bucket_name, object_key, s3):
-    destination_key = f"valid-docs-folder/{object_key}"
-    destination_bucket = 'valid-docs-bucket'
+# Maximum number of records from one event processed in parallel
+MAX_CONCURRENCY = int(os.environ.get('MAX_CONCURRENCY', '8'))
 
-    try:
-        s3.copy_object(
-            Bucket=destination_bucket,
-            CopySource={'Bucket': bucket_name, 'Key': object_key},
-            Key=destination_key
-        )
-        LOG.info(f"File copied to S3 bucket: {destination_bucket}/{destination_key}")
+# Single images go through Rekognition first, multi-page documents straight to async Textract
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+DOCUMENT_EXTENSIONS = ('.pdf', '.tif', '.tiff')
+# Pages of one document classified in parallel while the next ones are fetched
+PAGE_MAX_WORKERS = int(os.environ.get('PAGE_MAX_WORKERS', '2'))
 
-        # Delete the original object from the source bucket
-        s3.delete_object(
-            Bucket=bucket_name,
-            Key=object_key
-        )
-        LOG.info(f"Original object deleted from S3 bucket: {bucket_name}/{object_key}")
-    except Exception as e:
-        LOG.error(f"Error moving to valid docs bucket: {str(e)}")
+# Label, keyword and entity rules that classify a document, see rules.py
+RULES = load_rules()
 
-def process_comprehend(text):
-    comprehend_client = boto3.client('comprehend')
+# Classification results keyed by content digest, shared across warm invocations
+RESULT_CACHE = create_result_cache(rules=RULES.fingerprint)
 
-    # Detect PII entities in the text
-    pii_entities_response = comprehend_client.contains_pii_entities(Text=text, LanguageCode='en')
-    entities = []
+# Repeated deliveries of the same event are answered from this store
+IDEMPOTENCY = create_idempotency_store()
 
-    if 'Labels' in pii_entities_response:
-        for label in pii_entities_response['Labels']:
-            if label['Score'] > 0.7:  # Check if the score is greater than 70
-                pii_entity = {
-                    "Name": label['Name'],
-                    "Score": label['Score']
-                }
-                entities.append(pii_entity)
-
-    return entities
+# Documents decided by their labels alone are still read with synchronous
+# Textract, so that their sidecar has the text, e.g. the passport number
+SIDECAR_LABEL_OCR = os.environ.get('SIDECAR_LABEL_OCR', 'true').lower() == 'true'
 
-def move_to_valid_passport_bucket(bucket_name, object_key, s3):
-    destination_key = f"valid-docs-folder/passport/{object_key}"
-    destination_bucket = 'valid-docs-bucket'
-    try:
-        s3.copy_object(
-            Bucket=destination_bucket,
-            CopySource={'Bucket': bucket_name, 'Key': object_key},
-            Key=destination_key
-        )
-        LOG.info(f"File copied to S3 bucket: {destination_bucket}/{destination_key}")
+# Rekognition errors caused by the image itself rather than by the service
+REKOGNITION_IMAGE_ERRORS = ('InvalidImageFormatException', 'ImageTooLargeException', 'InvalidParameterException')
+# Comprehend errors caused by the text itself
+COMPREHEND_INPUT_ERRORS = ('TextSizeLimitExceededException', 'InvalidRequestException')
 
-        # Delete the original object from the source bucket
-        s3.delete_object(
-            Bucket=bucket_name,
-            Key=object_key
-        )
-        LOG.info(f"Original object deleted from S3 bucket: {bucket_name}/{object_key}")
+# Validate, orient and shrink images in memory before Rekognition and Textract
+IMAGE_PREPROCESSING = os.environ.get('IMAGE_PREPROCESSING', 'true').lower() == 'true'
 
-    except Exception as e:
-        LOG.error(f"Error moving passport to valid docs bucket: {str(e)}")
+# Set to False after the first invocation in this container
+_cold_start = True
 
 def process_image_with_rekognition(image_bytes):
-    rekognition = boto3.client('rekognition')
+    rekognition = get_client('rekognition')
     labels = []
 
     try:
@@ -86,94 +100,544 @@ def process_image_with_rekognition(image_bytes):
             labels = rekognition_response['Labels']
         
         return labels
-        
-    except Exception as e:
-        LOG.error(f"Error processing image with Rekognition: {str(e)}")
-        return labels
-
-def get_textract_results(job_id):
-    textract_client = boto3.client('textract')
 
-    while True:
-        response = textract_client.get_document_text_detection(JobId=job_id)
-        status = response['JobStatus']
-        
-        if status == 'SUCCEEDED':
-            return response
-        elif status == 'FAILED':
-            raise Exception("Textract job failed")
-        
-        time.sleep(5)  # Wait for 5 seconds before checking again
-        
-def move_to_invalid_bucket(bucket_name, object_key, s3):
-    destination_key = f"invalid-docs-folder/{object_key}"
-    destination_bucket = 'invalid-docs-bucket'
+    except ClientError as e:
+        # Images Rekognition cannot read are rejected, any other error is
+        # not the same as "no labels" and is raised so the result is neither
+        # cached nor routed
+        if e.response.get('Error', {}).get('Code') in REKOGNITION_IMAGE_ERRORS:
+            raise InvalidImageError(f"Rekognition rejected the image: {str(e)}")
+        raise
+
+def process_comprehend(text, rule):
+    # Run the Comprehend analysis chosen by the rules, long text is split into chunks
+    if rule["analysis"] == 'offsets':
+        return detect_pii_entities(text, stop_types=RULES.entity_types, min_score=rule["min_score"])
+    return contains_pii_entities(text, stop_types=RULES.entity_types, min_score=rule["min_score"])
+
+def classify_blocks(blocks, result, hinted_only=False):
+    # The text is checked in order of cost: keywords and local patterns, then
+    # Comprehend, which is only called when the local checks are not conclusive.
+    # With hinted_only, text without any ID keywords is not sent to Comprehend
+    # and the result is marked "unchecked" instead.
+    trace = result.setdefault("decision_trace", [])
+    # Extract text from LINE blocks
+    text = get_line_text(blocks)
+
+    # Extracted text is PII, so it is only logged when LOG_DOCUMENT_TEXT is enabled
+    if LOG_DOCUMENT_TEXT:
+        LOG.info("Extracted Textract Text passing to Comprehend %s", text)
+    LOG.info(f"Extracted {len(text)} characters of text")
+
+    with stage('local_detect'):
+        hints = RULES.match_hints(text)
+        entities = detect_local_entities(text, hints)
+    trace.append(trace_step('keywords', hints=sorted(hints)))
+
+    if entities:
+        LOG.info(f"Found Govt ID entities locally: {[entity['Type'] for entity in entities]}")
+        source = 'local'
+    elif hinted_only and not hints:
+        result["unchecked"] = True
+        source = None
+    elif text.strip():
+        rule = RULES.comprehend_rule(hints)
+        source = 'comprehend'
+        try:
+            if rule is not None:
+                LOG.info(f"Using Comprehend PII {rule['analysis']} analysis for hints {sorted(hints)}")
+                with stage('comprehend'):
+                    entities = process_comprehend(text, rule)
+                LOG.info(f"Comprehend entity types: {[entity.get('Name') or entity.get('Type') for entity in entities]}")
+
+        except ClientError as comprehend_error:
+            # Only text Comprehend refuses to analyse counts as no entities,
+            # any other error fails the document so it is retried
+            if comprehend_error.response.get('Error', {}).get('Code') not in COMPREHEND_INPUT_ERRORS:
+                raise
+            LOG.error(f"Comprehend rejected the text: {str(comprehend_error)}")
+            entities = []
+            result["error_message"] = str(comprehend_error)
+    else:
+        source = 'text'
+
+    # Kept for the sidecar written next to the routed document
+    result["ocr_pages"] = [page_record(blocks, text, entities)]
+
+    if source is None:
+        trace.append(trace_step('comprehend', 'unchecked'))
+        result["outcome"] = "invalid"
+        return result
+
+    outcome, entity_type = RULES.decide_entities(entities, trace, source)
+    if entity_type:
+        LOG.info("Document is a valid Govt ID or it contains Govt ID data.")
+        result["entity_types"] = [entity_type]
+    else:
+        LOG.info("No Valid Entity Type found.")
+    result["outcome"] = outcome
+    return result
+
+def read_sidecar_text(object_key, image_bytes, result):
+    # OCR output for the sidecar of a document its labels already decided.
+    # Only local checks run on the text, and the classification stands
+    # whatever happens here.
+    if not can_detect_sync(object_key, image_bytes):
+        return
     try:
-        s3.copy_object(
-            Bucket=destination_bucket,
-            CopySource={'Bucket': bucket_name, 'Key': object_key},
-            Key=destination_key
-        )
-        LOG.info(f"File copied to S3 bucket: {destination_bucket}/{destination_key}")
-
-        # Delete the original object from docs-landing-bucket
-        s3.delete_object(
-            Bucket=bucket_name,
-            Key=object_key
-        )
-        LOG.info(f"Original object deleted from S3 bucket: {bucket_name}/{object_key}")
+        with stage('sidecar_ocr'):
+            blocks = detect_text_sync(image_bytes)
+    except Exception as e:
+        LOG.warning(f"Could not read the text of {object_key} for its sidecar: {str(e)}")
+        return
+    text = get_line_text(blocks)
+    result["ocr_pages"] = [page_record(blocks, text, detect_local_entities(text, RULES.match_hints(text)))]
+
+def classify_pages(pages, result):
+    # Classify each page as its blocks arrive. Fetching stops at the first
+    # page with a Govt ID entity, so later pages are never read or sent to Comprehend.
+    # Pages without ID keywords are only sent to Comprehend, together in one
+    # pass, if no page qualifies.
+    document_metrics = current()
+
+    def classify_page(page):
+        page_number, blocks = page
+        with bind(document_metrics):
+            return page_number, blocks, classify_blocks(blocks, {}, hinted_only=True)
+
+    found = []
+    errors = []
+    unchecked_blocks = []
+    unchecked_pages = []
+    ocr_pages = []
+    traces = []
+
+    def collect(done):
+        for future in done:
+            page_number, blocks, page_result = future.result()
+            ocr_pages.extend(page_result.get("ocr_pages", []))
+            traces.append((page_number, page_result["decision_trace"]))
+            if page_result.get("unchecked"):
+                unchecked_blocks.extend(blocks)
+                unchecked_pages.append(page_number)
+            if page_result.get("error_message"):
+                errors.append(f"page {page_number}: {page_result['error_message']}")
+            if page_result["outcome"] in ("valid", "valid-passport"):
+                found.append((page_number, page_result))
+
+    result["pages_read"] = 0
+    pending = set()
+    with ThreadPoolExecutor(max_workers=max(1, PAGE_MAX_WORKERS)) as executor:
+        try:
+            for page in pages:
+                result["pages_read"] += 1
+                pending.add(executor.submit(classify_page, page))
+                if len(pending) >= PAGE_MAX_WORKERS:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                if found:
+                    break
+            while pending and not found:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        finally:
+            for future in pending:
+                future.cancel()
+            if hasattr(pages, 'close'):
+                pages.close()
+    result["ocr_pages"] = sorted(ocr_pages, key=lambda page: page["page"])
+    trace = result.setdefault("decision_trace", [])
+    for page_number, steps in sorted(traces, key=lambda item: item[0]):
+        trace.extend(dict(step, page=page_number) for step in steps)
+
+    if not found and unchecked_blocks:
+        unchecked_blocks.sort(key=lambda block: block.get('Page', 1))
+        page_result = classify_blocks(unchecked_blocks, {})
+        trace.extend(dict(step, pages=sorted(unchecked_pages)) for step in page_result["decision_trace"])
+        # Found in the text of several pages, so only kept at document level
+        result["ocr_entities"] = [entity for page in page_result["ocr_pages"] for entity in page["entities"]]
+        if page_result.get("error_message"):
+            errors.append(page_result["error_message"])
+        if page_result["outcome"] in ("valid", "valid-passport"):
+            LOG.info(f"Found Govt ID in the pages without ID keywords after reading {result['pages_read']} pages")
+            result["outcome"] = page_result["outcome"]
+            result["entity_types"] = page_result["entity_types"]
+            return result
+
+    if found:
+        page_number, page_result = min(found, key=lambda item: item[0])
+        LOG.info(f"Found Govt ID on page {page_number} after reading {result['pages_read']} pages")
+        result["outcome"] = page_result["outcome"]
+        result["entity_types"] = page_result["entity_types"]
+        result["id_page"] = page_number
+        return result
+
+    result["outcome"] = "invalid"
+    if errors:
+        result["error_message"] = "; ".join(errors)
+    return result
+
+def classify_document(bucket_name, object_key, digest, result):
+    # PDF and TIFF files can have many pages, so they always use an async Textract job
+    try:
+        if notifications_enabled():
+            result["job_id"] = start_text_detection_with_notification(bucket_name, object_key, digest=digest)
+            result["outcome"] = "pending"
+            return result
 
+        result["job_id"] = start_text_detection(bucket_name, object_key)
+        result = classify_pages(iter_text_pages(result["job_id"]), result)
     except Exception as e:
-        LOG.error(f"Error copying or deleting file: {str(e)}")
-
-def process_pii_offsets(text):
-    comprehend_client = boto3.client('comprehend')
-
-    # Detect PII entities in the text using PII offsets
-    pii_entities_response = comprehend_client.detect_pii_entities(Text=text, LanguageCode='en')
-    entities = [] 
-
-    if 'Entities' in pii_entities_response:
-        for entity in pii_entities_response['Entities']:            
-                pii_entity = {
-                    "Type": entity['Type'],
-                    "Score": entity['Score'],
-                    "BeginOffset": entity['BeginOffset'],
-                    "EndOffset": entity['EndOffset']
+        # A document Textract cannot read goes to the invalid bucket, like
+        # an unreadable image. Anything else fails the document.
+        if not is_document_error(e):
+            raise
+        LOG.error(f"Textract could not read {object_key}: {str(e)}")
+        result["outcome"] = "invalid"
+        result["error_message"] = str(e)
+        return result
+
+    cache_result(digest, result)
+    return result
+
+def sidecar_location(result):
+    # [bucket, key] of the sidecar route_results writes for the document
+    if not SIDECARS_ENABLED or result.get("outcome") not in DESTINATIONS:
+        return None
+    destination_bucket, destination_key = destination_for(result["outcome"], original_key(result["bucket"], result["key"]))
+    return [destination_bucket, sidecar_key(destination_key)]
+
+def cache_result(digest, result):
+    # Classifications affected by an error are not cached so a re-upload is analysed again
+    if "error_message" not in result:
+        RESULT_CACHE.put(digest, result["outcome"], result.get("entity_types"), sidecar=sidecar_location(result))
+
+def apply_cached_result(object_key, cached, result):
+    LOG.info(f"Result cache hit for {object_key}: {cached['outcome']}")
+    result["outcome"] = cached["outcome"]
+    result["entity_types"] = cached.get("entity_types", [])
+    result["cached"] = True
+    # The sidecar of the document the result was cached from has the OCR output
+    result["cached_sidecar"] = cached.get("sidecar")
+    result["decision_trace"].append(trace_step('cache', cached["outcome"]))
+    return result
+
+def process_record(record, s3):
+    s3_info = record.get('s3', {})
+    bucket_name = s3_info.get('bucket', {}).get('name')
+    object_key = s3_info.get('object', {}).get('key')
+
+    # Per-record result returned to lambda_handler
+    result = {
+        "bucket": bucket_name,
+        "key": object_key,
+        "size": s3_info.get('object', {}).get('size'),
+        "outcome": "invalid",
+        "decision_trace": []
+    }
+
+    LOG.info(f"File name is {object_key}")
+
+    # Check if the object is an image (jpg or png) or a scanned document (pdf or tiff)
+    if object_key.lower().endswith(IMAGE_EXTENSIONS + DOCUMENT_EXTENSIONS):
+        LOG.info(f"Processing image: {object_key}")
+        try:
+            with stage('download'):
+                response = s3.get_object(Bucket=bucket_name, Key=object_key)
+                image_bytes = response['Body'].read()
+            add_bytes('downloaded', len(image_bytes))
+
+            # Duplicate uploads are routed straight from the cached classification
+            digest = content_digest(image_bytes)
+            cached = RESULT_CACHE.get(digest)
+            if cached is not None:
+                return apply_cached_result(object_key, cached, result)
+
+            if object_key.lower().endswith(DOCUMENT_EXTENSIONS):
+                # Rekognition only reads images, documents go straight to Textract
+                if sniff_format(image_bytes) not in ('pdf', 'tiff'):
+                    LOG.info(f"Rejected {object_key}: content is not a PDF or TIFF file")
+                    cache_result(digest, result)
+                    return result
+                return classify_document(bucket_name, object_key, digest, result)
+
+            if IMAGE_PREPROCESSING:
+                try:
+                    with stage('preprocess'):
+                        preprocessed = preprocess_image(image_bytes)
+                except InvalidImageError as e:
+                    LOG.info(f"Rejected {object_key} before calling Rekognition: {str(e)}")
+                    cache_result(digest, result)
+                    return result
+
+                image_bytes = preprocessed["bytes"]
+                result["preprocessing"] = {
+                    "processed": preprocessed["processed"],
+                    "bytes_saved": preprocessed["bytes_saved"],
+                    "elapsed_ms": preprocessed["elapsed_ms"]
                 }
-                entities.append(pii_entity)
-    return entities
-
-def process_pii_labels(text):
-    comprehend_client = boto3.client('comprehend')
+                LOG.info(f"Preprocessed {object_key}: {result['preprocessing']}")
 
+            # Call the method to process the image with Rekognition
+            try:
+                with stage('rekognition'):
+                    rekognition_labels = process_image_with_rekognition(image_bytes)
+            except InvalidImageError as e:
+                # Not cached, the image may be readable after preprocessing changes
+                LOG.info(f"Rejected {object_key}: {str(e)}")
+                result["error_message"] = str(e)
+                return result
+
+            # Labels are the cheapest rules, they can decide the document
+            # before Textract and Comprehend are called
+            decision = RULES.check_labels(rekognition_labels, result["decision_trace"])
+            LOG.info(f"Rekognition label rules decided {decision}: {result['decision_trace'][-1]}")
+
+            if decision == READ_TEXT:
+                # Call Amazon Textract
+                LOG.info("Valid Labels found, calling Textract")
+
+                try:
+                    # Documents that need an async job finish in textract_completion_handler
+                    if notifications_enabled() and not can_detect_sync(object_key, image_bytes):
+                        result["job_id"] = start_text_detection_with_notification(bucket_name, object_key, digest=digest)
+                        result["outcome"] = "pending"
+                        return result
+
+                    # Single-page images use the synchronous API on the bytes already downloaded
+                    blocks = detect_text(bucket_name, object_key, image_bytes)
+                except Exception as e:
+                    # Images Textract cannot read, e.g. a bad or too large
+                    # document, go to the invalid bucket. Anything else fails
+                    # the document so it is retried.
+                    if not is_document_error(e):
+                        raise
+                    LOG.error(f"Textract could not read {object_key}: {str(e)}")
+                    result["error_message"] = str(e)
+                    return result
+
+                result = classify_blocks(blocks, result)
+                cache_result(digest, result)
+                return result
+
+            else:
+                # e.g. a passport found with high confidence goes to the passport folder
+                result["outcome"] = decision
+                if decision != "invalid" and SIDECARS_ENABLED and SIDECAR_LABEL_OCR:
+                    read_sidecar_text(object_key, image_bytes, result)
+                cache_result(digest, result)
+
+        except Exception as e:
+            if isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') in ('NoSuchKey', 'NoSuchVersion'):
+                # Already moved by an earlier delivery of the same event, nothing to route
+                LOG.info(f"{object_key} no longer exists, skipping it")
+                result["outcome"] = "skipped"
+                return result
+            if is_throttled(e):
+                # Left in the landing bucket and retried, rather than classified without all the data
+                LOG.warning(f"Deferring {object_key}: {str(e)}")
+                result["outcome"] = "deferred"
+                result["error_message"] = str(e)
+                return result
+            # Anything else may be transient, the message is retried and
+            # ends up in the dead-letter queue if it keeps failing
+            LOG.error(f"Error processing {object_key}: {str(e)}")
+            result["outcome"] = "error"
+            result["error_message"] = str(e)
+    else:
+        LOG.info("Document is not in desired format. Skipping processing.")
+
+    return result
+
+def process_record_safely(record, s3):
+    # Keep one bad record from failing the rest of the batch
     try:
-        # Detect PII entities in the text using Comprehend
-        pii_entities_response = comprehend_client.contains_pii_entities(Text=text, LanguageCode='en')
-        entities = []        
-
-        if 'Labels' in pii_entities_response:
-            for label in pii_entities_response['Labels']:                    
-                    pii_entity = {
-                        "Name": label['Name'],
-                        "Score": label['Score']
-                    }
-                    entities.append(pii_entity)
-
-        return entities
+        return process_record(record, s3)
+    except Exception as e:
+        s3_info = record.get('s3', {})
+        LOG.error(f"Unexpected error processing record: {str(e)}")
+        return {
+            "bucket": s3_info.get('bucket', {}).get('name'),
+            "key": s3_info.get('object', {}).get('key'),
+            "outcome": "error",
+            "error_message": str(e)
+        }
 
+def route_results(results, s3):
+    # Every classified document is copied once to its destination and the
+    # sources are deleted in bulk. Errors, pending and deferred documents stay in place.
+    router = Router(s3, max_workers=MAX_CONCURRENCY)
+    # Sidecars by location, so that a cache hit on a document routed in this
+    # invocation takes its sidecar from memory rather than copying one not written yet
+    sidecars = {}
+    if SIDECARS_ENABLED:
+        for result in results:
+            if result.get("outcome") in DESTINATIONS:
+                sidecars[tuple(sidecar_location(result))] = build_sidecar(result)
+    for result in results:
+        if result.get("outcome") in DESTINATIONS:
+            sidecar = sidecar_source = None
+            if SIDECARS_ENABLED:
+                location = tuple(sidecar_location(result))
+                sidecar = sidecars[location]
+                sidecar_source = tuple(result.get("cached_sidecar") or ()) or None
+                if sidecar_source in sidecars and sidecar_source != location:
+                    sidecar, sidecar_source = reuse_ocr(sidecar, sidecars[sidecar_source]), None
+                sidecar = encode_sidecar(sidecar)
+            router.route(result["bucket"], result["key"], result["outcome"], result.get("size"), sidecar, sidecar_source)
+        # OCR output only goes to the sidecar, not into the response
+        result.pop("ocr_pages", None)
+        result.pop("ocr_entities", None)
+        result.pop("cached_sidecar", None)
+
+    failures = router.flush()
+    for result in results:
+        error = failures.get((result.get("bucket"), result.get("key")))
+        if error:
+            result["routing_error"] = error
+    return results
+
+def notify_results(results):
+    # One message per routed document, buffered and sent in batches once
+    # the whole invocation has been routed
+    notifier = create_notifier()
+    if not notifier.sinks:
+        return
+    for result in results:
+        if result.get("outcome") in DESTINATIONS and not result.get("routing_error"):
+            destination = destination_for(result["outcome"], original_key(result["bucket"], result["key"]))
+            notifier.add(result_message(result, destination))
+    # Every message goes to each sink, and unsent counts them per sink
+    total = len(notifier) * len(notifier.sinks)
+    unsent = notifier.flush()
+    LOG.info(f"Sent {total - unsent} of {total} result notifications to {len(notifier.sinks)} sinks")
+
+def run_concurrently(fn, items):
+    # Process up to MAX_CONCURRENCY items at a time
+    max_workers = max(1, min(MAX_CONCURRENCY, len(items)))
+    if max_workers == 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(fn, items))
+
+def expand_records(records):
+    # S3 notifications arrive either directly or wrapped in SQS messages.
+    # Returns (SQS message id or None, S3 record) pairs and the ids of
+    # messages that could not be read.
+    s3_records = []
+    unreadable = []
+    for record in records:
+        if record.get('eventSource') != 'aws:sqs':
+            s3_records.append((None, record))
+            continue
+        try:
+            body = json.loads(record['body'])
+        except (KeyError, ValueError) as e:
+            LOG.error(f"Unreadable SQS message {record.get('messageId')}: {str(e)}")
+            unreadable.append(record.get('messageId'))
+            continue
+        # S3 sends a test event when the notification is first configured
+        if not isinstance(body, dict):
+            LOG.error(f"Unreadable SQS message {record.get('messageId')}: body is not a JSON object")
+            unreadable.append(record.get('messageId'))
+            continue
+        if body.get('Event') == 's3:TestEvent':
+            continue
+        for s3_record in body.get('Records', []):
+            s3_records.append((record['messageId'], s3_record))
+    return s3_records, unreadable
+
+def batch_item_failures(results, unreadable):
+    # SQS messages to retry, an error, a throttled API or a failed move of
+    # any document in a message sends the whole message back to the queue
+    failed = list(unreadable)
+    for result in results:
+        message_id = result.get("message_id")
+        if message_id and message_id not in failed and (result.get("outcome") in ("error", "deferred") or result.get("routing_error")):
+            failed.append(message_id)
+    return [{"itemIdentifier": message_id} for message_id in failed]
+
+def measured(fn, *args):
+    # Run fn with its own DocumentMetrics and attach the figures to the result
+    document_metrics = DocumentMetrics()
+    with bind(document_metrics):
+        with document_metrics.stage('total'):
+            result = fn(*args)
+    result["timings_ms"] = document_metrics.timings
+    result["api_calls"] = document_metrics.api_calls
+    result["bytes"] = document_metrics.bytes
+    return result
+
+def emit_metrics(results, invocation_metrics):
+    bytes_moved = sum(result.get("size") or 0 for result in results
+                      if result.get("outcome") in DESTINATIONS and not result.get("routing_error"))
+    emit(invocation_record(results, invocation_metrics.timings, bytes_moved))
+    for result in results:
+        if should_sample():
+            emit(document_record(result))
+
+def once(key, identity, fn, *args):
+    # Runs fn unless another delivery of the same event has completed or is
+    # still running, in which case that delivery's record is returned instead
+    if key is None:
+        return fn(*args)
+    try:
+        token, previous = IDEMPOTENCY.claim(key)
     except Exception as e:
-        print(f"Error processing PII labels with Comprehend: {str(e)}")
-        return []
-            
-def lambda_handler(event, context):    
-    # Define the S3 bucket names
-    DOCS_LANDING_BUCKET = 'docs-landing-bucket'
-    VALID_DOCS_BUCKET = 'valid-docs-bucket'
-    INVALID_DOCS_BUCKET = 'invalid-docs-bucket'
+        LOG.error(f"Error claiming event {key}, processing it anyway: {str(e)}")
+        return fn(*args)
+
+    if token is None:
+        LOG.info(f"Duplicate delivery of {identity}, the event is {previous['status']}")
+        return dict(identity, outcome="duplicate", original=previous.get("result"),
+                    in_progress=previous["status"] != COMPLETED)
+
+    result = fn(*args)
+    result["idempotency_key"] = key
+    result["idempotency_token"] = token
+    return result
+
+def settle_events(results):
+    # Called after routing: events that were fully handled are recorded as
+    # completed, failed ones are released so that a retry processes them again
+    for result in results:
+        token = result.pop("idempotency_token", None)
+        if not token:
+            continue
+        key = result["idempotency_key"]
+        try:
+            if result.get("outcome") in ("error", "deferred") or result.get("routing_error"):
+                IDEMPOTENCY.release(key, token)
+            else:
+                IDEMPOTENCY.complete(key, token, {
+                    "outcome": result["outcome"],
+                    "entity_types": result.get("entity_types", []),
+                    "job_id": result.get("job_id")
+                })
+        except Exception as e:
+            LOG.error(f"Error recording event {key}: {str(e)}")
+
+def s3_identity(record):
+    s3_info = record.get('s3', {})
+    return {
+        "bucket": s3_info.get('bucket', {}).get('name'),
+        "key": s3_info.get('object', {}).get('key')
+    }
+
+def process_message_record(item, s3):
+    message_id, record = item
+    result = measured(once, s3_event_key(record), s3_identity(record), process_record_safely, record, s3)
+    if message_id:
+        result["message_id"] = message_id
+    return result
+
+def lambda_handler(event, context):
+    global _cold_start
+    cold_start = _cold_start
+    _cold_start = False
 
     # Define the S3 client
-    s3 = boto3.client('s3')
+    s3 = get_client('s3')
 
     # Extract S3 bucket, key, and file name from the incoming event
     records = event.get('Records', [])
@@ -183,163 +647,117 @@ def lambda_handler(event, context):
             "error_message": "No records found in the event"
         }
 
-    for record in records:
-        s3_info = record.get('s3', {})
-        bucket_name = s3_info.get('bucket', {}).get('name')
-        object_key = s3_info.get('object', {}).get('key')
+    s3_records, unreadable = expand_records(records)
+    invocation_metrics = DocumentMetrics()
+    results = run_concurrently(lambda item: process_message_record(item, s3), s3_records)
+    with invocation_metrics.stage('routing'):
+        route_results(results, s3)
+    settle_events(results)
+    with invocation_metrics.stage('notify'):
+        notify_results(results)
+    emit_metrics(results, invocation_metrics)
+
+    if cold_start:
+        LOG.info(f"Cold start client init stats: {get_init_stats()}")
+    LOG.info(f"Result cache stats: {RESULT_CACHE.stats()}")
+    LOG.info(f"Rate limiter stats: {LIMITER.stats()}")
+
+    return {
+        "results": results,
+        "timings_ms": invocation_metrics.timings,
+        "batchItemFailures": batch_item_failures(results, unreadable)
+    }
+
+def process_completion(sns_record):
+    message = parse_completion_message(sns_record)
+    bucket_name = message["bucket"]
+    object_key = message["key"]
+
+    result = {
+        "bucket": bucket_name,
+        "key": object_key,
+        "job_id": message["job_id"],
+        "outcome": "invalid",
+        "decision_trace": []
+    }
+
+    # Ignore jobs that were not started by start_text_detection_with_notification
+    if not decode_job_tag(message["job_tag"])[0]:
+        LOG.info(f"Skipping Textract job {message['job_id']} with JobTag {message['job_tag']}")
+        result["outcome"] = "skipped"
+        return result
+
+    if message["status"] != 'SUCCEEDED':
+        # Textract could not read the document, it goes to the invalid bucket
+        LOG.error(f"Textract job {message['job_id']} finished with status {message['status']}")
+        result["error_message"] = f"Textract job finished with status {message['status']}"
+        return result
 
-        LOG.info(f"File name is {object_key}")
+    try:
+        # The job has finished, so this only pages through the results,
+        # stopping at the first page with a Govt ID
+        result = classify_pages(iter_text_pages(message["job_id"]), result)
+        if message["digest"]:
+            cache_result(message["digest"], result)
+        return result
 
-        # Check if the object is an image (jpg or png)
-        if object_key.lower().endswith(('.jpg', '.jpeg', '.png')):
-            LOG.info(f"Processing image: {object_key}")
-            try:
-                LOG.info("Starting Rekognition:")
-                response = s3.get_object(Bucket=bucket_name, Key=object_key)
-                image_bytes = response['Body'].read()
-                
-                # Call the method to process the image with Rekognition
-                rekognition_labels = process_image_with_rekognition(image_bytes)
-
-                LOG.info("Detected Rekognition labels:")
-                valid_labels = ['Text', 'Person', 'Face', 'Head', 'QR Code', 'Document', 'Id Cards','Passport']
-                min_confidence = 50.0  # Minimum confidence threshold in percentage
-
-                # Set a default destination_bucket value
-                destination_bucket = 'invalid-docs-bucket'
-                destination_key = f"invalid-docs-folder/{object_key}"
-
-                valid_label_found = False
-                for label in rekognition_labels:
-                    if label['Name'] in valid_labels and label['Confidence'] >= min_confidence:
-                        LOG.info(f"Label: {label['Name']}, Confidence: {label['Confidence']}")
-                        valid_label_found = True
-
-                    if label['Name'] == 'Passport' and label['Confidence'] >= 90:
-                        LOG.info("Found 'Passport' with high confidence. Valid Govt ID.")
-                        print("Found 'Passport' with high confidence. Valid Govt ID.")
-
-                        # Move the document to the valid-docs-bucket under passport folder
-                        move_to_valid_passport_bucket(bucket_name, object_key, s3)
-                        break    
-                
-                if valid_label_found and not (valid_label_found and label['Name'] == 'Passport' and label['Confidence'] >= 90):
-                    # Call Amazon Textract
-                    LOG.info("Valid Labels found, calling Textract")
-                    textract_client = boto3.client('textract')
-                    response = None  # Initialize response with a default value
-
-                    try:
-                        response = textract_client.start_document_text_detection(
-                            DocumentLocation={"S3Object": {"Bucket": bucket_name, "Name": object_key}}
-                        )
-                        job_id = response['JobId']
-                        LOG.info(f"Textract job started with JobId: {job_id}")
-                    except textract_client.exceptions.UnsupportedDocumentException as e:
-                        LOG.error(f"Error copying or deleting file: {str(e)}")
-
-                        move_to_invalid_bucket(bucket_name, object_key, s3)
-                        return {
-                            "error_message": "Unsupported document format"
-                        }
-                    except textract_client.exceptions.InvalidS3ObjectException as e:
-                        LOG.error(f"Unsupported Format/Object type detected. Textract can't process the File. Please try with a new file: {str(e)}")
-                        
-                        #LOG.info(f"Moving the file to invalid-docs")
-                        # Move the file to the invalid-docs-bucket
-                        move_to_invalid_bucket(bucket_name, object_key, s3)
-                        return {
-                            "error_message": "Invalid S3 object for textract"
-                        }
-
-                    if response is not None:
-                        # Wait for Textract job to complete and get results
-                        textract_results = get_textract_results(job_id)
-                        
-                        # Extract text blocks from Textract results
-                        blocks = textract_results["Blocks"]
-                        text_blocks = [block for block in blocks if block["BlockType"] == "LINE"]
-
-                        # Extract text from text blocks
-                        text = ' '.join([block["Text"] for block in text_blocks])
-
-                        LOG.info("Extracted Textract Text passing to Comprehend %s", text)
-                        # Process extracted text using Amazon Comprehend
-                        comprehend_results = process_comprehend(text)
-
-                        try:
-                             LOG.info("Extracted Textract Text passing to check Driving License: %s", text)
-                             # Process extracted text using Amazon Comprehend
-
-                             words = text.split()
-                             print("Individual words in the text:")
-                             for word in words:
-                                  print(word)                             
-
-                             if "Driving" in words and "Licence" in words:
-                                 LOG.info("Found 'Driving License' text. Using Comprehend PII offset analysis.")
-                                 comprehend_results = process_pii_offsets(text)
-                                 print("Comprehend results:", comprehend_results)
-
-                             elif "Aadhaar" in words:
-                                 LOG.info("Found 'Aadhaar' text. Using Comprehend PII label analysis.")
-                                 comprehend_results = process_pii_labels(text)
-                                 print("Comprehend results:", comprehend_results)
-
-                             elif "Permanent" in words and "Account" in words and "Number" in words:
-                                 LOG.info("Found 'PAN' text. Using Comprehend PII label analysis.")
-                                 comprehend_results = process_pii_offsets(text)
-                                 print("Comprehend results:", comprehend_results)     
-
-                        except Exception as comprehend_error:
-                             LOG.error(f"Error while processing text with Comprehend: {str(comprehend_error)}")
-                             comprehend_results = []  # Set an empty result or handle the error as needed
-                             print("Error processing text with Comprehend:", comprehend_error)                                             
-
-                        # Check if any of the specified entities are identified in comprehend_results
-                        specified_entity_types = ['IN_AADHAAR', 'IN_PERMANENT_ACCOUNT_NUMBER', 'DRIVER_ID', 'PASSPORT_NUMBER']
-
-                        found_entity = False
-                        for entity in comprehend_results:
-                             if entity.get('Name') == 'IN_AADHAAR' or entity.get('Type') == 'DRIVER_ID' or entity.get('Type') == 'IN_PERMANENT_ACCOUNT_NUMBER':
-                                  LOG.info("Document is a valid Govt ID or it contains Govt ID data.")
-                                  print("Document is a valid Govt ID or it contains Govt ID data.")
-                                  found_entity = True
-                                  # Move the document to the valid-docs-bucket under passport folder
-                                  move_to_bucket(bucket_name, object_key, s3)
-                                  break
-                             if not found_entity:
-                                  LOG.info("No Valid Entity Type found.")
-                                  print("No Valid Entity Type found.")
-                                  # Move the file to the invalid-docs-bucket
-                                  move_to_invalid_bucket(bucket_name, object_key, s3)
-    
-                                  # Delete the original object from docs-landing-bucket
-                                  s3.delete_object(Bucket=bucket_name, Key=object_key)                    
-                            
-                    else:
-                        LOG.info("Document is not a valid Govt ID. Skipping processing.")
-                        print("Document is not a valid Govt ID. Skipping processing.")                       
-                        # Move the file to the invalid-docs-bucket
-                        move_to_invalid_bucket(bucket_name, object_key, s3)
-    
-                        # Delete the original object from docs-landing-bucket
-                        s3.delete_object(Bucket=bucket_name, Key=object_key)
-        
+    except Exception as e:
+        if is_throttled(e):
+            LOG.warning(f"Deferring Textract job {message['job_id']}: {str(e)}")
+            result["outcome"] = "deferred"
+            result["error_message"] = str(e)
+            return result
+        LOG.error(f"Error completing Textract job {message['job_id']}: {str(e)}")
+        result["outcome"] = "error"
+        result["error_message"] = str(e)
+        return result
+
+def process_completion_safely(sns_record):
+    # Keep one bad notification from failing the rest of the batch
+    try:
+        return process_completion(sns_record)
+    except Exception as e:
+        LOG.error(f"Unexpected error processing Textract notification: {str(e)}")
+        return {
+            "outcome": "error",
+            "error_message": str(e)
+        }
+
+def process_completion_once(sns_record):
+    try:
+        job_id = parse_completion_message(sns_record)["job_id"]
+    except Exception:
+        # process_completion reports the unreadable message
+        return process_completion_safely(sns_record)
+    return once(textract_job_key(job_id), {"job_id": job_id}, process_completion_safely, sns_record)
+
+def textract_completion_handler(event, context):
+    # Stage two: Textract published a job completion to SNS
+    s3 = get_client('s3')
+
+    records = event.get('Records', [])
+    if not records:
+        LOG.error("No records found in the event.")
+        return {
+            "error_message": "No records found in the event"
+        }
 
-            except Exception as e:
-                LOG.error(f"Document is not a valid jpg, png or jpeg format: {str(e)}")
-                # Move the file to the invalid-docs-bucket
-                move_to_invalid_bucket(bucket_name, object_key, s3)
-    
-                # Delete the original object from docs-landing-bucket
-                s3.delete_object(Bucket=bucket_name, Key=object_key)
-        else:
-            LOG.info("Document is not in desired format. Skipping processing.")
-            print("Document is not in desired format. Skipping processing.")                       
-            
-            # Move the file to the invalid-docs-bucket
-            move_to_invalid_bucket(bucket_name, object_key, s3)
-    
-            # Delete the original object from docs-landing-bucket
-            s3.delete_object(Bucket=bucket_name, Key=object_key)
+    invocation_metrics = DocumentMetrics()
+    results = run_concurrently(lambda record: measured(process_completion_once, record), records)
+    with invocation_metrics.stage('routing'):
+        route_results(results, s3)
+    settle_events(results)
+    with invocation_metrics.stage('notify'):
+        notify_results(results)
+    emit_metrics(results, invocation_metrics)
+    LOG.info(f"Rate limiter stats: {LIMITER.stats()}")
+
+    # SNS invokes asynchronously, so failing the invocation makes Lambda
+    # deliver the notification again later
+    deferred = [result.get("job_id") for result in results if result.get("outcome") in ("error", "deferred")]
+    if deferred:
+        raise Exception(f"Textract jobs failed or throttled, deferred: {deferred}")
+
+    return {
+        "results": results
+    }
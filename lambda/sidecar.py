@@ -0,0 +1,126 @@
+import gzip
+import json
+import os
+import time
+
+from botocore.exceptions import ClientError
+
+from clients import get_client
+
+# Version of the sidecar layout, bumped on incompatible changes
+SCHEMA_VERSION = 1
+# A routed document's sidecar is stored next to it under its key plus this suffix
+SIDECAR_SUFFIX = '.ocr.json.gz'
+# Write a sidecar for every routed document
+SIDECARS_ENABLED = os.environ.get('SIDECARS_ENABLED', 'true').lower() == 'true'
+
+def sidecar_key(object_key):
+    return f"{object_key}{SIDECAR_SUFFIX}"
+
+def is_sidecar_key(object_key):
+    return object_key.endswith(SIDECAR_SUFFIX)
+
+def _bbox(block):
+    box = block.get('Geometry', {}).get('BoundingBox')
+    if not box:
+        return None
+    return [round(box['Left'], 4), round(box['Top'], 4), round(box['Width'], 4), round(box['Height'], 4)]
+
+def _entity(entity):
+    # Comprehend labels have no offsets, local and Comprehend entities do
+    return {
+        "type": entity.get('Type') or entity.get('Name'),
+        "score": round(entity.get('Score', 0.0), 4),
+        "begin": entity.get('BeginOffset'),
+        "end": entity.get('EndOffset'),
+        "source": entity.get('Source', 'comprehend')
+    }
+
+def page_record(blocks, text, entities):
+    # One page of OCR output. text is the normalized text the entities were
+    # found in, and each line records where it starts in that text.
+    lines = []
+    offset = 0
+    for block in blocks:
+        if block["BlockType"] != "LINE":
+            continue
+        line_text = ' '.join(block["Text"].split())
+        offset = text.find(line_text, offset)
+        lines.append({
+            "text": line_text,
+            "offset": offset,
+            "confidence": round(block.get('Confidence', 0.0), 2),
+            "bbox": _bbox(block)
+        })
+        offset += len(line_text)
+    return {
+        "page": blocks[0].get('Page', 1) if blocks else 1,
+        "text": text,
+        "lines": lines,
+        "entities": [_entity(entity) for entity in entities]
+    }
+
+def build_sidecar(result):
+    # Everything downstream consumers need instead of running OCR again.
+    # Documents classified without Textract (cache hits, passports found by
+    # Rekognition, rejected files) have no pages.
+    return {
+        "schema_version": SCHEMA_VERSION,
+        "source": {"bucket": result["bucket"], "key": result["key"]},
+        "outcome": result["outcome"],
+        "entity_types": result.get("entity_types", []),
+        "id_page": result.get("id_page"),
+        "cached": bool(result.get("cached")),
+        "pages_read": result.get("pages_read", len(result.get("ocr_pages", []))),
+        "pages": result.get("ocr_pages", []),
+        "entities": result.get("ocr_entities", []),
+        "decision_trace": result.get("decision_trace", []),
+        "created_at": int(time.time())
+    }
+
+def reuse_ocr(sidecar, original):
+    # The sidecar of a cache hit: the OCR output of the upload the result was
+    # cached from, whose source is recorded as ocr_source
+    return dict(
+        sidecar,
+        id_page=original.get("id_page"),
+        pages_read=original.get("pages_read", 0),
+        pages=original.get("pages", []),
+        entities=original.get("entities", []),
+        ocr_source=original.get("ocr_source") or original["source"]
+    )
+
+def encode_sidecar(sidecar):
+    # Compact JSON, gzipped with a fixed mtime so equal sidecars are equal bytes
+    data = json.dumps(sidecar, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return gzip.compress(data, mtime=0)
+
+def decode_sidecar(data):
+    if data[:2] == b'\x1f\x8b':
+        data = gzip.decompress(data)
+    sidecar = json.loads(data)
+    if sidecar.get("schema_version", 0) > SCHEMA_VERSION:
+        raise ValueError(f"Sidecar schema version {sidecar.get('schema_version')} is newer than {SCHEMA_VERSION}")
+    return sidecar
+
+def read_sidecar(bucket_name, object_key, s3=None):
+    # Reader API for consumers: the sidecar of a document in the valid or
+    # invalid bucket, or None if it has none
+    s3 = s3 or get_client('s3')
+    try:
+        response = s3.get_object(Bucket=bucket_name, Key=sidecar_key(object_key))
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            return None
+        raise
+    return decode_sidecar(response['Body'].read())
+
+def entity_values(sidecar, entity_types=None):
+    # (type, text, score) for every entity with offsets, e.g. the ID number
+    values = []
+    for page in sidecar.get("pages", []):
+        for entity in page["entities"]:
+            if entity["begin"] is None or (entity_types and entity["type"] not in entity_types):
+                continue
+            values.append((entity["type"], page["text"][entity["begin"]:entity["end"]], entity["score"]))
+    return values
@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The Lambda modules import each other as top-level modules, as they do in
+# the deployed function, and the fakes come from the benchmarks
+sys.path[:0] = [os.path.join(ROOT, 'lambda'), os.path.join(ROOT, 'benchmarks')]
+
+# The handler reads its configuration from the environment at import time
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ['API_RATE_LIMITS'] = 'off'
+os.environ['THROTTLE_BACKOFF_BASE'] = '0'
+os.environ['TEXTRACT_POLL_INITIAL_DELAY'] = '0'
+for name in ('TEXTRACT_SNS_TOPIC_ARN', 'TEXTRACT_ROLE_ARN', 'RESULT_CACHE_TABLE', 'RESULT_CACHE_DIR',
+             'IDEMPOTENCY_TABLE', 'RESULT_TOPIC_ARN', 'RESULT_QUEUE_URL', 'RULES_CONFIG'):
+    os.environ.pop(name, None)
+
+LANDING_BUCKET = 'docs-landing-bucket'
+RESULT_TOPIC_ARN = 'arn:aws:sns:us-east-1:000000000000:results'
+
+@pytest.fixture
+def world(monkeypatch):
+    # Fake AWS services registered as the handler's clients, with a fresh
+    # result cache and idempotency store. Textract notifications are off.
+    import cache
+    import clients
+    import idempotency
+    import notify
+    import ocr
+    import s3event
+    from fakes import SimulationConfig, World
+
+    world = World(SimulationConfig(latency_scale=0, in_progress_cycles=0, seed=0))
+    for name, client in world.clients().items():
+        clients.set_client(name, client)
+    monkeypatch.setattr(s3event, 'RESULT_CACHE', cache.ResultCache([cache.LRUCacheBackend()], rules=s3event.RULES.fingerprint))
+    monkeypatch.setattr(s3event, 'IDEMPOTENCY', idempotency.MemoryIdempotencyStore())
+    monkeypatch.setattr(s3event, 'IMAGE_PREPROCESSING', False)
+    monkeypatch.setattr(ocr, 'TEXTRACT_SNS_TOPIC_ARN', None)
+    monkeypatch.setattr(ocr, 'TEXTRACT_ROLE_ARN', None)
+    monkeypatch.setattr(notify, 'RESULT_TOPIC_ARN', RESULT_TOPIC_ARN)
+    yield world
+    clients.reset_clients()
+
+@pytest.fixture
+def textract_notifications(monkeypatch):
+    import ocr
+    monkeypatch.setattr(ocr, 'TEXTRACT_SNS_TOPIC_ARN', 'arn:aws:sns:us-east-1:000000000000:textract')
+    monkeypatch.setattr(ocr, 'TEXTRACT_ROLE_ARN', 'arn:aws:iam::000000000000:role/textract')
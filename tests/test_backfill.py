@@ -0,0 +1,79 @@
+import json
+
+import backfill
+from conftest import LANDING_BUCKET
+from corpus import DOCUMENT_LABELS, document_body
+
+AADHAAR_PAGE = ["Government of India", "Aadhaar", "Name RAVI KUMAR", "2345 6789 0124"]
+FILLER_PAGE = ["Terms and conditions", "Page of an unrelated form"]
+
+def upload(world, bucket_name, key, pages):
+    document = {"key": key, "kind": 'document', "labels": DOCUMENT_LABELS, "pages": pages, "nonce": key}
+    world.upload(bucket_name, key, document_body(document), document)
+
+def run(*argv):
+    return backfill.run(backfill.parse_args(['--workers', '1', *argv]))
+
+def detect_labels_calls(world):
+    return len(world.recorder.durations['rekognition.detect_labels'])
+
+def test_objects_are_classified_and_moved(world, tmp_path):
+    upload(world, LANDING_BUCKET, 'a.jpg', [AADHAAR_PAGE])
+    upload(world, LANDING_BUCKET, 'b.jpg', [FILLER_PAGE])
+    checkpoint = run('--bucket', LANDING_BUCKET, '--checkpoint', str(tmp_path / 'checkpoint.json'))
+
+    assert checkpoint["complete"]
+    assert checkpoint["outcomes"] == {"valid": 1, "invalid": 1}
+    assert json.loads((tmp_path / 'checkpoint.json').read_text()) == checkpoint
+    assert ('valid-docs-bucket', 'valid-docs-folder/a.jpg') in world.objects
+    assert ('invalid-docs-bucket', 'invalid-docs-folder/b.jpg') in world.objects
+    assert not any(bucket == LANDING_BUCKET for bucket, _ in world.objects)
+
+def test_run_resumes_after_the_checkpoint(world, tmp_path):
+    # Invalid documents stay where they are, so a new listing still finds them
+    for key in ('a.jpg', 'b.jpg', 'c.jpg'):
+        upload(world, 'invalid-docs-bucket', f"invalid-docs-folder/{key}", [FILLER_PAGE])
+    path = str(tmp_path / 'checkpoint.json')
+    checkpoint = run('--bucket', 'invalid-docs-bucket', '--checkpoint', path, '--batch-size', '1', '--limit', '2')
+    assert not checkpoint["complete"]
+    assert checkpoint["start_after"] == 'invalid-docs-folder/b.jpg'
+    assert detect_labels_calls(world) == 2
+
+    checkpoint = run('--bucket', 'invalid-docs-bucket', '--checkpoint', path)
+    assert checkpoint["complete"]
+    assert checkpoint["processed"] == 3
+    assert detect_labels_calls(world) == 3
+
+    assert run('--bucket', 'invalid-docs-bucket', '--checkpoint', path)["processed"] == 3
+    assert detect_labels_calls(world) == 3
+
+def test_keys_file_resumes_by_line(world, tmp_path):
+    for key in ('a.jpg', 'b.jpg', 'c.jpg'):
+        upload(world, LANDING_BUCKET, key, [AADHAAR_PAGE])
+    keys = tmp_path / 'failed.jsonl'
+    keys.write_text('a.jpg\n{"key": "b.jpg", "outcome": "error"}\n\nc.jpg\n')
+    path = tmp_path / 'checkpoint.json'
+    path.write_text(json.dumps(dict(backfill.new_checkpoint(backfill.parse_args(
+        ['--bucket', LANDING_BUCKET, '--keys-from', str(keys)])), start_after=1)))
+
+    checkpoint = run('--bucket', LANDING_BUCKET, '--keys-from', str(keys), '--checkpoint', str(path))
+    assert checkpoint["complete"]
+    assert checkpoint["start_after"] == 4
+    assert (LANDING_BUCKET, 'a.jpg') in world.objects
+    assert ('valid-docs-bucket', 'valid-docs-folder/b.jpg') in world.objects
+    assert ('valid-docs-bucket', 'valid-docs-folder/c.jpg') in world.objects
+
+def test_dry_run_leaves_objects_in_place(world, tmp_path, capsys):
+    upload(world, LANDING_BUCKET, 'a.jpg', [AADHAAR_PAGE])
+    objects = dict(world.objects)
+    run('--bucket', LANDING_BUCKET, '--dry-run', '--checkpoint', str(tmp_path / 'checkpoint.json'))
+
+    assert world.objects == objects
+    assert world.messages == []
+    assert not (tmp_path / 'checkpoint.json').exists()
+    move, = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert move == {
+        "source": f"s3://{LANDING_BUCKET}/a.jpg",
+        "destination": "s3://valid-docs-bucket/valid-docs-folder/a.jpg",
+        "outcome": "valid"
+    }
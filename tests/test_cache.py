@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+import cache
+from cache import DirectoryCacheBackend, LRUCacheBackend, ResultCache
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, 'time', clock.time)
+    return clock
+
+def test_lru_entries_expire(clock):
+    backend = LRUCacheBackend(ttl_seconds=60)
+    backend.put('a', {"outcome": "valid"})
+    clock.now += 59
+    assert backend.get('a') == {"outcome": "valid"}
+    clock.now += 1
+    assert backend.get('a') is None
+    assert len(backend) == 0
+    assert backend.evictions == 1
+
+def test_lru_evicts_the_least_recently_used(clock):
+    backend = LRUCacheBackend(max_entries=2)
+    backend.put('a', 1)
+    backend.put('b', 2)
+    backend.get('a')
+    backend.put('c', 3)
+    assert backend.get('b') is None
+    assert (backend.get('a'), backend.get('c')) == (1, 3)
+    assert backend.evictions == 1
+
+def test_directory_entries_expire(clock, tmp_path):
+    backend = DirectoryCacheBackend(str(tmp_path), ttl_seconds=60)
+    backend.put('a', {"outcome": "valid"})
+    assert backend.get('a') == {"outcome": "valid"}
+    clock.now += 60
+    assert backend.get('a') is None
+    assert not (tmp_path / 'a.json').exists()
+
+def test_directory_evicts_the_oldest_writes(clock, tmp_path):
+    backend = DirectoryCacheBackend(str(tmp_path), max_entries=2)
+    for index, digest in enumerate(('a', 'b', 'c')):
+        backend.put(digest, index)
+        os.utime(tmp_path / f"{digest}.json", (index, index))
+    assert sorted(os.listdir(tmp_path)) == ['b.json', 'c.json']
+    assert backend.evictions == 1
+
+def test_hits_fill_earlier_backends_and_other_rules_miss(tmp_path):
+    memory = LRUCacheBackend()
+    directory = DirectoryCacheBackend(str(tmp_path))
+    ResultCache([directory], rules='v1').put('a', 'valid', ['IN_AADHAAR'])
+
+    result_cache = ResultCache([memory, directory], rules='v1')
+    assert result_cache.get('a')["entity_types"] == ['IN_AADHAAR']
+    assert memory.get('a')["outcome"] == 'valid'
+    assert ResultCache([directory], rules='v2').get('a') is None
+    assert result_cache.stats() == {"hits": 1, "misses": 0, "errors": 0}
+
+def test_only_final_outcomes_are_cached():
+    result_cache = ResultCache([LRUCacheBackend()])
+    result_cache.put('a', 'error')
+    result_cache.put('b', 'deferred')
+    assert result_cache.get('a') is None and result_cache.get('b') is None
@@ -0,0 +1,34 @@
+from detectors import detect_local_entities, verhoeff_valid
+
+AADHAAR_NUMBER = '2345 6789 0124'
+
+def test_verhoeff_checksum():
+    assert verhoeff_valid('234567890124')
+    assert verhoeff_valid('2363')
+    assert not verhoeff_valid('234567890125')
+    assert not verhoeff_valid('234567890142')
+
+def test_aadhaar_number_with_the_aadhaar_hint():
+    text = f"Aadhaar {AADHAAR_NUMBER}"
+    entity, = detect_local_entities(text, {'AADHAAR'})
+    assert entity["Type"] == 'IN_AADHAAR'
+    assert text[entity["BeginOffset"]:entity["EndOffset"]] == AADHAAR_NUMBER
+
+def test_aadhaar_number_needs_the_hint():
+    assert detect_local_entities(f"Invoice {AADHAAR_NUMBER}", set()) == []
+    assert detect_local_entities(f"Invoice {AADHAAR_NUMBER}", {'PAN'}) == []
+
+def test_aadhaar_number_fails_the_checksum():
+    assert detect_local_entities("Aadhaar 2345 6789 0125", {'AADHAAR'}) == []
+
+def test_longer_digit_groups_are_not_aadhaar_numbers():
+    # 16 digit card numbers and 12 digits preceded or followed by another group
+    assert detect_local_entities(f"Aadhaar 4111 {AADHAAR_NUMBER}", {'AADHAAR'}) == []
+    assert detect_local_entities(f"Aadhaar {AADHAAR_NUMBER} 1111", {'AADHAAR'}) == []
+    assert detect_local_entities(f"Aadhaar {AADHAAR_NUMBER}1", {'AADHAAR'}) == []
+
+def test_other_documents_need_their_hints():
+    text = "ABCDE1234F MH14 20110062821 K1234567"
+    assert detect_local_entities(text, set()) == []
+    types = [entity["Type"] for entity in detect_local_entities(text, {'PAN', 'DRIVING_LICENCE', 'PASSPORT'})]
+    assert types == ['IN_PERMANENT_ACCOUNT_NUMBER', 'DRIVER_ID', 'PASSPORT_NUMBER']
@@ -0,0 +1,55 @@
+import idempotency
+from idempotency import COMPLETED, MemoryIdempotencyStore, s3_event_key
+
+def s3_record(key='id.jpg', version_id=None, sequencer=None):
+    object_info = {'key': key}
+    if version_id:
+        object_info['versionId'] = version_id
+    if sequencer:
+        object_info['sequencer'] = sequencer
+    return {'s3': {'bucket': {'name': 'docs-landing-bucket'}, 'object': object_info}}
+
+def test_event_key_identifies_one_delivery():
+    assert s3_event_key(s3_record(sequencer='01')) == s3_event_key(s3_record(sequencer='01'))
+    assert s3_event_key(s3_record(sequencer='01')) != s3_event_key(s3_record(sequencer='02'))
+    assert s3_event_key(s3_record(version_id='v1')) != s3_event_key(s3_record(version_id='v2'))
+    assert s3_event_key(s3_record()) is None
+
+def test_claim_complete_and_duplicate():
+    store = MemoryIdempotencyStore()
+    token, existing = store.claim('event')
+    assert token and existing is None
+
+    token_again, existing = store.claim('event')
+    assert token_again is None
+    assert existing["token"] == token
+
+    store.complete('event', token, {"outcome": "valid"})
+    token_again, existing = store.claim('event')
+    assert token_again is None
+    assert existing["status"] == COMPLETED
+    assert existing["result"] == {"outcome": "valid"}
+
+def test_released_claim_can_be_taken_again():
+    store = MemoryIdempotencyStore()
+    token, _ = store.claim('event')
+    store.release('event', 'another token')
+    assert store.claim('event')[0] is None
+    store.release('event', token)
+    assert len(store) == 0
+    assert store.claim('event')[0] is not None
+
+def test_expired_lease_is_taken_over(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(idempotency.time, 'time', lambda: now[0])
+    store = MemoryIdempotencyStore(lease_seconds=60)
+    token, _ = store.claim('event')
+    now[0] += 61
+    new_token, existing = store.claim('event')
+    assert new_token not in (None, token)
+    assert existing is None
+
+    # The first delivery lost its lease and must not record its result
+    store.complete('event', token, {"outcome": "valid"})
+    store.complete('event', new_token, {"outcome": "invalid"})
+    assert store.claim('event')[1]["result"] == {"outcome": "invalid"}
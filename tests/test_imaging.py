@@ -0,0 +1,70 @@
+import io
+import random
+
+import pytest
+
+import imaging
+from imaging import InvalidImageError, preprocess_image, sniff_format
+
+Image = pytest.importorskip('PIL.Image')
+
+def jpeg(width, height, orientation=None, noise=False, quality=95):
+    image = Image.new('RGB', (width, height), (200, 200, 200))
+    if noise:
+        rng = random.Random(1)
+        image.putdata([(rng.randrange(256), rng.randrange(256), rng.randrange(256)) for _ in range(width * height)])
+    exif = Image.Exif()
+    if orientation:
+        exif[imaging.ORIENTATION_TAG] = orientation
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=quality, exif=exif.tobytes())
+    return output.getvalue()
+
+def decoded(data):
+    return Image.open(io.BytesIO(data))
+
+def test_sniff_format():
+    assert sniff_format(b'\xff\xd8\xff\xe0rest') == 'jpeg'
+    assert sniff_format(b'%PDF-1.7') == 'pdf'
+    assert sniff_format(b'II*\x00') == 'tiff'
+    assert sniff_format(b'GIF89a') is None
+
+def test_rejects_content_that_is_not_an_image():
+    with pytest.raises(InvalidImageError):
+        preprocess_image(b'%PDF-1.7 not an image')
+
+def test_rejects_undecodable_image():
+    with pytest.raises(InvalidImageError):
+        preprocess_image(b'\xff\xd8\xff' + b'\x00' * 100, max_bytes=10)
+
+def test_small_upright_image_is_untouched():
+    data = jpeg(64, 32)
+    result = preprocess_image(data)
+    assert result["bytes"] is data
+    assert not result["processed"]
+    assert result["bytes_saved"] == 0
+
+def test_exif_orientation_is_applied():
+    # Orientation 6 means the camera was rotated 90 degrees
+    result = preprocess_image(jpeg(64, 32, orientation=6))
+    assert result["processed"]
+    assert decoded(result["bytes"]).size == (32, 64)
+
+def test_large_image_is_scaled_down():
+    result = preprocess_image(jpeg(400, 200), max_long_edge=100)
+    assert result["processed"]
+    assert decoded(result["bytes"]).size == (100, 50)
+
+def test_fit_lowers_quality_then_resolution(monkeypatch):
+    monkeypatch.setattr(imaging, 'MIN_LONG_EDGE', 50)
+    data = jpeg(200, 200, noise=True)
+    result = preprocess_image(data, max_bytes=len(data) // 8, max_long_edge=1000)
+    assert result["processed"]
+    assert len(result["bytes"]) <= len(data) // 8
+    assert max(decoded(result["bytes"]).size) < 200
+
+def test_fit_stops_at_the_minimum_long_edge(monkeypatch):
+    monkeypatch.setattr(imaging, 'MIN_LONG_EDGE', 150)
+    data = jpeg(200, 200, noise=True)
+    result = preprocess_image(data, max_bytes=100, max_long_edge=1000)
+    assert max(decoded(result["bytes"]).size) == 150
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+import notify
+import s3event
+from notify import MAX_BATCH_BYTES, MAX_BATCH_ENTRIES, ResultNotifier, batches
+
+class FlakySink:
+    # Each call returns the next of the given failures, or raises it
+    name = 'flaky'
+
+    def __init__(self, failures):
+        self.failures = list(failures)
+        self.calls = []
+
+    def send(self, entries):
+        self.calls.append([entry_id for entry_id, _ in entries])
+        failures = self.failures.pop(0) if self.failures else []
+        if isinstance(failures, Exception):
+            raise failures
+        return failures
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(notify.time, 'sleep', lambda seconds: None)
+
+def notifier(sink, count=3):
+    notifier = ResultNotifier([sink])
+    for index in range(count):
+        notifier.add({"key": f"doc-{index}", "outcome": "valid"})
+    return notifier
+
+def test_failed_entries_are_sent_again():
+    sink = FlakySink([[{'Id': '1', 'SenderFault': False}]])
+    assert notifier(sink).flush() == 0
+    assert sink.calls == [['0', '1', '2'], ['1']]
+
+def test_sender_faults_are_not_retried():
+    sink = FlakySink([[{'Id': '0', 'SenderFault': True, 'Code': 'InvalidParameter'}]])
+    assert notifier(sink).flush() == 1
+    assert sink.calls == [['0', '1', '2']]
+
+def test_gives_up_after_the_last_attempt(monkeypatch):
+    monkeypatch.setattr(notify, 'NOTIFY_MAX_ATTEMPTS', 2)
+    sink = FlakySink([RuntimeError('unavailable'), [{'Id': '2', 'SenderFault': False}]])
+    assert notifier(sink).flush() == 1
+    assert sink.calls == [['0', '1', '2'], ['0', '1', '2']]
+
+def test_batches_are_limited_in_entries_and_bytes():
+    assert [len(batch) for batch in batches(['{}'] * 25)] == [MAX_BATCH_ENTRIES, MAX_BATCH_ENTRIES, 5]
+    large = json.dumps({"text": 'x' * (MAX_BATCH_BYTES // 2)})
+    assert [len(batch) for batch in batches([large] * 3)] == [1, 1, 1]
+
+def test_unsent_messages_are_counted_per_sink(monkeypatch, caplog):
+    monkeypatch.setattr(notify, 'RESULT_TOPIC_ARN', 'arn:aws:sns:us-east-1:000000000000:results')
+    monkeypatch.setattr(notify, 'RESULT_QUEUE_URL', 'https://sqs.us-east-1.amazonaws.com/000000000000/results')
+    monkeypatch.setattr(notify.SnsSink, 'send', lambda self, entries: [])
+    monkeypatch.setattr(notify.SqsSink, 'send', lambda self, entries: [{'Id': '0', 'SenderFault': True}])
+    result = {"bucket": 'docs-landing-bucket', "key": 'id.jpg', "outcome": 'valid'}
+    with caplog.at_level('INFO'):
+        s3event.notify_results([result, dict(result, key='other.jpg')])
+    assert "Sent 3 of 4 result notifications to 2 sinks" in caplog.text
@@ -0,0 +1,44 @@
+import pii
+from fakes import FakeComprehend
+from pii import split_text
+
+def test_short_text_is_one_chunk():
+    assert split_text("Aadhaar 2345 6789 0124", max_bytes=100) == [(0, "Aadhaar 2345 6789 0124")]
+    assert split_text("", max_bytes=100) == []
+
+def test_chunks_start_at_their_offset_in_the_text():
+    text = "alpha beta gamma delta epsilon zeta eta theta"
+    chunks = split_text(text, max_bytes=12)
+    assert len(chunks) > 1
+    for offset, chunk in chunks:
+        assert len(chunk.encode('utf-8')) <= 12
+        assert text[offset:offset + len(chunk)] == chunk
+    assert ''.join(chunk for _, chunk in chunks) == text
+
+def test_long_tokens_are_split_on_character_boundaries():
+    text = "ab " + "é" * 10 + " cd"
+    chunks = split_text(text, max_bytes=6)
+    for offset, chunk in chunks:
+        assert len(chunk.encode('utf-8')) <= 6
+        assert text[offset:offset + len(chunk)] == chunk
+    assert ''.join(chunk for _, chunk in chunks) == text
+
+def test_entity_offsets_are_rebased_to_the_full_text(world, monkeypatch):
+    monkeypatch.setattr(pii, 'split_text', lambda text: split_text(text, max_bytes=40))
+    text = "Terms and conditions of the unrelated form " * 3 + "Number 2345 6789 0124"
+    entity, = pii.detect_pii_entities(text)
+    assert entity["Type"] == 'IN_AADHAAR'
+    assert text[entity["BeginOffset"]:entity["EndOffset"]] == '2345 6789 0124'
+
+def test_low_scores_neither_count_nor_stop_the_other_chunks(world, monkeypatch):
+    def detect(self, Text, LanguageCode):
+        score = 0.5 if 'blurred' in Text else 0.95
+        begin = Text.find('ID')
+        return {'Entities': [{'Type': 'IN_AADHAAR', 'Score': score, 'BeginOffset': begin, 'EndOffset': begin + 2}] if begin >= 0 else []}
+    monkeypatch.setattr(FakeComprehend, 'detect_pii_entities', detect)
+    monkeypatch.setattr(pii, 'split_text', lambda text: split_text(text, max_bytes=20))
+    text = "blurred ID number   " + "filler text here    " * 4 + "clear ID number"
+
+    entity, = pii.detect_pii_entities(text, stop_types=('IN_AADHAAR',), min_score=0.8)
+    assert entity["Score"] == 0.95
+    assert entity["BeginOffset"] == text.rindex('ID')
@@ -0,0 +1,285 @@
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+import s3event
+from conftest import LANDING_BUCKET
+from corpus import DOCUMENT_LABELS, document_body
+from fakes import FakeComprehend, FakeRekognition, FakeTextract
+from sidecar import decode_sidecar
+
+AADHAAR_PAGE = ["Government of India", "Aadhaar", "Name RAVI KUMAR", "2345 6789 0124"]
+PAN_PAGE = ["INCOME TAX DEPARTMENT", "Permanent Account Number", "ABCDE1234F"]
+UNLABELLED_AADHAAR_PAGE = ["Name RAVI KUMAR", "2345 6789 0124"]
+FILLER_PAGE = ["Terms and conditions", "Page of an unrelated form"]
+
+def upload(world, key, pages, labels=DOCUMENT_LABELS, nonce=None):
+    document = {"key": key, "kind": 'document', "labels": labels, "pages": pages, "nonce": nonce or key}
+    world.upload(LANDING_BUCKET, key, document_body(document), document)
+    return document
+
+def sqs_event(*keys, sequencer='0001'):
+    records = []
+    for index, key in enumerate(keys):
+        s3_event = {'Records': [{
+            's3': {
+                'bucket': {'name': LANDING_BUCKET},
+                'object': {'key': key, 'size': 10, 'sequencer': f"{sequencer}{index:04d}"}
+            }
+        }]}
+        records.append({'eventSource': 'aws:sqs', 'messageId': f"msg-{key}", 'body': json.dumps(s3_event)})
+    return {'Records': records}
+
+def client_error(code, operation):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+def test_image_is_classified_routed_and_published(world):
+    upload(world, 'id.jpg', [AADHAAR_PAGE])
+    response = s3event.lambda_handler(sqs_event('id.jpg'), None)
+
+    result, = response["results"]
+    assert result["outcome"] == "valid"
+    assert result["entity_types"] == ['IN_AADHAAR']
+    assert response["batchItemFailures"] == []
+    assert ('valid-docs-bucket', 'valid-docs-folder/id.jpg') in world.objects
+    assert (LANDING_BUCKET, 'id.jpg') not in world.objects
+
+    sidecar = decode_sidecar(world.objects[('valid-docs-bucket', 'valid-docs-folder/id.jpg.ocr.json.gz')])
+    assert sidecar["pages"][0]["entities"][0]["type"] == 'IN_AADHAAR'
+    message, = [json.loads(message) for message in world.messages]
+    assert message["destination"] == 's3://valid-docs-bucket/valid-docs-folder/id.jpg'
+    assert message["document_type"] == 'aadhaar'
+
+def test_pdf_finishes_through_the_textract_completion(world, textract_notifications):
+    upload(world, 'scan.pdf', [FILLER_PAGE, PAN_PAGE, FILLER_PAGE])
+    response = s3event.lambda_handler(sqs_event('scan.pdf'), None)
+
+    result, = response["results"]
+    assert result["outcome"] == "pending"
+    assert (LANDING_BUCKET, 'scan.pdf') in world.objects
+    assert len(world.completions) == 1
+
+    response = s3event.textract_completion_handler({'Records': world.completions}, None)
+    result, = response["results"]
+    assert result["outcome"] == "valid"
+    assert result["id_page"] == 2
+    assert result["entity_types"] == ['IN_PERMANENT_ACCOUNT_NUMBER']
+    assert ('valid-docs-bucket', 'valid-docs-folder/scan.pdf') in world.objects
+    assert (LANDING_BUCKET, 'scan.pdf') not in world.objects
+    assert {step.get("page") for step in result["decision_trace"]} >= {1, 2}
+
+def test_new_content_under_the_same_key_gets_its_own_textract_job(world, textract_notifications):
+    upload(world, 'scan.pdf', [PAN_PAGE], nonce='first')
+    first, = s3event.lambda_handler(sqs_event('scan.pdf', sequencer='0001'), None)["results"]
+    upload(world, 'scan.pdf', [FILLER_PAGE], nonce='second')
+    second, = s3event.lambda_handler(sqs_event('scan.pdf', sequencer='0002'), None)["results"]
+
+    assert first["job_id"] != second["job_id"]
+    assert len(world.completions) == 2
+
+def test_completion_delivered_twice_is_processed_once(world, textract_notifications):
+    upload(world, 'scan.pdf', [PAN_PAGE])
+    s3event.lambda_handler(sqs_event('scan.pdf'), None)
+    s3event.textract_completion_handler({'Records': world.completions}, None)
+    result, = s3event.textract_completion_handler({'Records': world.completions}, None)["results"]
+    assert result["outcome"] == "duplicate"
+
+def test_repeated_s3_notification_is_absorbed(world):
+    upload(world, 'id.jpg', [AADHAAR_PAGE])
+    s3event.lambda_handler(sqs_event('id.jpg'), None)
+    result, = s3event.lambda_handler(sqs_event('id.jpg'), None)["results"]
+    assert result["outcome"] == "duplicate"
+    assert result["original"]["outcome"] == "valid"
+
+def test_transient_error_is_retried_and_not_routed(world, monkeypatch):
+    def unavailable(self, Document):
+        raise client_error('InternalServerError', 'DetectDocumentText')
+    monkeypatch.setattr(FakeTextract, 'detect_document_text', unavailable)
+    upload(world, 'id.jpg', [AADHAAR_PAGE])
+    response = s3event.lambda_handler(sqs_event('id.jpg'), None)
+
+    result, = response["results"]
+    assert result["outcome"] == "error"
+    assert response["batchItemFailures"] == [{"itemIdentifier": "msg-id.jpg"}]
+    assert (LANDING_BUCKET, 'id.jpg') in world.objects
+
+def test_rekognition_error_is_not_cached(world, monkeypatch):
+    upload(world, 'id.jpg', [AADHAAR_PAGE])
+    with monkeypatch.context() as patch:
+        def unavailable(self, Image, **kwargs):
+            raise client_error('InternalServerError', 'DetectLabels')
+        patch.setattr(FakeRekognition, 'detect_labels', unavailable)
+        result, = s3event.lambda_handler(sqs_event('id.jpg', sequencer='0001'), None)["results"]
+    assert result["outcome"] == "error"
+
+    result, = s3event.lambda_handler(sqs_event('id.jpg', sequencer='0002'), None)["results"]
+    assert result["outcome"] == "valid"
+    assert not result.get("cached")
+
+def test_image_rekognition_rejects_is_invalid(world, monkeypatch):
+    def rejected(self, Image, **kwargs):
+        raise client_error('ImageTooLargeException', 'DetectLabels')
+    monkeypatch.setattr(FakeRekognition, 'detect_labels', rejected)
+    upload(world, 'big.jpg', [AADHAAR_PAGE])
+    response = s3event.lambda_handler(sqs_event('big.jpg'), None)
+    assert response["results"][0]["outcome"] == "invalid"
+    assert response["batchItemFailures"] == []
+
+def test_cache_hit_copies_the_original_sidecar(world):
+    document = upload(world, 'first.jpg', [AADHAAR_PAGE])
+    s3event.lambda_handler(sqs_event('first.jpg', sequencer='0001'), None)
+    world.upload(LANDING_BUCKET, 'copy.jpg', document_body(document), document)
+    result, = s3event.lambda_handler(sqs_event('copy.jpg', sequencer='0002'), None)["results"]
+
+    assert result["cached"]
+    sidecar = decode_sidecar(world.objects[('valid-docs-bucket', 'valid-docs-folder/copy.jpg.ocr.json.gz')])
+    assert sidecar["pages"][0]["entities"][0]["type"] == 'IN_AADHAAR'
+    assert sidecar["source"]["key"] == 'copy.jpg'
+    assert sidecar["ocr_source"]["key"] == 'first.jpg'
+    assert sidecar["cached"]
+
+def test_cache_hit_in_the_same_batch_takes_the_ocr_output(world, monkeypatch):
+    # One record at a time, so the second finds the first in the cache
+    monkeypatch.setattr(s3event, 'MAX_CONCURRENCY', 1)
+    document = upload(world, 'first.jpg', [AADHAAR_PAGE])
+    world.upload(LANDING_BUCKET, 'copy.jpg', document_body(document), document)
+    first, copy = s3event.lambda_handler(sqs_event('first.jpg', 'copy.jpg'), None)["results"]
+    assert copy["cached"]
+
+    sidecar = decode_sidecar(world.objects[('valid-docs-bucket', 'valid-docs-folder/copy.jpg.ocr.json.gz')])
+    assert sidecar["pages"][0]["entities"][0]["type"] == 'IN_AADHAAR'
+    assert sidecar["source"]["key"] == 'copy.jpg'
+    assert sidecar["ocr_source"]["key"] == 'first.jpg'
+
+def test_passport_decided_by_labels_has_text_in_its_sidecar(world):
+    labels = DOCUMENT_LABELS + [{'Name': 'Passport', 'Confidence': 96.0}]
+    upload(world, 'passport.jpg', [["REPUBLIC OF INDIA", "Passport", "K1234567"]], labels=labels)
+    result, = s3event.lambda_handler(sqs_event('passport.jpg'), None)["results"]
+
+    assert result["outcome"] == "valid-passport"
+    assert result["decision_trace"][0]["stage"] == 'labels'
+    sidecar = decode_sidecar(world.objects[('valid-docs-bucket', 'valid-docs-folder/passport/passport.jpg.ocr.json.gz')])
+    assert sidecar["pages"][0]["entities"][0]["type"] == 'PASSPORT_NUMBER'
+
+def test_message_body_that_is_not_an_object_is_unreadable(world):
+    upload(world, 'id.jpg', [AADHAAR_PAGE])
+    event = sqs_event('id.jpg')
+    event['Records'].append({'eventSource': 'aws:sqs', 'messageId': 'msg-list', 'body': '[]'})
+    response = s3event.lambda_handler(event, None)
+    assert response["results"][0]["outcome"] == "valid"
+    assert response["batchItemFailures"] == [{"itemIdentifier": "msg-list"}]
+
+def test_transient_comprehend_error_is_retried(world, monkeypatch):
+    contains_pii_entities = FakeComprehend.contains_pii_entities
+    failures = [client_error('InternalServerException', 'ContainsPiiEntities')]
+
+    def fails_once(self, Text, LanguageCode):
+        if failures:
+            raise failures.pop()
+        return contains_pii_entities(self, Text, LanguageCode)
+    monkeypatch.setattr(FakeComprehend, 'contains_pii_entities', fails_once)
+    upload(world, 'id.jpg', [UNLABELLED_AADHAAR_PAGE])
+    result, = s3event.lambda_handler(sqs_event('id.jpg'), None)["results"]
+    assert result["outcome"] == "valid"
+    assert not failures
+
+def test_comprehend_error_fails_the_document(world, monkeypatch):
+    def unavailable(self, Text, LanguageCode):
+        raise client_error('InternalServerException', 'ContainsPiiEntities')
+    monkeypatch.setattr(FakeComprehend, 'contains_pii_entities', unavailable)
+    upload(world, 'id.jpg', [UNLABELLED_AADHAAR_PAGE])
+    response = s3event.lambda_handler(sqs_event('id.jpg'), None)
+
+    assert response["results"][0]["outcome"] == "error"
+    assert response["batchItemFailures"] == [{"itemIdentifier": "msg-id.jpg"}]
+    assert (LANDING_BUCKET, 'id.jpg') in world.objects
+    assert not any(bucket == 'invalid-docs-bucket' for bucket, _ in world.objects)
+
+def test_text_comprehend_rejects_is_invalid(world, monkeypatch):
+    def rejected(self, Text, LanguageCode):
+        raise client_error('TextSizeLimitExceededException', 'ContainsPiiEntities')
+    monkeypatch.setattr(FakeComprehend, 'contains_pii_entities', rejected)
+    upload(world, 'id.jpg', [UNLABELLED_AADHAAR_PAGE])
+    response = s3event.lambda_handler(sqs_event('id.jpg'), None)
+
+    assert response["results"][0]["outcome"] == "invalid"
+    assert response["batchItemFailures"] == []
+    assert ('invalid-docs-bucket', 'invalid-docs-folder/id.jpg') in world.objects
+
+def test_comprehend_error_on_pdf_pages_fails_the_document(world, monkeypatch):
+    def unavailable(self, Text, LanguageCode):
+        raise client_error('InternalServerException', 'ContainsPiiEntities')
+    monkeypatch.setattr(FakeComprehend, 'contains_pii_entities', unavailable)
+    upload(world, 'scan.pdf', [FILLER_PAGE, UNLABELLED_AADHAAR_PAGE])
+    response = s3event.lambda_handler(sqs_event('scan.pdf'), None)
+
+    assert response["results"][0]["outcome"] == "error"
+    assert response["batchItemFailures"] == [{"itemIdentifier": "msg-scan.pdf"}]
+    assert (LANDING_BUCKET, 'scan.pdf') in world.objects
+
+def test_pdf_textract_rejects_is_invalid(world, monkeypatch):
+    def rejected(self, DocumentLocation, **kwargs):
+        raise client_error('UnsupportedDocumentException', 'StartDocumentTextDetection')
+    monkeypatch.setattr(FakeTextract, 'start_document_text_detection', rejected)
+    upload(world, 'scan.pdf', [PAN_PAGE])
+    response = s3event.lambda_handler(sqs_event('scan.pdf'), None)
+
+    result, = response["results"]
+    assert result["outcome"] == "invalid"
+    assert "UnsupportedDocumentException" in result["error_message"]
+    assert response["batchItemFailures"] == []
+    assert ('invalid-docs-bucket', 'invalid-docs-folder/scan.pdf') in world.objects
+
+def test_failed_textract_job_is_invalid(world, monkeypatch):
+    def failed(self, JobId, **kwargs):
+        return {'JobStatus': 'FAILED', 'StatusMessage': 'The document is encrypted'}
+    monkeypatch.setattr(FakeTextract, 'get_document_text_detection', failed)
+    upload(world, 'scan.pdf', [PAN_PAGE])
+    response = s3event.lambda_handler(sqs_event('scan.pdf'), None)
+
+    result, = response["results"]
+    assert result["outcome"] == "invalid"
+    assert "encrypted" in result["error_message"]
+    assert response["batchItemFailures"] == []
+    assert ('invalid-docs-bucket', 'invalid-docs-folder/scan.pdf') in world.objects
+
+def test_pdf_start_error_fails_the_document(world, monkeypatch):
+    def unavailable(self, DocumentLocation, **kwargs):
+        raise client_error('InternalServerError', 'StartDocumentTextDetection')
+    monkeypatch.setattr(FakeTextract, 'start_document_text_detection', unavailable)
+    upload(world, 'scan.pdf', [PAN_PAGE])
+    response = s3event.lambda_handler(sqs_event('scan.pdf'), None)
+
+    assert response["results"][0]["outcome"] == "error"
+    assert (LANDING_BUCKET, 'scan.pdf') in world.objects
+
+@pytest.mark.parametrize('code', ['BadDocumentException', 'DocumentTooLargeException', 'UnsupportedDocumentException'])
+def test_image_textract_rejects_is_invalid(world, monkeypatch, code):
+    def rejected(self, Document):
+        raise client_error(code, 'DetectDocumentText')
+    monkeypatch.setattr(FakeTextract, 'detect_document_text', rejected)
+    upload(world, 'id.jpg', [AADHAAR_PAGE])
+    response = s3event.lambda_handler(sqs_event('id.jpg'), None)
+
+    result, = response["results"]
+    assert result["outcome"] == "invalid"
+    assert code in result["error_message"]
+    assert response["batchItemFailures"] == []
+    assert ('invalid-docs-bucket', 'invalid-docs-folder/id.jpg') in world.objects
+
+def test_failed_completion_raises_and_can_be_replayed(world, textract_notifications, monkeypatch):
+    upload(world, 'scan.pdf', [UNLABELLED_AADHAAR_PAGE])
+    s3event.lambda_handler(sqs_event('scan.pdf'), None)
+    with monkeypatch.context() as patch:
+        def unavailable(self, Text, LanguageCode):
+            raise client_error('InternalServerException', 'ContainsPiiEntities')
+        patch.setattr(FakeComprehend, 'contains_pii_entities', unavailable)
+        with pytest.raises(Exception, match="failed or throttled"):
+            s3event.textract_completion_handler({'Records': world.completions}, None)
+    assert (LANDING_BUCKET, 'scan.pdf') in world.objects
+
+    # The event a dead-letter queue holds, replayed once the cause is gone
+    result, = s3event.textract_completion_handler({'Records': world.completions}, None)["results"]
+    assert result["outcome"] == "valid"
+    assert ('valid-docs-bucket', 'valid-docs-folder/scan.pdf') in world.objects
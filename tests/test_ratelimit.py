@@ -0,0 +1,111 @@
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+import ratelimit
+from ratelimit import DEFAULT_RATE_LIMITS, RateLimitedClient, RateLimiter, ThrottledError, TokenBucket, parse_rate_limits
+
+class Clock:
+    # Stands in for time.monotonic and time.sleep
+
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(ratelimit.time, 'sleep', clock.sleep)
+    return clock
+
+def client_error(code):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, 'DetectLabels')
+
+class Flaky:
+    # Raises the given errors in turn, then returns 'ok'
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+def test_parse_rate_limits():
+    assert parse_rate_limits('') == DEFAULT_RATE_LIMITS
+    assert parse_rate_limits('off') == {}
+    assert parse_rate_limits(' OFF ') == {}
+    limits = parse_rate_limits('textract.detect_document_text=5, comprehend.custom=2.5,')
+    assert limits['textract.detect_document_text'] == 5.0
+    assert limits['comprehend.custom'] == 2.5
+    assert limits['rekognition.detect_labels'] == DEFAULT_RATE_LIMITS['rekognition.detect_labels']
+
+def test_token_bucket_waits_for_tokens(clock):
+    bucket = TokenBucket(rate=2.0)
+    assert bucket.acquire() == 0.0
+    assert bucket.acquire() == 0.0
+    assert bucket.acquire() == pytest.approx(0.5)
+    clock.now += 10
+    # Tokens refill up to the bucket's capacity, not beyond
+    assert [bucket.acquire() for _ in range(2)] == [0.0, 0.0]
+    assert bucket.acquire() == pytest.approx(0.5)
+
+def test_throttled_call_is_retried(clock):
+    limiter = RateLimiter(limits={})
+    fn = Flaky(client_error('ThrottlingException'))
+    assert limiter.call('rekognition.detect_labels', fn) == 'ok'
+    assert fn.calls == 2
+    assert limiter.stats()['rekognition.detect_labels']["throttled"] == 1
+
+def test_gives_up_with_throttled_error(clock):
+    limiter = RateLimiter(limits={})
+    fn = Flaky(*[client_error('ThrottlingException')] * ratelimit.THROTTLE_MAX_ATTEMPTS)
+    with pytest.raises(ThrottledError) as error:
+        limiter.call('rekognition.detect_labels', fn)
+    assert error.value.api == 'rekognition.detect_labels'
+    assert fn.calls == ratelimit.THROTTLE_MAX_ATTEMPTS
+    assert limiter.stats()['rekognition.detect_labels']["gave_up"] == 1
+
+def test_transient_errors_are_retried_then_raised(clock):
+    limiter = RateLimiter(limits={})
+    fn = Flaky(client_error('InternalServerError'), EndpointConnectionError(endpoint_url='https://textract'))
+    assert limiter.call('textract.detect_document_text', fn) == 'ok'
+    assert fn.calls == 3
+
+    fn = Flaky(*[client_error('ServiceUnavailableException')] * ratelimit.THROTTLE_MAX_ATTEMPTS)
+    with pytest.raises(ClientError):
+        limiter.call('textract.detect_document_text', fn)
+    assert fn.calls == ratelimit.THROTTLE_MAX_ATTEMPTS
+
+def test_other_errors_are_raised_at_once(clock):
+    limiter = RateLimiter(limits={})
+    fn = Flaky(client_error('InvalidImageFormatException'))
+    with pytest.raises(ClientError):
+        limiter.call('rekognition.detect_labels', fn)
+    assert fn.calls == 1
+    assert clock.sleeps == []
+
+def test_limited_client_waits_for_its_api_bucket(clock):
+    class Client:
+        exceptions = object()
+
+        def detect_labels(self, **kwargs):
+            return kwargs
+
+    limiter = RateLimiter(limits={'rekognition.detect_labels': 1.0})
+    client = RateLimitedClient(Client(), 'rekognition', limiter=limiter)
+    assert client.exceptions is Client.exceptions
+    assert client.detect_labels(Image='a') == {'Image': 'a'}
+    client.detect_labels(Image='b')
+    assert clock.sleeps == [pytest.approx(1.0)]
+    assert limiter.stats()['rekognition.detect_labels']["calls"] == 2
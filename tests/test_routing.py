@@ -0,0 +1,91 @@
+import pytest
+
+from fakes import FakeS3, SimulationConfig, World
+from routing import Router
+from sidecar import build_sidecar, decode_sidecar, encode_sidecar
+
+@pytest.fixture
+def world():
+    return World(SimulationConfig(latency_scale=0))
+
+def upload(world, key, body=b'document'):
+    world.objects[('docs-landing-bucket', key)] = body
+
+def sidecar(key, pages=(), **fields):
+    return encode_sidecar(dict(build_sidecar({"bucket": 'docs-landing-bucket', "key": key, "outcome": 'valid', "ocr_pages": list(pages)}), **fields))
+
+def test_cache_hit_takes_the_ocr_output_of_the_existing_sidecar(world):
+    upload(world, 'copy.jpg')
+    page = {"page": 1, "text": "2345 6789 0124", "lines": [], "entities": []}
+    world.objects[('valid-docs-bucket', 'valid-docs-folder/first.jpg.ocr.json.gz')] = sidecar('first.jpg', [page])
+    router = Router(FakeS3(world), max_workers=1)
+    router.route('docs-landing-bucket', 'copy.jpg', 'valid', sidecar=sidecar('copy.jpg', cached=True),
+                 sidecar_source=('valid-docs-bucket', 'valid-docs-folder/first.jpg.ocr.json.gz'))
+    assert router.flush() == {}
+
+    copied = decode_sidecar(world.objects[('valid-docs-bucket', 'valid-docs-folder/copy.jpg.ocr.json.gz')])
+    assert copied["pages"] == [page]
+    assert copied["source"] == {"bucket": 'docs-landing-bucket', "key": 'copy.jpg'}
+    assert copied["ocr_source"] == {"bucket": 'docs-landing-bucket', "key": 'first.jpg'}
+    assert copied["cached"]
+
+def test_missing_cached_sidecar_is_written_again(world):
+    upload(world, 'copy.jpg')
+    router = Router(FakeS3(world), max_workers=1)
+    router.route('docs-landing-bucket', 'copy.jpg', 'valid', sidecar=b'own sidecar',
+                 sidecar_source=('valid-docs-bucket', 'valid-docs-folder/gone.jpg.ocr.json.gz'))
+    assert router.flush() == {}
+    assert world.objects[('valid-docs-bucket', 'valid-docs-folder/copy.jpg.ocr.json.gz')] == b'own sidecar'
+
+def test_cached_sidecar_at_the_destination_is_kept(world):
+    upload(world, 'scan.jpg')
+    world.objects[('valid-docs-bucket', 'valid-docs-folder/scan.jpg.ocr.json.gz')] = b'original sidecar'
+    router = Router(FakeS3(world), max_workers=1)
+    router.route('docs-landing-bucket', 'scan.jpg', 'valid', sidecar=b'own sidecar',
+                 sidecar_source=('valid-docs-bucket', 'valid-docs-folder/scan.jpg.ocr.json.gz'))
+    assert router.flush() == {}
+    assert world.objects[('valid-docs-bucket', 'valid-docs-folder/scan.jpg.ocr.json.gz')] == b'original sidecar'
+
+def test_failed_copy_leaves_no_sidecar(world, monkeypatch):
+    upload(world, 'id.jpg')
+
+    def copy_object_failing(self, Bucket, CopySource, Key, **kwargs):
+        raise RuntimeError('copy failed')
+    monkeypatch.setattr(FakeS3, 'copy_object', copy_object_failing)
+    router = Router(FakeS3(world), max_workers=1)
+    router.route('docs-landing-bucket', 'id.jpg', 'valid', sidecar=b'own sidecar')
+    assert router.flush() == {('docs-landing-bucket', 'id.jpg'): 'copy failed'}
+    assert set(world.objects) == {('docs-landing-bucket', 'id.jpg')}
+
+def test_source_of_a_failed_copy_is_not_deleted(world, monkeypatch):
+    upload(world, 'id.jpg')
+    upload(world, 'other.jpg')
+    copy_object = FakeS3.copy_object
+
+    def copy_object_failing(self, Bucket, CopySource, Key, **kwargs):
+        if CopySource['Key'] == 'id.jpg':
+            raise RuntimeError('copy failed')
+        return copy_object(self, Bucket, CopySource, Key, **kwargs)
+    monkeypatch.setattr(FakeS3, 'copy_object', copy_object_failing)
+
+    router = Router(FakeS3(world), max_workers=1)
+    router.route('docs-landing-bucket', 'id.jpg', 'valid')
+    router.route('docs-landing-bucket', 'other.jpg', 'invalid')
+    assert router.flush() == {('docs-landing-bucket', 'id.jpg'): 'copy failed'}
+    assert ('docs-landing-bucket', 'id.jpg') in world.objects
+    assert ('docs-landing-bucket', 'other.jpg') not in world.objects
+    assert ('invalid-docs-bucket', 'invalid-docs-folder/other.jpg') in world.objects
+
+def test_keys_that_could_not_be_deleted_are_reported(world, monkeypatch):
+    upload(world, 'id.jpg')
+    upload(world, 'other.jpg')
+
+    def delete_objects_partially(self, Bucket, Delete, **kwargs):
+        return {'Errors': [{'Key': 'id.jpg', 'Code': 'AccessDenied', 'Message': 'Access Denied'}]}
+    monkeypatch.setattr(FakeS3, 'delete_objects', delete_objects_partially)
+
+    router = Router(FakeS3(world), max_workers=1)
+    router.route('docs-landing-bucket', 'id.jpg', 'valid')
+    router.route('docs-landing-bucket', 'other.jpg', 'valid')
+    assert router.flush() == {('docs-landing-bucket', 'id.jpg'): 'AccessDenied: Access Denied'}
+    assert ('valid-docs-bucket', 'valid-docs-folder/id.jpg') in world.objects
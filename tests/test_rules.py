@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+from rules import DEFAULT_RULES, READ_TEXT, RuleSet, load_rules
+
+def labels(*names, confidence=99.0):
+    return [{'Name': name, 'Confidence': confidence} for name in names]
+
+def test_default_rules():
+    rules = load_rules(None)
+    assert rules.config == DEFAULT_RULES
+    assert rules.fingerprint == RuleSet(DEFAULT_RULES).fingerprint
+
+def test_rules_from_json_merge_with_the_defaults(tmp_path):
+    config = {"entities": {"IN_AADHAAR": "valid"}}
+    from_string = load_rules(json.dumps(config))
+    assert from_string.entity_types == ('IN_AADHAAR',)
+    assert from_string.config["labels"] == DEFAULT_RULES["labels"]
+    assert from_string.fingerprint != load_rules(None).fingerprint
+
+    path = tmp_path / 'rules.json'
+    path.write_text(json.dumps(config))
+    assert load_rules(str(path)).fingerprint == from_string.fingerprint
+
+def test_unknown_sections_and_outcomes_are_rejected():
+    with pytest.raises(ValueError, match="Unknown rules sections"):
+        load_rules('{"label": []}')
+    with pytest.raises(ValueError, match="Label rule outcome"):
+        load_rules('{"labels": [{"names": ["Passport"], "outcome": "maybe"}]}')
+    with pytest.raises(ValueError, match="Entity outcome"):
+        load_rules('{"entities": {"IN_AADHAAR": "accepted"}}')
+    with pytest.raises(ValueError, match="Comprehend analysis"):
+        load_rules('{"comprehend": [{"analysis": "entities"}]}')
+
+def test_deciding_label_rule_wins_in_label_order():
+    rules = load_rules(None)
+    trace = []
+    assert rules.check_labels(labels('Document', 'Passport'), trace) == 'valid-passport'
+    assert trace == [{"stage": "labels", "decision": "valid-passport", "label": "Passport", "confidence": 99.0}]
+
+    trace = []
+    assert rules.check_labels(labels('Passport', confidence=70.0) + labels('Text'), trace) == READ_TEXT
+    assert trace == [{"stage": "labels", "decision": READ_TEXT, "labels": ["Passport", "Text"]}]
+
+    trace = []
+    assert rules.check_labels(labels('Text', confidence=40.0) + labels('Cat'), trace) == 'invalid'
+    assert trace[0]["decision"] == 'invalid'
+
+def test_deciding_rule_applies_after_a_rule_that_reads_text():
+    rules = load_rules(json.dumps({"labels": [
+        {"names": ["Document"], "min_confidence": 50.0},
+        {"names": ["Document"], "min_confidence": 90.0, "outcome": "invalid"}
+    ]}))
+    trace = []
+    assert rules.check_labels(labels('Document'), trace) == 'invalid'
+
+def test_hints_and_comprehend_rule():
+    rules = load_rules(None)
+    hints = rules.match_hints("INCOME\nTAX Department, Driving Licence")
+    assert hints == {'PAN', 'DRIVING_LICENCE'}
+    assert rules.comprehend_rule(hints)["hint"] == 'DRIVING_LICENCE'
+    assert rules.comprehend_rule(set()) == {"hint": None, "analysis": "labels", "min_score": 0.7}